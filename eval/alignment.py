@@ -1,75 +1,184 @@
-# Author: Bingxin Ke
-# source: Lotus
-
-import numpy as np
-import torch
-
-
-def align_depth_least_square(
-    gt_arr: np.ndarray,
-    pred_arr: np.ndarray,
-    valid_mask_arr: np.ndarray,
-    return_scale_shift=True,
-    max_resolution=None,
-):
-    ori_shape = pred_arr.shape  # input shape
-
-    gt = gt_arr.squeeze()  # [H, W]
-    pred = pred_arr.squeeze()
-    valid_mask = valid_mask_arr.squeeze()
-
-    # Downsample if needed
-    if max_resolution is not None:
-        scale_factor = np.min(max_resolution / np.array(ori_shape[-2:]))
-        if scale_factor < 1:
-            downscaler = torch.nn.Upsample(scale_factor=scale_factor, mode="nearest")
-            gt = downscaler(torch.as_tensor(gt).unsqueeze(0)).numpy()
-            pred = downscaler(torch.as_tensor(pred).unsqueeze(0)).numpy()
-            valid_mask = (
-                downscaler(torch.as_tensor(valid_mask).unsqueeze(0).float())
-                .bool()
-                .numpy()
-            )
-
-    assert (
-        gt.shape == pred.shape == valid_mask.shape
-    ), f"{gt.shape}, {pred.shape}, {valid_mask.shape}"
-
-    gt_masked = gt[valid_mask].reshape((-1, 1))
-    pred_masked = pred[valid_mask].reshape((-1, 1))
-
-    # Construct linear system for least squares
-    _ones = np.ones_like(pred_masked)
-    A = np.concatenate([pred_masked, _ones], axis=-1)
-    X = np.linalg.lstsq(A, gt_masked, rcond=None)[0]
-    scale, shift = X
-
-    aligned_pred = pred_arr * scale + shift
-
-    # Restore original dimensions
-    aligned_pred = aligned_pred.reshape(ori_shape)
-
-    if return_scale_shift:
-        return aligned_pred, scale, shift
-    else:
-        return aligned_pred
-
-
-# ******************** disparity space ********************
-def depth2disparity(depth, return_mask=False):
-    if isinstance(depth, torch.Tensor):
-        disparity = torch.zeros_like(depth)
-    elif isinstance(depth, np.ndarray):
-        disparity = np.zeros_like(depth)
-    non_negtive_mask = depth > 0
-    disparity[non_negtive_mask] = 1.0 / depth[non_negtive_mask]
-    if return_mask:
-        return disparity, non_negtive_mask
-    else:
-        return disparity
-
-
-def disparity2depth(disparity, **kwargs):
-    # For simplicity, we assume the inverse operation is similar to depth2disparity.
-    # If a true inverse is needed, consider 1.0 / disparity for valid disparities.
-    return depth2disparity(disparity, **kwargs)
+# Author: Bingxin Ke
+# source: Lotus
+
+import numpy as np
+
+
+def nearest_indices(size, scale_factor):
+    """Source indices of a nearest-neighbour resize of an axis by scale_factor (as torch's "nearest")"""
+    out_size = int(np.floor(size * scale_factor))
+    return np.minimum((np.arange(out_size) / scale_factor).astype(np.intp), size - 1)
+
+
+def align_depth_least_square(
+    gt_arr: np.ndarray,
+    pred_arr: np.ndarray,
+    valid_mask_arr: np.ndarray,
+    return_scale_shift=True,
+    max_resolution=None,
+):
+    ori_shape = pred_arr.shape  # input shape
+
+    gt = gt_arr.squeeze()  # [H, W]
+    pred = pred_arr.squeeze()
+    valid_mask = valid_mask_arr.squeeze()
+
+    # Downsample if needed (nearest neighbour)
+    if max_resolution is not None:
+        scale_factor = np.min(max_resolution / np.array(ori_shape[-2:]))
+        if scale_factor < 1:
+            rows, cols = (nearest_indices(size, scale_factor) for size in gt.shape[-2:])
+            gt = gt[..., rows[:, None], cols]
+            pred = pred[..., rows[:, None], cols]
+            valid_mask = valid_mask[..., rows[:, None], cols].astype(bool)
+
+    assert (
+        gt.shape == pred.shape == valid_mask.shape
+    ), f"{gt.shape}, {pred.shape}, {valid_mask.shape}"
+
+    gt_masked = gt[valid_mask].reshape((-1, 1))
+    pred_masked = pred[valid_mask].reshape((-1, 1))
+
+    # Construct linear system for least squares
+    _ones = np.ones_like(pred_masked)
+    A = np.concatenate([pred_masked, _ones], axis=-1)
+    X = np.linalg.lstsq(A, gt_masked, rcond=None)[0]
+    scale, shift = X
+
+    aligned_pred = pred_arr * scale + shift
+
+    # Restore original dimensions
+    aligned_pred = aligned_pred.reshape(ori_shape)
+
+    if return_scale_shift:
+        return aligned_pred, scale, shift
+    else:
+        return aligned_pred
+
+
+# ******************** closed-form alignment ********************
+# Sufficient statistics of the 2-parameter least squares fit gt ~ scale * pred + shift
+LSQ_SUM_FIELDS = ("n", "sum_pred", "sum_gt", "sum_pred_sq", "sum_pred_gt")
+
+
+def sampling_stride(shape, max_resolution=None):
+    """Row/column stride that brings a frame down to at most max_resolution pixels per side.
+    
+    1-D inputs are pixel samples, not images, and are never strided.
+    """
+    if max_resolution is None or len(shape) < 2:
+        return 1
+    return max(1, int(np.ceil(max(shape[-2:]) / max_resolution)))
+
+
+def least_square_sums(
+    gt_arr: np.ndarray,
+    pred_arr: np.ndarray,
+    valid_mask_arr: np.ndarray,
+    max_resolution=None,
+):
+    """[n, Σp, Σg, Σp², Σpg] over the valid pixels, on a strided grid if max_resolution is set"""
+    gt = gt_arr.squeeze()
+    pred = pred_arr.squeeze()
+    valid_mask = valid_mask_arr.squeeze()
+
+    assert (
+        gt.shape == pred.shape == valid_mask.shape
+    ), f"{gt.shape}, {pred.shape}, {valid_mask.shape}"
+
+    stride = sampling_stride(gt.shape, max_resolution)
+    if stride > 1:
+        gt = gt[::stride, ::stride]
+        pred = pred[::stride, ::stride]
+        valid_mask = valid_mask[::stride, ::stride]
+
+    gt_masked = gt[valid_mask].astype(np.float64, copy=False)
+    pred_masked = pred[valid_mask].astype(np.float64, copy=False)
+    return np.array([
+        gt_masked.size,
+        pred_masked.sum(),
+        gt_masked.sum(),
+        np.dot(pred_masked, pred_masked),
+        np.dot(pred_masked, gt_masked),
+    ], dtype=np.float64)
+
+
+def solve_scale_shift(sums):
+    """Scale and shift from least squares sums; same solution as np.linalg.lstsq on [pred, 1]"""
+    n, sum_p, sum_g, sum_pp, sum_pg = sums
+    if n == 0:
+        return 0.0, 0.0
+    denom = n * sum_pp - sum_p**2
+    if denom <= 1e-12 * n * sum_pp:
+        # Constant prediction: lstsq returns the minimum norm solution
+        p = sum_p / n
+        g = sum_g / n
+        return p * g / (p**2 + 1), g / (p**2 + 1)
+    scale = (n * sum_pg - sum_p * sum_g) / denom
+    shift = (sum_g - scale * sum_p) / n
+    return scale, shift
+
+
+def align_depth_closed_form(
+    gt_arr: np.ndarray,
+    pred_arr: np.ndarray,
+    valid_mask_arr: np.ndarray,
+    return_scale_shift=True,
+    max_resolution=None,
+):
+    """Drop-in replacement of align_depth_least_square solving the 2x2 normal equations"""
+    scale, shift = solve_scale_shift(
+        least_square_sums(gt_arr, pred_arr, valid_mask_arr, max_resolution))
+
+    aligned_pred = np.asarray(pred_arr, dtype=np.float64) * scale + shift
+
+    if return_scale_shift:
+        return aligned_pred, scale, shift
+    else:
+        return aligned_pred
+
+
+# ******************** log-depth histogram (streaming median) ********************
+# Fixed bins in log space: relative bin width ~0.17%, linearly interpolated within the bin
+LOG_DEPTH_BINS = 1 << 14
+LOG_DEPTH_RANGE = (np.log(1e-6), np.log(1e6))
+
+
+def log_depth_histogram(depth: np.ndarray, valid_mask: np.ndarray):
+    """Counts of log(depth) over the valid pixels in LOG_DEPTH_BINS fixed bins; values out of range go to the end bins"""
+    lo, hi = LOG_DEPTH_RANGE
+    values = np.maximum(depth[valid_mask].astype(np.float64), np.exp(lo))
+    idx = (np.log(values) - lo) * (LOG_DEPTH_BINS / (hi - lo))
+    idx = np.clip(idx, 0, LOG_DEPTH_BINS - 1).astype(np.intp)
+    return np.bincount(idx, minlength=LOG_DEPTH_BINS).astype(np.float64)
+
+
+def histogram_median(hist):
+    """Median depth of a log_depth_histogram, None if it is empty"""
+    total = hist.sum()
+    if total == 0:
+        return None
+    cumulative = np.cumsum(hist)
+    half = total / 2
+    b = int(np.searchsorted(cumulative, half))
+    fraction = (half - (cumulative[b] - hist[b])) / hist[b]
+    lo, hi = LOG_DEPTH_RANGE
+    return float(np.exp(lo + (b + fraction) * (hi - lo) / LOG_DEPTH_BINS))
+
+
+# ******************** disparity space ********************
+def depth2disparity(depth, return_mask=False):
+    # Tensors (torch) are handled without importing torch
+    disparity = np.zeros_like(depth) if isinstance(depth, np.ndarray) else depth.new_zeros(depth.shape)
+    non_negtive_mask = depth > 0
+    disparity[non_negtive_mask] = 1.0 / depth[non_negtive_mask]
+    if return_mask:
+        return disparity, non_negtive_mask
+    else:
+        return disparity
+
+
+def disparity2depth(disparity, **kwargs):
+    # For simplicity, we assume the inverse operation is similar to depth2disparity.
+    # If a true inverse is needed, consider 1.0 / disparity for valid disparities.
+    return depth2disparity(disparity, **kwargs)
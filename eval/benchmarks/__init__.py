@@ -0,0 +1 @@
+"""Benchmarks for the evaluation framework (run from the eval directory)"""
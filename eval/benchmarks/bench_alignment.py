@@ -0,0 +1,85 @@
+"""
+Benchmark and equivalence check of the closed-form scale/shift alignment against the lstsq version
+
+Usage (from the eval directory):
+    python -m benchmarks.bench_alignment --height 720 --width 1280 --max_resolution 1000
+    python -m benchmarks.bench_alignment --check --seed 0
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from alignment import align_depth_closed_form, align_depth_least_square
+
+
+def synthetic_pair(height, width, seed=0):
+    """Relative prediction related to the GT by a known scale/shift plus noise"""
+    rng = np.random.default_rng(seed)
+    gt = rng.uniform(0.05, 1.0, (height, width))
+    gt[rng.random((height, width)) < 0.1] = 0
+    pred = (gt - 0.1) / 2.5 + rng.normal(0.0, 0.01, (height, width))
+    return gt, pred, gt > 0
+
+
+def time_call(fn, repeats):
+    """Best-of-repeats wall time of fn() in milliseconds"""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Alignment benchmark")
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--max_resolution", type=int, default=1000,
+                        help="aligment_max_res used for the strided closed-form variant")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--tolerance", type=float, default=1e-9,
+                        help="Maximum relative deviation of scale and shift from lstsq at full resolution")
+    parser.add_argument("--check", action="store_true",
+                        help="Tolerance check only: time a single run and exit 1 beyond tolerance")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic frames")
+    args = parser.parse_args()
+    if args.check:
+        args.repeats = 1
+
+    failed = False
+    print(f"Frame {args.height}x{args.width}, best of {args.repeats} runs")
+    print(f"{'inputs':>8} | {'method':>22} | {'ms/frame':>9} | {'speedup':>7} | {'scale':>10} | {'shift':>10} | {'rel err':>9}")
+    for dtype in (np.float64, np.float32):
+        gt, pred, mask = (a.astype(dtype) if a.dtype != bool else a
+                          for a in synthetic_pair(args.height, args.width, args.seed))
+        # lstsq solves in the input precision; the float64 solution is the reference
+        _, ref_scale, ref_shift = align_depth_least_square(gt.astype(np.float64), pred.astype(np.float64), mask)
+        ref_scale, ref_shift = float(ref_scale[0]), float(ref_shift[0])
+        lstsq_ms = time_call(lambda: align_depth_least_square(gt, pred, mask), args.repeats)
+        print(f"{np.dtype(dtype).name:>8} | {'lstsq':>22} | {lstsq_ms:>9.2f} | {1.0:>7.2f} | "
+              f"{ref_scale:>10.6f} | {ref_shift:>10.6f} | {0.0:>9.2e}")
+
+        for max_resolution in (None, args.max_resolution):
+            _, scale, shift = align_depth_closed_form(gt, pred, mask, max_resolution=max_resolution)
+            ms = time_call(lambda: align_depth_closed_form(gt, pred, mask, max_resolution=max_resolution),
+                           args.repeats)
+            error = max(abs(scale - ref_scale) / abs(ref_scale), abs(shift - ref_shift) / abs(ref_shift))
+            label = "closed form" if max_resolution is None else f"closed form (max {max_resolution})"
+            status = ""
+            if max_resolution is None and error > args.tolerance:
+                status = "  FAIL"
+                failed = True
+            print(f"{np.dtype(dtype).name:>8} | {label:>22} | {ms:>9.2f} | {lstsq_ms / ms:>7.2f} | "
+                  f"{scale:>10.6f} | {shift:>10.6f} | {error:>9.2e}{status}")
+
+    if failed:
+        print("Closed-form alignment deviates from lstsq beyond tolerance")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark of the vectorised bootstrap and equivalence check against resampling frame by frame
+
+Usage (from the eval directory):
+    python -m benchmarks.bench_bootstrap --frames 50000 --resamples 10000 --models 2
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from bootstrap import COLUMNS, FrameStats, bootstrap_metrics, metrics_from_stats, resample_counts
+from metrics import NUM_SUMS, MetricAccumulator, metric_values_from_sums
+
+
+def synthetic_sums(num_frames, seed=0):
+    """Plausible per-frame sums: n valid pixels, per-pixel error sums and δ / F_A counts"""
+    rng = np.random.default_rng(seed)
+    n = rng.integers(10_000, 1_000_000, num_frames).astype(np.float64)
+    sums = np.empty((num_frames, NUM_SUMS))
+    sums[:, 0] = n
+    sums[:, 1:7] = rng.uniform(0.001, 0.2, (num_frames, 6)) * n[:, None]
+    sums[:, 7:] = rng.uniform(0.5, 1.0, (num_frames, NUM_SUMS - 7)) * n[:, None]
+    return sums
+
+
+def frame_stats(sums_per_model):
+    """FrameStats filled directly (one accumulator row per frame, as evaluate_models_parallel would)"""
+    stats = FrameStats()
+    for m, sums in enumerate(sums_per_model):
+        values = metric_values_from_sums(sums)
+        rows = np.concatenate([sums, np.ones((len(sums), 1)), values], axis=1)
+        stats.rows[(f"model{m}", "all")] = dict(enumerate(rows))
+    return stats
+
+
+def check_equivalence(seed=0, num_frames=50, num_resamples=5):
+    """Largest relative deviation of the vectorised metrics from MetricAccumulator resampling"""
+    sums = synthetic_sums(num_frames, seed)
+    stats = frame_stats([sums]).matrix([("model0", "all")])
+    counts = resample_counts(np.random.default_rng(seed), num_frames, num_resamples)
+    worst = 0.0
+    for pixel_weighted in (False, True):
+        fast = metrics_from_stats(counts @ stats, pixel_weighted)
+        for r in range(num_resamples):
+            accumulator = MetricAccumulator()
+            for frame in np.repeat(np.arange(num_frames), counts[r].astype(int)):
+                accumulator.add_frame(sums[frame])
+            reference = np.array(list(accumulator.metrics(pixel_weighted).values()))
+            worst = max(worst, float(np.max(np.abs(fast[r] - reference) / np.maximum(np.abs(reference), 1e-12))))
+    return worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bootstrap benchmark")
+    parser.add_argument("--frames", type=int, default=50_000)
+    parser.add_argument("--resamples", type=int, default=10_000)
+    parser.add_argument("--models", type=int, default=2)
+    parser.add_argument("--tolerance", type=float, default=1e-9,
+                        help="Maximum relative deviation from resampling with MetricAccumulator")
+    args = parser.parse_args()
+
+    error = check_equivalence()
+    print(f"Equivalence with frame-by-frame resampling: max rel err {error:.2e}")
+
+    stats = frame_stats([synthetic_sums(args.frames, seed) for seed in range(args.models)])
+    keys = [(f"model{m}", "all") for m in range(args.models)]
+    start = time.perf_counter()
+    values = bootstrap_metrics(stats, keys, args.resamples)
+    seconds = time.perf_counter() - start
+    print(f"{args.resamples} resamples x {args.frames} frames x {args.models} model(s): {seconds:.2f} s "
+          f"({args.resamples / seconds:.0f} resamples/s, {COLUMNS} statistics per frame)")
+    spread = np.nanpercentile(values[:, 0, 0], [2.5, 97.5])
+    print(f"model0 Abs Rel 95% interval: [{spread[0]:.5f}, {spread[1]:.5f}]")
+
+    if error > args.tolerance:
+        print("Vectorised bootstrap deviates from frame-by-frame resampling beyond tolerance")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+In-memory Evaluator vs writing predictions to disk and evaluating the folder
+
+The predictions of a synthetic lunar dataset (see synthetic_dataset.py) are held in memory, as they
+come out of a model. The disk round trip saves them as .npy files and evaluates the folder like
+eval2results.py (evaluate_models_parallel); the in-memory path submits them to an Evaluator. Both use
+label and shadow slices. Reports frames per second of both and exits 1 if their metrics differ.
+
+Usage (from the eval directory):
+    python -m benchmarks.bench_evaluator --frames 32 --height 720 --width 1280 --num_workers 4
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.bench_pipeline import LABELS, SHADOW_REGIONS, preprocessor_for
+from benchmarks.synthetic_dataset import generate_dataset
+from evaluator import Evaluator
+from metrics import EvalModel, build_slices, evaluate_models_parallel
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-memory Evaluator vs disk round trip benchmark")
+    parser.add_argument("--dataset", type=str,
+                        help="Synthetic dataset directory, generated if it does not exist (default: a temporary one)")
+    parser.add_argument("--frames", type=int, default=32)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--queue_size", type=int, default=32)
+    args = parser.parse_args()
+
+    dataset_dir = args.dataset or tempfile.mkdtemp(prefix="lunar_bench_")
+    output_dir = tempfile.mkdtemp(prefix="lunar_preds_")
+    try:
+        if not os.path.isdir(os.path.join(dataset_dir, "npy", "gt")):
+            print(f"Generating {args.frames} frames of {args.height}x{args.width} in {dataset_dir}")
+            generate_dataset(dataset_dir, args.frames, args.height, args.width, ("npy",))
+        gt_dir, pred_dir = os.path.join(dataset_dir, "npy", "gt"), os.path.join(dataset_dir, "npy", "pred")
+        label_dir, shadow_dir = os.path.join(dataset_dir, "label"), os.path.join(dataset_dir, "shadow")
+        names = sorted(os.listdir(gt_dir))[:args.frames]
+        # The model output
+        predictions = [(os.path.splitext(name)[0], np.load(os.path.join(pred_dir, name))) for name in names]
+
+        start = time.perf_counter()
+        for frame_id, pred in predictions:
+            np.save(os.path.join(output_dir, f"{frame_id}.npy"), pred)
+        preprocessor = preprocessor_for("npy")
+        slices = build_slices(LABELS, SHADOW_REGIONS)
+        results = evaluate_models_parallel(
+            [os.path.join(gt_dir, name) for name in names],
+            [EvalModel("pred", [os.path.join(output_dir, name) for name in names], None)],
+            preprocessor, slices, num_workers=args.num_workers, shadow_mask_dir=shadow_dir,
+            labeling_path=label_dir, progress_interval=0)
+        disk_fps = len(names) / (time.perf_counter() - start)
+        reference = {name: accumulator for (_, name), accumulator in results.items()}
+
+        start = time.perf_counter()
+        evaluator = Evaluator(gt_dir, queue_size=args.queue_size, relative_depth=True, num_workers=args.num_workers,
+                              labeling=list(LABELS), labeling_path=label_dir, shadow_mask=shadow_dir,
+                              shadow_region=list(SHADOW_REGIONS))
+        evaluator.evaluate(predictions)
+        accumulators = evaluator.results()
+        memory_fps = len(names) / (time.perf_counter() - start)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        if not args.dataset:
+            shutil.rmtree(dataset_dir, ignore_errors=True)
+
+    # Accumulated sums, image counts and per-image metric sums of every slice
+    difference = max(float(np.max(np.abs(reference[name].stats - accumulators[name].stats))) for name in reference)
+    print(f"{len(names)} frames, {len(slices)} slices, {args.num_workers} worker(s)")
+    print(f"disk round trip: {disk_fps:.2f} frames/s")
+    print(f"Evaluator:       {memory_fps:.2f} frames/s ({memory_fps / disk_fps:.2f}x)")
+    print(f"max difference of the accumulated statistics: {difference:.2e}")
+    if difference > 0:
+        print("The in-memory metrics differ from the disk round trip")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
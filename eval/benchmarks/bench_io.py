@@ -0,0 +1,108 @@
+"""
+Read-ahead decoding (--io_threads) vs decoding in the compute loop
+
+Runs eval2results.py on a synthetic lunar dataset (see synthetic_dataset.py) with label and shadow
+slices, once per --io_threads value, depth format and label map encoding (RGB and palette PNGs, which
+the label loader decodes to the same colors). Reports frames per second and the I/O vs compute
+utilisation the run prints, and exits 1 if a run's results differ from the run without prefetching.
+The gain grows with the file latency, so run it on the filesystem the datasets live on (--dataset).
+
+Usage (from the eval directory):
+    python -m benchmarks.bench_io --frames 32 --height 720 --width 1280 --num_workers 4 --io_threads 0 1 2 4
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_pipeline import EVAL_DIR, LABELS, SHADOW_REGIONS
+from benchmarks.synthetic_dataset import generate_dataset
+
+
+def write_palette_labels(dataset_dir):
+    """Save the RGB label maps of a dataset as palette (P mode) PNGs in dataset_dir/label_palette"""
+    from PIL import Image
+
+    label_dir, palette_dir = os.path.join(dataset_dir, "label"), os.path.join(dataset_dir, "label_palette")
+    os.makedirs(palette_dir, exist_ok=True)
+    for name in sorted(os.listdir(label_dir)):
+        image = Image.open(os.path.join(label_dir, name)).convert("RGB")
+        image.convert("P", palette=Image.ADAPTIVE).save(os.path.join(palette_dir, name))
+
+
+def run_eval(dataset_dir, fmt, labels, num_workers, io_threads, io_readahead):
+    """(seconds, results table, I/O utilisation line) of one eval2results.py run with the label maps
+    of dataset_dir/labels
+    """
+    command = [sys.executable, "eval2results.py", os.path.join(dataset_dir, fmt, "gt"),
+               os.path.join(dataset_dir, fmt, "pred"), "--relative_depth", "--num_workers", str(num_workers),
+               "--labeling", *LABELS, "--labeling_path", os.path.join(dataset_dir, labels),
+               "--shadow_mask", os.path.join(dataset_dir, "shadow"), "--shadow_region", *SHADOW_REGIONS,
+               "--io_threads", str(io_threads), "--io_readahead", str(io_readahead), "--progress_interval", "1e9"]
+    if fmt == "pfm":
+        command.append("--pfm_flip_rows")
+    start = time.perf_counter()
+    output = subprocess.run(command, cwd=EVAL_DIR, check=True, capture_output=True, text=True).stdout
+    seconds = time.perf_counter() - start
+    if "Error processing" in output:
+        # Failed frames are left out of the results, which would hide a decoding mismatch
+        raise RuntimeError(f"frames failed with --io_threads {io_threads} and {labels} label maps:\n{output}")
+    lines = output.splitlines()
+    table = "\n".join(lines[next(i for i, line in enumerate(lines) if line.startswith("Results")):])
+    utilisation = next((line.split(": ", 1)[1] for line in lines if line.startswith("I/O vs compute")), "-")
+    return seconds, table, utilisation
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read-ahead decoding benchmark")
+    parser.add_argument("--dataset", type=str,
+                        help="Synthetic dataset directory, generated if it does not exist (default: a temporary one)")
+    parser.add_argument("--frames", type=int, default=32)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--formats", type=str, nargs="+", default=["png", "npy"])
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--io_threads", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("--io_readahead", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=2, help="Runs per setting, the fastest is reported")
+    args = parser.parse_args()
+
+    dataset_dir = args.dataset or tempfile.mkdtemp(prefix="lunar_bench_")
+    failed = False
+    try:
+        if any(not os.path.isdir(os.path.join(dataset_dir, fmt, "gt")) for fmt in args.formats):
+            print(f"Generating {args.frames} frames of {args.height}x{args.width} in {dataset_dir}")
+            generate_dataset(dataset_dir, args.frames, args.height, args.width, tuple(args.formats))
+        if not os.path.isdir(os.path.join(dataset_dir, "label_palette")):
+            write_palette_labels(dataset_dir)
+        frames = len(os.listdir(os.path.join(dataset_dir, args.formats[0], "gt")))
+        print(f"{frames} frames, {args.num_workers} worker(s), readahead {args.io_readahead}")
+        print(f"{'Format':<6} | {'Labels':<13} | {'I/O threads':>11} | {'Frames/s':>8} | {'Speedup':>7} | I/O vs compute")
+        for fmt in args.formats:
+            for labels in ("label", "label_palette"):
+                reference = None
+                for io_threads in args.io_threads:
+                    runs = [run_eval(dataset_dir, fmt, labels, args.num_workers, io_threads, args.io_readahead)
+                            for _ in range(args.repeats)]
+                    seconds, table, utilisation = min(runs, key=lambda run: run[0])
+                    if reference is None:
+                        reference = (seconds, table)
+                    elif table != reference[1]:
+                        print(f"{fmt}, {labels}: the results with --io_threads {io_threads} differ from "
+                              f"--io_threads {args.io_threads[0]}")
+                        failed = True
+                    print(f"{fmt:<6} | {labels:<13} | {io_threads:>11} | {frames / seconds:>8.2f} | "
+                          f"{reference[0] / seconds:>6.2f}x | {utilisation}")
+    finally:
+        if not args.dataset:
+            shutil.rmtree(dataset_dir, ignore_errors=True)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Microbenchmark and tolerance check of the fused metric engine against compute_metrics_reference
+
+Usage (from the eval directory):
+    python -m benchmarks.bench_metrics --height 720 --width 1280 --repeats 20
+    python -m benchmarks.bench_metrics --check --seed 0
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import metrics
+from metrics import METRIC_NAMES, compute_metrics_reference, configure_metrics, compute_metrics
+
+
+def synthetic_pair(height, width, dtype, seed=0):
+    """Random depth pair with invalid pixels and a distance-like mask"""
+    rng = np.random.default_rng(seed)
+    gt = rng.uniform(0.0, 1.0, (height, width)).astype(dtype)
+    gt[rng.random((height, width)) < 0.1] = 0
+    pred = np.clip(gt * rng.normal(1.0, 0.15, (height, width)), 1e-6, 1.0).astype(dtype)
+    mask = gt < 0.8
+    return gt, pred, mask
+
+
+def time_call(fn, repeats):
+    """Best-of-repeats wall time of fn() in milliseconds"""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1e3
+
+
+def max_relative_error(reference, values):
+    """Largest relative deviation over all metrics"""
+    return max(abs(values[m] - reference[m]) / max(abs(reference[m]), 1e-12) for m in METRIC_NAMES)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fused metric engine benchmark")
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--tolerance", type=float, default=1e-9,
+                        help="Maximum relative deviation from the reference for float64 computations")
+    parser.add_argument("--float32_tolerance", type=float, default=1e-4,
+                        help="Maximum relative deviation when float32 inputs or a float32 working precision are involved")
+    parser.add_argument("--check", action="store_true",
+                        help="Tolerance check only: time a single run and exit 1 beyond tolerance")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic frames")
+    args = parser.parse_args()
+    if args.check:
+        args.repeats = 1
+    
+    backends = ["numpy"] + (["numba"] if metrics._load_numba_kernel() is not None else [])
+    failed = False
+    
+    print(f"Frame {args.height}x{args.width}, best of {args.repeats} runs")
+    print(f"{'inputs':>8} | {'backend':>10} | {'work dtype':>10} | {'ms/frame':>9} | {'speedup':>7} | {'max rel err':>11}")
+    for input_dtype in (np.float32, np.float64):
+        gt, pred, mask = synthetic_pair(args.height, args.width, input_dtype, args.seed)
+        reference = compute_metrics_reference(gt, pred, mask)
+        reference_ms = time_call(lambda: compute_metrics_reference(gt, pred, mask), args.repeats)
+        print(f"{np.dtype(input_dtype).name:>8} | {'reference':>10} | {'native':>10} | {reference_ms:>9.2f} | {1.0:>7.2f} | {0.0:>11.2e}")
+        
+        for backend in backends:
+            for work_dtype in ("auto", "float32"):
+                configure_metrics(backend, work_dtype)
+                values = compute_metrics(gt, pred, mask)
+                ms = time_call(lambda: compute_metrics(gt, pred, mask), args.repeats)
+                error = max_relative_error(reference, values)
+                single = work_dtype == "float32" or input_dtype == np.float32
+                tolerance = args.float32_tolerance if single else args.tolerance
+                status = "" if error <= tolerance else "  FAIL"
+                failed |= error > tolerance
+                print(f"{np.dtype(input_dtype).name:>8} | {backend:>10} | {work_dtype:>10} | {ms:>9.2f} | "
+                      f"{reference_ms / ms:>7.2f} | {error:>11.2e}{status}")
+    
+    configure_metrics()
+    if failed:
+        print("Fused metric engine deviates from the reference beyond tolerance")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
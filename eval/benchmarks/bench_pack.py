@@ -0,0 +1,126 @@
+"""
+Prediction packs (pred_pack.py) vs the .npy / .pfm folders they were made from
+
+Packs the predictions of a synthetic lunar dataset (see synthetic_dataset.py) with each encoding and
+evaluates the folder and the pack with label and shadow slices in every alignment mode. Reports the
+size on disk, load_depth milliseconds per frame and the largest absolute difference of each metric
+(per-image and pixel-weighted, over all slices), and exits 1 if a difference exceeds --tolerance.
+
+Usage (from the eval directory):
+    python -m benchmarks.bench_pack --frames 16 --height 720 --width 1280 --formats npy pfm
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+from benchmarks.bench_pipeline import LABELS, SHADOW_REGIONS, time_stage
+from benchmarks.synthetic_dataset import generate_dataset
+from eval2results import list_files
+from methods2evaluation import OptimizedDepthPreprocessor
+from metrics import METRIC_NAMES, EvalModel, build_slices, evaluate_models_parallel
+from pred_pack import write_pack
+
+MODES = {
+    "relative": dict(relative_depth=True, disparity=False, absolute_depth=False),
+    "disparity": dict(relative_depth=True, disparity=True, absolute_depth=False),
+    "absolute": dict(relative_depth=False, disparity=False, absolute_depth=True),
+}
+
+
+def preprocessor(fmt, mode):
+    args = argparse.Namespace(resize=False, pfm_flip_rows=fmt == "pfm", max_gt_distance=100, **MODES[mode])
+    return OptimizedDepthPreprocessor(args=args)
+
+
+def evaluate(gt_paths, pred_paths, preprocessor, slices, label_dir, shadow_dir):
+    """{slice name: {metric: value}} of the per-image and the pixel-weighted metrics"""
+    results = evaluate_models_parallel(gt_paths, [EvalModel("pred", pred_paths, None)], preprocessor, slices,
+                                       num_workers=1, shadow_mask_dir=shadow_dir, labeling_path=label_dir,
+                                       progress_interval=0)
+    return {name: (accumulator.image_metrics(), accumulator.pixel_metrics())
+            for (_, name), accumulator in results.items()}
+
+
+def max_differences(reference, other):
+    """Largest absolute difference of each metric over all slices"""
+    differences = dict.fromkeys(METRIC_NAMES, 0.0)
+    for name, metrics in reference.items():
+        for expected, actual in zip(metrics, other[name]):
+            if expected is None:
+                continue
+            for metric in METRIC_NAMES:
+                differences[metric] = max(differences[metric], abs(expected[metric] - actual[metric]))
+    return differences
+
+
+def folder_bytes(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prediction pack benchmark")
+    parser.add_argument("--dataset", type=str,
+                        help="Synthetic dataset directory, generated if it does not exist (default: a temporary one)")
+    parser.add_argument("--frames", type=int, default=16)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--formats", type=str, nargs="+", choices=["npy", "pfm"], default=["npy", "pfm"])
+    parser.add_argument("--encodings", type=str, nargs="+", choices=["log_uint16", "float16"],
+                        default=["log_uint16", "float16"])
+    parser.add_argument("--repeats", type=int, default=3, help="Timing runs, the fastest is reported")
+    parser.add_argument("--tolerance", type=float, default=1e-3,
+                        help="Largest accepted absolute difference of a metric")
+    args = parser.parse_args()
+
+    dataset_dir = args.dataset or tempfile.mkdtemp(prefix="lunar_bench_")
+    pack_dir = tempfile.mkdtemp(prefix="lunar_packs_")
+    slices = build_slices(LABELS, SHADOW_REGIONS)
+    failed = False
+    try:
+        if any(not os.path.isdir(os.path.join(dataset_dir, fmt, "gt")) for fmt in args.formats):
+            print(f"Generating {args.frames} frames of {args.height}x{args.width} in {dataset_dir}")
+            generate_dataset(dataset_dir, args.frames, args.height, args.width, tuple(args.formats))
+        label_dir, shadow_dir = os.path.join(dataset_dir, "label"), os.path.join(dataset_dir, "shadow")
+        for fmt in args.formats:
+            gt_paths = list_files(os.path.join(dataset_dir, fmt, "gt"))
+            pred_dir = os.path.join(dataset_dir, fmt, "pred")
+            sources = {fmt: list_files(pred_dir)}
+            for encoding in args.encodings:
+                pack_path = os.path.join(pack_dir, f"{fmt}_{encoding}.qpred")
+                write_pack(pred_dir, pack_path, encoding)
+                sources[encoding] = list_files(pack_path)
+            loader = preprocessor(fmt, "relative")
+            print(f"\n{fmt}: {len(gt_paths)} frames, {len(slices)} slices")
+            print(f"{'Source':<10} | {'MB':>7} | {'Load ms/frame':>13}")
+            for source, pred_paths in sources.items():
+                paths = pred_paths if source == fmt else [os.path.dirname(pred_paths[0])]
+                load_ms = time_stage(loader.load_depth, pred_paths, args.repeats)
+                print(f"{source:<10} | {folder_bytes(paths) / (1 << 20):>7.1f} | {load_ms:>13.2f}")
+
+            # Largest difference of each metric over the alignment modes and slices
+            differences = {encoding: dict.fromkeys(METRIC_NAMES, 0.0) for encoding in args.encodings}
+            for mode in MODES:
+                mode_preprocessor = preprocessor(fmt, mode)
+                reference = evaluate(gt_paths, sources[fmt], mode_preprocessor, slices, label_dir, shadow_dir)
+                for encoding in args.encodings:
+                    packed = evaluate(gt_paths, sources[encoding], mode_preprocessor, slices, label_dir, shadow_dir)
+                    for metric, difference in max_differences(reference, packed).items():
+                        differences[encoding][metric] = max(differences[encoding][metric], difference)
+            print(f"{'Max |diff|':<10} | " + " | ".join(f"{metric:>8}" for metric in METRIC_NAMES))
+            for encoding, worst in differences.items():
+                print(f"{encoding:<10} | " + " | ".join(f"{worst[metric]:>8.1e}" for metric in METRIC_NAMES))
+                failed |= max(worst.values()) > args.tolerance
+    finally:
+        shutil.rmtree(pack_dir, ignore_errors=True)
+        if not args.dataset:
+            shutil.rmtree(dataset_dir, ignore_errors=True)
+    if failed:
+        print(f"A pack metric differs from its folder by more than {args.tolerance}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
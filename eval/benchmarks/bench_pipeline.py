@@ -0,0 +1,213 @@
+"""
+Stage and end-to-end benchmark of the evaluation pipeline with a regression gate
+
+Times every stage on a synthetic lunar dataset (see synthetic_dataset.py): decoding GT and predictions
+per depth format, resizing, each alignment mode, building the slice masks and the metrics. Then it
+times the full eval2results.py run per format and worker count. Results are written to JSON; with
+--baseline they are compared against a previous JSON and the run fails if any timing regressed
+beyond --threshold.
+
+Usage (from the eval directory):
+    python -m benchmarks.bench_pipeline --output bench.json --save_baseline benchmarks/baseline.json
+    python -m benchmarks.bench_pipeline --output bench.json --baseline benchmarks/baseline.json --threshold 0.25
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from alignment import align_depth_least_square
+from benchmarks.synthetic_dataset import DEPTH_FORMATS, generate_dataset
+from methods2evaluation import OptimizedDepthPreprocessor
+from metrics import build_slice_masks, build_slices, compute_metric_sums
+
+EVAL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ALIGNMENTS = ("relative", "disparity", "absolute")
+LABELS = ("all", "crater", "obstacle")
+SHADOW_REGIONS = ("in", "out")
+DISTANCE_RANGES = ((0.0, 0.5),)
+
+
+def preprocessor_for(fmt, config_info="config_info", max_gt_distance=100):
+    """Preprocessor configured like eval2results.py with --relative_depth for a depth format"""
+    args = argparse.Namespace(relative_depth=True, disparity=False, absolute_depth=False, resize=False,
+                              pfm_flip_rows=fmt == "pfm", max_gt_distance=max_gt_distance)
+    return OptimizedDepthPreprocessor(config_info=config_info, args=args)
+
+
+def time_stage(fn, items, repeats):
+    """Best-of-repeats mean wall time of fn(item) over items, in milliseconds per item"""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        best = min(best, time.perf_counter() - start)
+    return best * 1e3 / len(items)
+
+
+def stage_timings(dataset_dir, formats, repeats, config_info="config_info"):
+    """{stage name: ms per frame}; decoding per format, the array stages on the npy-equivalent frames"""
+    timings = {}
+    label_dir, shadow_dir = os.path.join(dataset_dir, "label"), os.path.join(dataset_dir, "shadow")
+    frames = None
+    for fmt in formats:
+        preprocessor = preprocessor_for(fmt, config_info)
+        gt_paths = sorted(os.path.join(dataset_dir, fmt, "gt", f) for f in os.listdir(os.path.join(dataset_dir, fmt, "gt")))
+        pred_paths = sorted(os.path.join(dataset_dir, fmt, "pred", f) for f in os.listdir(os.path.join(dataset_dir, fmt, "pred")))
+        # np.asarray forces the (lazily memory-mapped) PFM data to be read
+        timings[f"decode_gt/{fmt}"] = time_stage(lambda p: np.asarray(preprocessor.load_gt(p)).sum(), gt_paths, repeats)
+        timings[f"decode_pred/{fmt}"] = time_stage(
+            lambda p: np.asarray(preprocessor.load_depth(p, is_gt=False)).sum(), pred_paths, repeats)
+        if frames is None:
+            frames = [(os.path.basename(pred_path), preprocessor.load_gt(gt_path),
+                       np.squeeze(preprocessor.load_depth(pred_path, is_gt=False)))
+                      for gt_path, pred_path in zip(gt_paths, pred_paths)]
+
+    preprocessor = preprocessor_for(formats[0], config_info)
+    half = [(name, gt, np.ascontiguousarray(pred[::2, ::2])) for name, gt, pred in frames]
+    timings["resize"] = time_stage(lambda f: preprocessor.resize_prediction(f[2], f[1]), half, repeats)
+    for alignment in ALIGNMENTS:
+        timings[f"align/{alignment}"] = time_stage(
+            lambda f: preprocessor.align_prediction(f[2], f[1], alignment), frames, repeats)
+    timings["align/lstsq"] = time_stage(
+        lambda f: align_depth_least_square(f[1], f[2], f[1] > 0, max_resolution=preprocessor.alignment_max_res),
+        frames, repeats)
+
+    slices = build_slices(LABELS, SHADOW_REGIONS, DISTANCE_RANGES)
+    timings["mask"] = time_stage(
+        lambda f: build_slice_masks(f[1], f[0], slices, preprocessor, shadow_dir, label_dir), frames, repeats)
+    aligned = [(gt, preprocessor.align_prediction(pred, gt),
+                build_slice_masks(gt, name, slices, preprocessor, shadow_dir, label_dir))
+               for name, gt, pred in frames]
+    timings["metrics/single"] = time_stage(lambda f: compute_metric_sums(f[0], f[1], verbose=False), aligned, repeats)
+    timings[f"metrics/{len(slices)}_slices"] = time_stage(
+        lambda f: [compute_metric_sums(f[0], f[1], mask, verbose=False) for mask in f[2]], aligned, repeats)
+    return timings
+
+
+def end_to_end_timings(dataset_dir, formats, worker_counts, repeats, num_frames):
+    """{run name: ms per run} and {run name: frames per second} of the full eval2results.py run"""
+    timings, throughput = {}, {}
+    for fmt in formats:
+        for workers in worker_counts:
+            command = [sys.executable, "eval2results.py",
+                       os.path.join(dataset_dir, fmt, "gt"), os.path.join(dataset_dir, fmt, "pred"),
+                       "--relative_depth", "--num_workers", str(workers),
+                       "--labeling", *LABELS, "--labeling_path", os.path.join(dataset_dir, "label"),
+                       "--shadow_mask", os.path.join(dataset_dir, "shadow"), "--shadow_region", *SHADOW_REGIONS]
+            if fmt == "pfm":
+                command.append("--pfm_flip_rows")
+            best = float("inf")
+            for _ in range(repeats):
+                start = time.perf_counter()
+                subprocess.run(command, cwd=EVAL_DIR, check=True, stdout=subprocess.DEVNULL)
+                best = min(best, time.perf_counter() - start)
+            name = f"end_to_end/{fmt}/workers={workers}"
+            timings[name] = best * 1e3
+            throughput[name] = num_frames / best
+    return timings, throughput
+
+
+def compare_to_baseline(timings, baseline, threshold, min_ms):
+    """Rows (name, baseline ms, current ms, ratio, status); a timing regresses if it is more than
+    threshold slower and more than min_ms slower (timer noise on tiny stages)
+    """
+    rows = []
+    for name, current in timings.items():
+        reference = baseline.get(name)
+        if reference is None:
+            rows.append((name, None, current, None, "new"))
+            continue
+        ratio = current / reference if reference > 0 else float("inf")
+        regressed = ratio > 1 + threshold and current - reference > min_ms
+        rows.append((name, reference, current, ratio, "REGRESSION" if regressed else "ok"))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluation pipeline benchmark")
+    parser.add_argument("--dataset", type=str,
+                        help="Synthetic dataset directory, generated if it does not exist (default: a temporary one)")
+    parser.add_argument("--frames", type=int, default=10)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--formats", nargs="+", choices=DEPTH_FORMATS, default=list(DEPTH_FORMATS))
+    parser.add_argument("--num_workers", type=int, nargs="+", default=[1, 2, 4],
+                        help="Worker counts of the end-to-end runs (none: skip them)")
+    parser.add_argument("--repeats", type=int, default=3, help="Best of this many runs per stage")
+    parser.add_argument("--end_to_end_repeats", type=int, default=1)
+    parser.add_argument("--config_info", type=str, default="config_info")
+    parser.add_argument("--output", type=str, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", type=str, help="Compare against the results of this JSON file")
+    parser.add_argument("--save_baseline", type=str, help="Also write the results as a new baseline to this file")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Relative slowdown against the baseline that counts as a regression")
+    parser.add_argument("--min_ms", type=float, default=0.5,
+                        help="Absolute slowdown in ms below which no regression is reported")
+    args = parser.parse_args()
+
+    config = {"frames": args.frames, "height": args.height, "width": args.width, "formats": args.formats,
+              "num_workers": args.num_workers, "config_info": args.config_info}
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["config"] != config:
+            print(f"Baseline {args.baseline} was recorded with {baseline['config']}, this run uses {config}")
+            sys.exit(2)
+
+    dataset_dir = args.dataset or tempfile.mkdtemp(prefix="lunar_bench_")
+    try:
+        if not os.path.isdir(os.path.join(dataset_dir, args.formats[-1], "gt")):
+            print(f"Generating {args.frames} frames of {args.height}x{args.width} in {dataset_dir}")
+            generate_dataset(dataset_dir, args.frames, args.height, args.width, args.formats, args.config_info)
+        timings = stage_timings(dataset_dir, args.formats, args.repeats, args.config_info)
+        end_to_end, throughput = end_to_end_timings(dataset_dir, args.formats, args.num_workers,
+                                                    args.end_to_end_repeats, args.frames)
+        timings.update(end_to_end)
+    finally:
+        if not args.dataset:
+            shutil.rmtree(dataset_dir, ignore_errors=True)
+
+    results = {
+        "config": config,
+        "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                        "platform": platform.platform(), "cpu_count": os.cpu_count()},
+        "timings_ms": timings,
+        "frames_per_second": throughput,
+    }
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {path}")
+
+    name_width = max(len(name) for name in timings)
+    if baseline is None:
+        print(f"{'stage':<{name_width}} | {'ms':>10}")
+        for name, ms in timings.items():
+            print(f"{name:<{name_width}} | {ms:>10.2f}" + (f"   ({throughput[name]:.1f} frames/s)" if name in throughput else ""))
+        return
+
+    rows = compare_to_baseline(timings, baseline["timings_ms"], args.threshold, args.min_ms)
+    print(f"{'stage':<{name_width}} | {'baseline':>10} | {'ms':>10} | {'ratio':>6} | status")
+    for name, reference, current, ratio, status in rows:
+        reference = "-" if reference is None else f"{reference:.2f}"
+        ratio = "-" if ratio is None else f"{ratio:.2f}"
+        print(f"{name:<{name_width}} | {reference:>10} | {current:>10.2f} | {ratio:>6} | {status}")
+    regressions = [row[0] for row in rows if row[4] == "REGRESSION"]
+    if regressions:
+        print(f"{len(regressions)} timing(s) regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
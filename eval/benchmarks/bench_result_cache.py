@@ -0,0 +1,98 @@
+"""
+Result cache (--result_cache) round trip: a warm run must reuse every entry and print the cold run's results
+
+Runs eval2results.py twice per scenario on a synthetic lunar dataset (see synthetic_dataset.py) with a
+fresh cache: label and shadow slices, distance curves with a single bin and with several bins, and a
+shadow sweep. Reports the cold and warm seconds and the entries the warm run reused, and exits 1 if the
+warm run fails, recomputes an entry or prints different results.
+
+Usage (from the eval directory):
+    python -m benchmarks.bench_result_cache --frames 16 --height 720 --width 1280 --num_workers 4
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_pipeline import EVAL_DIR, LABELS, SHADOW_REGIONS
+from benchmarks.synthetic_dataset import generate_dataset
+
+SCENARIOS = {
+    "slices": [],
+    "1 distance bin": ["--distance_bins", "0", "100", "100"],
+    "4 distance bins": ["--distance_bins", "0", "100", "25"],
+    "shadow sweep": ["--shadow_rgb", "{rgb}", "--shadow_sweep", "--shadow_kernel_sizes", "1",
+                     "--distance_bins", "0", "100", "100"],
+}
+
+
+def run_eval(dataset_dir, options, cache_path, num_workers):
+    """(seconds, results, cache summary line) of one eval2results.py run, results None if it failed"""
+    rgb_dir = os.path.join(dataset_dir, "rgb")
+    shadow = (["--shadow_mask", os.path.join(dataset_dir, "shadow")] if "--shadow_rgb" not in options else [])
+    command = [sys.executable, "eval2results.py", os.path.join(dataset_dir, "npy", "gt"),
+               os.path.join(dataset_dir, "npy", "pred"), "--relative_depth", "--num_workers", str(num_workers),
+               "--labeling", *LABELS, "--labeling_path", os.path.join(dataset_dir, "label"),
+               *shadow, "--shadow_region", *SHADOW_REGIONS, "--result_cache", cache_path,
+               "--progress_interval", "1e9", *(option.format(rgb=rgb_dir) for option in options)]
+    start = time.perf_counter()
+    process = subprocess.run(command, cwd=EVAL_DIR, capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if process.returncode != 0 or "Error processing" in process.stdout:
+        print(process.stdout[-2000:] + process.stderr[-2000:])
+        return seconds, None, "-"
+    lines = process.stdout.splitlines()
+    summary = next((line for line in lines if line.startswith("Result cache:")), "-")
+    results = "\n".join(lines[next(i for i, line in enumerate(lines) if line.startswith("Results")):])
+    return seconds, results, summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Result cache round trip benchmark")
+    parser.add_argument("--dataset", type=str,
+                        help="Synthetic dataset directory, generated if it does not exist (default: a temporary one)")
+    parser.add_argument("--frames", type=int, default=16)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--scenarios", type=str, nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    args = parser.parse_args()
+
+    dataset_dir = args.dataset or tempfile.mkdtemp(prefix="lunar_bench_")
+    cache_dir = tempfile.mkdtemp(prefix="lunar_result_cache_")
+    failed = False
+    try:
+        if not os.path.isdir(os.path.join(dataset_dir, "npy", "gt")):
+            print(f"Generating {args.frames} frames of {args.height}x{args.width} in {dataset_dir}")
+            generate_dataset(dataset_dir, args.frames, args.height, args.width, ("npy",))
+        print(f"{'Scenario':<16} | {'Cold s':>7} | {'Warm s':>7} | {'Speedup':>7} | Warm run")
+        for name in args.scenarios:
+            cache_path = os.path.join(cache_dir, f"{name.replace(' ', '_')}.sqlite")
+            cold_seconds, cold, _ = run_eval(dataset_dir, SCENARIOS[name], cache_path, args.num_workers)
+            warm_seconds, warm, summary = run_eval(dataset_dir, SCENARIOS[name], cache_path, args.num_workers)
+            if cold is None or warm is None:
+                status = "FAIL (run failed)"
+            elif warm != cold:
+                status = "FAIL (results differ)"
+            elif " 0 computed" not in summary:
+                status = f"FAIL ({summary})"
+            else:
+                status = summary.split(": ", 1)[1]
+            failed |= status.startswith("FAIL")
+            print(f"{name:<16} | {cold_seconds:>7.2f} | {warm_seconds:>7.2f} | "
+                  f"{cold_seconds / warm_seconds:>7.2f} | {status}")
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        if not args.dataset:
+            shutil.rmtree(dataset_dir, ignore_errors=True)
+    if failed:
+        print("A warm result cache run does not reproduce the cold run")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Resident evaluation server vs a cold eval2results.py run per checkpoint
+
+Starts eval_server.py on a synthetic lunar dataset (see synthetic_dataset.py) with label and shadow
+slices. Each checkpoint is then evaluated three ways: a fresh eval2results.py process, a folder job
+on the server, and a stream job that posts the predictions as arrays. Reports the seconds per
+evaluation of each. Exits 1 if the server's metrics differ from evaluate_models_parallel by more than
+--tolerance; frames finish in a different order, so the sums can differ in the last bit.
+
+Usage (from the eval directory):
+    python -m benchmarks.bench_server --frames 32 --height 720 --width 1280 --checkpoints 3 --num_workers 4
+"""
+
+import argparse
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+
+import numpy as np
+
+from benchmarks.bench_pipeline import EVAL_DIR, LABELS, SHADOW_REGIONS, preprocessor_for
+from benchmarks.synthetic_dataset import generate_dataset
+from eval_server import call, evaluate_arrays, evaluate_folder
+from metrics import EvalModel, build_slices, evaluate_models_parallel
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_server(url, process, timeout=300):
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError("the server exited")
+        try:
+            return call(url, "GET", "/status")
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    raise RuntimeError("the server did not start")
+
+
+def max_relative_difference(reference, results):
+    """Largest relative difference of the metrics and file counts of every slice"""
+    worst = 0.0
+    for name, accumulator in reference.items():
+        entry = results[name]
+        if entry["files"] != accumulator.n_images:
+            return float("inf")
+        metrics = accumulator.metrics()
+        for metric, value in (metrics or {}).items():
+            worst = max(worst, abs(entry["metrics"][metric] - value) / max(abs(value), 1e-12))
+    return worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resident evaluation server benchmark")
+    parser.add_argument("--dataset", type=str,
+                        help="Synthetic dataset directory, generated if it does not exist (default: a temporary one)")
+    parser.add_argument("--frames", type=int, default=32)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--checkpoints", type=int, default=3)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--tolerance", type=float, default=1e-9)
+    args = parser.parse_args()
+
+    dataset_dir = args.dataset or tempfile.mkdtemp(prefix="lunar_bench_")
+    server = None
+    try:
+        if not os.path.isdir(os.path.join(dataset_dir, "npy", "gt")):
+            print(f"Generating {args.frames} frames of {args.height}x{args.width} in {dataset_dir}")
+            generate_dataset(dataset_dir, args.frames, args.height, args.width, ("npy",))
+        gt_dir, pred_dir = os.path.join(dataset_dir, "npy", "gt"), os.path.join(dataset_dir, "npy", "pred")
+        label_dir, shadow_dir = os.path.join(dataset_dir, "label"), os.path.join(dataset_dir, "shadow")
+        names = sorted(os.listdir(gt_dir))
+        options = {"alignment": "relative", "labeling": list(LABELS), "shadow_region": list(SHADOW_REGIONS)}
+
+        reference = evaluate_models_parallel(
+            [os.path.join(gt_dir, name) for name in names],
+            [EvalModel("pred", [os.path.join(pred_dir, name) for name in names], None)],
+            preprocessor_for("npy"), build_slices(LABELS, SHADOW_REGIONS), num_workers=args.num_workers,
+            shadow_mask_dir=shadow_dir, labeling_path=label_dir, progress_interval=0)
+        reference = {name: accumulator for (_, name), accumulator in reference.items()}
+
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        start = time.perf_counter()
+        server = subprocess.Popen([sys.executable, "eval_server.py", "serve", gt_dir, "--labeling_path", label_dir,
+                                   "--shadow_mask", shadow_dir, "--num_workers", str(args.num_workers),
+                                   "--port", str(port)], cwd=EVAL_DIR, stdout=subprocess.DEVNULL)
+        wait_for_server(url, server)
+        startup = time.perf_counter() - start
+
+        cli = [sys.executable, "eval2results.py", gt_dir, pred_dir, "--relative_depth", "--num_workers",
+               str(args.num_workers), "--labeling", *LABELS, "--labeling_path", label_dir,
+               "--shadow_mask", shadow_dir, "--shadow_region", *SHADOW_REGIONS, "--progress_interval", "0"]
+        timings = {"cold eval2results.py": [], "server folder job": [], "server stream job": []}
+        difference = 0.0
+        for _ in range(args.checkpoints):
+            start = time.perf_counter()
+            subprocess.run(cli, cwd=EVAL_DIR, check=True, stdout=subprocess.DEVNULL)
+            timings["cold eval2results.py"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            result = evaluate_folder(url, pred_dir, **options)
+            timings["server folder job"].append(time.perf_counter() - start)
+            difference = max(difference, max_relative_difference(reference, result["results"]))
+
+            predictions = [(name, np.load(os.path.join(pred_dir, name))) for name in names]
+            start = time.perf_counter()
+            result = evaluate_arrays(url, predictions, **options)
+            timings["server stream job"].append(time.perf_counter() - start)
+            difference = max(difference, max_relative_difference(reference, result["results"]))
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        if not args.dataset:
+            shutil.rmtree(dataset_dir, ignore_errors=True)
+
+    print(f"{len(names)} frames, {len(reference)} slices, {args.num_workers} worker(s), "
+          f"server startup {startup:.2f}s (GT, labels and shadow masks packed once)")
+    for name, seconds in timings.items():
+        print(f"{name:<22} | {np.mean(seconds):>7.3f} s per checkpoint | {len(names) / np.mean(seconds):>7.2f} frames/s")
+    print(f"max relative metric difference: {difference:.2e}")
+    if not difference <= args.tolerance:
+        print(f"The server's metrics differ from evaluate_models_parallel by more than {args.tolerance:g}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Cold start benchmark: import time, first frame and peak memory of a fresh evaluation process
+
+Every scenario runs eval2results.py on one frame of a synthetic lunar dataset (see synthetic_dataset.py)
+in a fresh interpreter with --num_workers 1, like a freshly started worker. Reports the import time of
+the evaluation modules, the time of the first frame, the peak RSS and the heavy optional modules the
+process loaded. Exits 1 if a scenario loads a heavy module its formats and modes do not need
+(e.g. torch, or cv2 without --shadow_rgb).
+
+--preload imports modules before the timed imports, e.g. "--preload torch cv2 PIL imageio" shows the
+cost of importing everything eagerly.
+
+Usage (from the eval directory):
+    python -m benchmarks.bench_startup --height 720 --width 1280
+    python -m benchmarks.bench_startup --preload torch
+"""
+
+# Only the standard library at module level: the probe runs in this module and must start clean
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+EVAL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("torch", "cv2", "PIL", "imageio", "numba", "scipy")
+
+
+def scenarios(dataset_dir):
+    """(name, eval2results.py arguments, heavy modules the run may load)"""
+    def folders(fmt):
+        return [os.path.join(dataset_dir, fmt, "gt"), os.path.join(dataset_dir, fmt, "pred")]
+    label, shadow, rgb = (os.path.join(dataset_dir, name) for name in ("label", "shadow", "rgb"))
+    return [
+        ("npy", folders("npy"), ()),
+        ("png", folders("png"), ("PIL",)),
+        ("pfm", folders("pfm") + ["--pfm_flip_rows"], ()),
+        ("npy + labels + shadow masks", folders("npy") + ["--labeling", "crater", "--labeling_path", label,
+                                                          "--shadow_mask", shadow], ("PIL", "imageio")),
+        ("npy + shadow_rgb", folders("npy") + ["--shadow_rgb", rgb], ("cv2",)),
+    ]
+
+
+def probe(arguments, preload):
+    """Run eval2results.py on arguments in this process; returns the timings, peak RSS and heavy modules"""
+    import resource
+
+    for name in preload:
+        importlib.import_module(name)
+    start = time.perf_counter()
+    import eval2results
+    import worker_pool  # noqa: F401 (imported by the workers)
+    imported = time.perf_counter()
+    sys.argv = ["eval2results.py", *arguments, "--relative_depth", "--num_workers", "1", "--progress_interval", "0"]
+    with contextlib.redirect_stdout(io.StringIO()):
+        eval2results.main()
+    finished = time.perf_counter()
+    return {
+        "import_s": imported - start,
+        "first_frame_s": finished - imported,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "heavy_modules": [name for name in HEAVY_MODULES if name in sys.modules],
+    }
+
+
+def run_probe(arguments, preload):
+    """probe() in a fresh interpreter, plus the wall time of the whole process"""
+    command = [sys.executable, "-m", "benchmarks.bench_startup", "--probe", json.dumps(arguments),
+               "--preload", *preload]
+    start = time.perf_counter()
+    output = subprocess.run(command, cwd=EVAL_DIR, check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.splitlines()[-1])
+    result["process_s"] = time.perf_counter() - start
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluation cold start benchmark")
+    parser.add_argument("--dataset", type=str,
+                        help="Synthetic dataset directory, generated if it does not exist (default: a temporary one)")
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--repeats", type=int, default=3, help="Best of this many processes per scenario")
+    parser.add_argument("--preload", nargs="*", default=[], help="Modules imported before the timed imports")
+    parser.add_argument("--probe", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.probe is not None:
+        print(json.dumps(probe(json.loads(args.probe), args.preload)))
+        return
+
+    from benchmarks.synthetic_dataset import generate_dataset
+
+    dataset_dir = args.dataset or tempfile.mkdtemp(prefix="lunar_bench_")
+    unexpected = []
+    try:
+        if not os.path.isdir(os.path.join(dataset_dir, "pfm", "gt")):
+            print(f"Generating 1 frame of {args.height}x{args.width} in {dataset_dir}")
+            generate_dataset(dataset_dir, 1, args.height, args.width)
+        print(f"{'scenario':<28} | {'import s':>8} | {'frame s':>7} | {'process s':>9} | {'peak MB':>7} | heavy modules")
+        for name, arguments, expected in scenarios(dataset_dir):
+            runs = [run_probe(arguments, args.preload) for _ in range(args.repeats)]
+            best = {key: min(run[key] for run in runs) for key in ("import_s", "first_frame_s", "process_s", "peak_rss_mb")}
+            loaded = runs[0]["heavy_modules"]
+            extra = [module for module in loaded if module not in expected and module not in args.preload]
+            unexpected.extend(f"{name}: {module}" for module in extra)
+            print(f"{name:<28} | {best['import_s']:>8.3f} | {best['first_frame_s']:>7.3f} | "
+                  f"{best['process_s']:>9.3f} | {best['peak_rss_mb']:>7.1f} | {', '.join(loaded) or '-'}"
+                  + (f"   (unexpected: {', '.join(extra)})" if extra else ""))
+    finally:
+        if not args.dataset:
+            shutil.rmtree(dataset_dir, ignore_errors=True)
+
+    if unexpected:
+        print(f"Heavy modules loaded without being needed: {'; '.join(unexpected)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
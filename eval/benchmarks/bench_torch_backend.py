@@ -0,0 +1,133 @@
+"""
+NumPy per-frame vs batched torch CPU evaluation (--metrics_backend torch)
+
+Evaluates the frames of a synthetic lunar dataset (see synthetic_dataset.py) on label and shadow
+slices with process_frame and with torch_backend.process_frames_batched, for every alignment mode
+and batch size. Reports frames per second of both and the largest relative difference of the
+metric sums; exits 1 if a difference exceeds --tolerance or the paths disagree on a failed frame.
+With --num_workers, both backends also run through the worker pool (evaluate_models_parallel) with
+that many workers, the torch workers on their default share of the cores (--torch_threads).
+
+Usage (from the eval directory):
+    python -m benchmarks.bench_torch_backend --frames 16 --height 720 --width 1280 --batch_sizes 4 8 16
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.bench_pipeline import LABELS, SHADOW_REGIONS, preprocessor_for
+from benchmarks.synthetic_dataset import generate_dataset
+from metrics import EvalModel, build_slices, evaluate_models_parallel, process_frame
+from torch_backend import process_frames_batched
+
+ALIGNMENTS = ("relative", "disparity", "absolute")
+
+
+def max_relative_difference(reference, batched):
+    """Largest |a - b| / max(|a|, 1) over all sums; inf if only one of the paths produced a result"""
+    worst = 0.0
+    for ref_frame, frame in zip(reference, batched):
+        if (ref_frame is None) != (frame is None):
+            return float("inf")
+        for ref_model, model in zip(ref_frame or [], frame or []):
+            if (ref_model is None) != (model is None):
+                return float("inf")
+            for ref_sums, sums in zip(ref_model or [], model or []):
+                if (ref_sums is None) != (sums is None):
+                    return float("inf")
+                if ref_sums is not None:
+                    ref_sums, sums = np.asarray(ref_sums), np.asarray(sums)
+                    worst = max(worst, float(np.max(np.abs(ref_sums - sums) / np.maximum(np.abs(ref_sums), 1))))
+    return worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NumPy vs batched torch evaluation benchmark")
+    parser.add_argument("--dataset", type=str,
+                        help="Synthetic dataset directory, generated if it does not exist (default: a temporary one)")
+    parser.add_argument("--frames", type=int, default=16)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[4, 8, 16])
+    parser.add_argument("--threads", type=int, help="torch intra-op threads (default: torch's choice)")
+    parser.add_argument("--num_workers", type=int, nargs="+", default=[],
+                        help="Also compare the backends through the worker pool with these worker counts")
+    parser.add_argument("--tolerance", type=float, default=5e-5,
+                        help="Largest accepted relative difference of the metric sums (float32 log differs "
+                             "between NumPy and torch in the last bit, which adds up in the signed log sums)")
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    dataset_dir = args.dataset or tempfile.mkdtemp(prefix="lunar_bench_")
+    try:
+        if not os.path.isdir(os.path.join(dataset_dir, "npy", "gt")):
+            print(f"Generating {args.frames} frames of {args.height}x{args.width} in {dataset_dir}")
+            generate_dataset(dataset_dir, args.frames, args.height, args.width, ("npy",))
+        gt_dir, pred_dir = os.path.join(dataset_dir, "npy", "gt"), os.path.join(dataset_dir, "npy", "pred")
+        frames = [(os.path.join(gt_dir, name), [os.path.join(pred_dir, name)]) for name in sorted(os.listdir(gt_dir))]
+        frames = frames[:args.frames]
+        slices = build_slices(LABELS, SHADOW_REGIONS)
+        preprocessor = preprocessor_for("npy")
+        shadow_dir, label_dir = os.path.join(dataset_dir, "shadow"), os.path.join(dataset_dir, "label")
+
+        print(f"{len(frames)} frames, {len(slices)} slices, {torch.get_num_threads()} torch thread(s)")
+        print(f"{'alignment':<10} | {'batch':>5} | {'numpy fps':>9} | {'torch fps':>9} | {'speedup':>7} | max rel diff")
+        failed = False
+        for alignment in ALIGNMENTS:
+            # Warm up both paths (first torch calls, file system cache)
+            process_frames_batched(frames[:1], [alignment], preprocessor, 100, shadow_dir, label_dir, slices, False)
+            start = time.perf_counter()
+            reference = [process_frame((gt_path, pred_paths, [alignment], preprocessor, 100, shadow_dir, label_dir,
+                                        slices, False, None, None, None, None))
+                         for gt_path, pred_paths in frames]
+            numpy_fps = len(frames) / (time.perf_counter() - start)
+            for batch_size in args.batch_sizes:
+                start = time.perf_counter()
+                batched = []
+                for b in range(0, len(frames), batch_size):
+                    batched.extend(process_frames_batched(frames[b:b + batch_size], [alignment], preprocessor, 100,
+                                                          shadow_dir, label_dir, slices, False))
+                torch_fps = len(frames) / (time.perf_counter() - start)
+                difference = max_relative_difference(reference, batched)
+                failed |= not difference <= args.tolerance
+                print(f"{alignment:<10} | {batch_size:>5} | {numpy_fps:>9.2f} | {torch_fps:>9.2f} | "
+                      f"{torch_fps / numpy_fps:>6.2f}x | {difference:.2e}")
+
+        if args.num_workers:
+            print(f"\nWorker pool, relative alignment, torch batch size {args.batch_sizes[-1]}")
+            print(f"{'workers':>7} | {'numpy fps':>9} | {'torch fps':>9} | {'speedup':>7} | max rel diff")
+        for num_workers in args.num_workers:
+            fps, stats = {}, {}
+            for backend in ("numpy", "torch"):
+                start = time.perf_counter()
+                results = evaluate_models_parallel(
+                    [gt_path for gt_path, _ in frames], [EvalModel("pred", [p[0] for _, p in frames], None)],
+                    preprocessor, slices, num_workers=num_workers, shadow_mask_dir=shadow_dir,
+                    labeling_path=label_dir, metrics_backend=backend, progress_interval=0,
+                    torch_batch_size=args.batch_sizes[-1])
+                fps[backend] = len(frames) / (time.perf_counter() - start)
+                stats[backend] = [results[key].stats for key in sorted(results)]
+            difference = max(float(np.max(np.abs(a - b) / np.maximum(np.abs(a), 1)))
+                             for a, b in zip(stats["numpy"], stats["torch"]))
+            failed |= not difference <= args.tolerance
+            print(f"{num_workers:>7} | {fps['numpy']:>9.2f} | {fps['torch']:>9.2f} | "
+                  f"{fps['torch'] / fps['numpy']:>6.2f}x | {difference:.2e}")
+    finally:
+        if not args.dataset:
+            shutil.rmtree(dataset_dir, ignore_errors=True)
+
+    if failed:
+        print(f"Batched torch results differ from NumPy by more than {args.tolerance:g}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Synthetic lunar depth datasets for benchmarks
+
+A camera above a flat regolith plane with craters, rocks and a mountain ridge on the horizon; the sky
+has no depth. Every frame gets a GT depth, a relative prediction (affine in depth plus noise),
+a label image in the LABEL_COLORS encoding, a grayscale RGB rendering and its dark shadow mask.
+
+Layout (frames are named 000000, 000001, ...):
+    OUT/<format>/gt, OUT/<format>/pred    per depth format: npy, png, pfm
+    OUT/label, OUT/shadow, OUT/rgb        shared png files (rgb as color0_000000.png)
+
+Depth units follow the loaders in methods2evaluation.py: npy GT is normalized to max_depth, png GT is
+stored as uint16 * scale_factor, pfm GT is in meters (rows bottom-up, evaluate with --pfm_flip_rows).
+
+Usage (from the eval directory):
+    python -m benchmarks.synthetic_dataset /tmp/lunar_bench --frames 20 --height 720 --width 1280
+"""
+
+import argparse
+import os
+
+import cv2
+import numpy as np
+
+from generate_dark_mask import dark_masks_from_gray
+from metrics import LABEL_COLORS
+from methods2evaluation import OptimizedDepthPreprocessor
+
+DEPTH_FORMATS = ("npy", "png", "pfm")
+# Far plane of the scene in meters; normalized depth = meters / FAR_DISTANCE
+FAR_DISTANCE = 300.0
+# Depth of the sky in pfm files, removed by the loader's max distance filter
+PFM_SKY_DISTANCE = 1e4
+# Relative predictions in png are stored as uint16 with this factor
+PRED_PNG_SCALE = 10000.0
+
+
+def write_pfm(path, depth):
+    """Write a single channel little endian PFM file (rows bottom-up, as the format specifies)"""
+    depth = np.ascontiguousarray(depth[::-1], dtype="<f4")
+    with open(path, "wb") as f:
+        f.write(f"Pf\n{depth.shape[1]} {depth.shape[0]}\n-1.0\n".encode("latin-1"))
+        f.write(depth.tobytes())
+
+
+def synthetic_frame(height, width, seed=0):
+    """(depth in meters, 0 = sky; label ids; grayscale uint8 rendering) of one lunar scene"""
+    rng = np.random.default_rng(seed)
+    labels = {name: i for i, name in enumerate(LABEL_COLORS, start=1)}
+    rows, cols = np.mgrid[0:height, 0:width].astype(np.float64)
+
+    # Ground plane below the horizon: depth ~ 1 / (row - horizon)
+    horizon = height * rng.uniform(0.25, 0.35)
+    below = np.maximum(rows - horizon, 1.0)
+    depth = np.minimum(1.5 * height / below, FAR_DISTANCE)
+    depth[rows < horizon] = 0
+    label = np.where(rows >= horizon, labels["ground"], 0).astype(np.uint8)
+    intensity = 110 + 25 * rng.standard_normal((height, width))
+
+    # Mountain ridge above the horizon, at the far plane
+    ridge = horizon - height * (0.04 + 0.03 * np.sin(cols / width * rng.uniform(3, 7) + rng.uniform(0, 6)))
+    mountain = (rows >= ridge) & (rows < horizon)
+    depth[mountain] = FAR_DISTANCE * rng.uniform(0.85, 1.0)
+    label[mountain] = labels["mountain"]
+    intensity[mountain] = 140 + 30 * np.sin(cols[mountain] / 17.0)
+
+    # Craters: bowls in the ground whose sun-facing wall is in shadow
+    for _ in range(rng.integers(4, 9)):
+        cy = rng.uniform(horizon + 0.1 * height, height)
+        cx = rng.uniform(0, width)
+        ry = rng.uniform(0.02, 0.06) * height * (cy - horizon) / (height - horizon)
+        rx = ry * rng.uniform(2.0, 3.5)
+        r = np.hypot((rows - cy) / max(ry, 1.0), (cols - cx) / rx)
+        inside = (r < 1) & (label == labels["ground"])
+        depth[inside] *= 1 + 0.02 * (1 - r[inside] ** 2)
+        label[inside] = labels["crater"]
+        intensity[inside & (cols < cx)] *= 0.3
+
+    # Rocks: closer than the ground behind them, casting a shadow away from the sun
+    for _ in range(rng.integers(5, 15)):
+        cy = rng.uniform(horizon + 0.2 * height, height)
+        cx = rng.uniform(0, width)
+        size = rng.uniform(0.01, 0.03) * height * (cy - horizon) / (height - horizon)
+        r = np.hypot(rows - cy, cols - cx) / max(size, 1.0)
+        rock = r < 1
+        depth[rock] = depth[int(min(cy + size, height - 1)), int(cx)]
+        label[rock] = labels["obstacle"]
+        intensity[rock] = 170
+        shadow = (np.abs(rows - cy) < size) & (cols > cx) & (cols < cx + 4 * size) & ~rock
+        intensity[shadow] *= 0.25
+
+    intensity[depth == 0] = 0
+    return depth, label, np.clip(intensity, 0, 255).astype(np.uint8)
+
+
+def relative_prediction(depth_normalized, rng):
+    """Affine-invariant prediction of a normalized depth: scaled, shifted, smoothed and noisy"""
+    pred = 0.5 * depth_normalized + 0.02
+    pred *= 1 + 0.05 * rng.standard_normal(pred.shape)
+    pred = cv2.GaussianBlur(pred.astype(np.float32), (5, 5), 0)
+    pred[depth_normalized == 0] = 0.52
+    return np.clip(pred, 1e-4, None)
+
+
+def label_image(label):
+    """RGB label image in the LABEL_COLORS encoding"""
+    colors = np.zeros((len(LABEL_COLORS) + 1, 3), dtype=np.uint8)
+    colors[1:] = list(LABEL_COLORS.values())
+    return colors[label]
+
+
+def generate_dataset(output_dir, frames=20, height=720, width=1280, formats=DEPTH_FORMATS,
+                     config_info="config_info", seed=0):
+    """Write a synthetic dataset (see module docstring); returns {format: (gt_dir, pred_dir)}"""
+    scale_factor = OptimizedDepthPreprocessor(config_info=config_info).scale_factor
+    folders = {fmt: (os.path.join(output_dir, fmt, "gt"), os.path.join(output_dir, fmt, "pred")) for fmt in formats}
+    shared = {name: os.path.join(output_dir, name) for name in ("label", "shadow", "rgb")}
+    for folder in list(shared.values()) + [f for pair in folders.values() for f in pair]:
+        os.makedirs(folder, exist_ok=True)
+
+    for i in range(frames):
+        name = f"{i:06d}"
+        depth, label, intensity = synthetic_frame(height, width, seed + i)
+        depth_normalized = (depth / FAR_DISTANCE).astype(np.float32)
+        pred = relative_prediction(depth_normalized, np.random.default_rng(seed + i + 1_000_000))
+
+        cv2.imwrite(os.path.join(shared["label"], f"{name}.png"), cv2.cvtColor(label_image(label), cv2.COLOR_RGB2BGR))
+        cv2.imwrite(os.path.join(shared["rgb"], f"color0_{name}.png"), intensity)
+        dark_mask, _ = dark_masks_from_gray(intensity, kernel_sizes=())
+        cv2.imwrite(os.path.join(shared["shadow"], f"{name}.png"), dark_mask)
+
+        for fmt, (gt_dir, pred_dir) in folders.items():
+            if fmt == "npy":
+                np.save(os.path.join(gt_dir, f"{name}.npy"), depth_normalized)
+                np.save(os.path.join(pred_dir, f"{name}.npy"), pred)
+            elif fmt == "png":
+                gt_png = np.round(depth_normalized * scale_factor).astype(np.uint16)
+                cv2.imwrite(os.path.join(gt_dir, f"{name}.png"), gt_png)
+                pred_png = np.round(np.clip(pred * PRED_PNG_SCALE, 0, 65535)).astype(np.uint16)
+                cv2.imwrite(os.path.join(pred_dir, f"{name}.png"), pred_png)
+            elif fmt == "pfm":
+                write_pfm(os.path.join(gt_dir, f"{name}.pfm"), np.where(depth > 0, depth, PFM_SKY_DISTANCE))
+                write_pfm(os.path.join(pred_dir, f"{name}.pfm"), pred * FAR_DISTANCE)
+            else:
+                raise ValueError(f"Unknown depth format '{fmt}', choose from {DEPTH_FORMATS}")
+    return folders
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic lunar depth dataset")
+    parser.add_argument("output_dir")
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--formats", nargs="+", choices=DEPTH_FORMATS, default=list(DEPTH_FORMATS))
+    parser.add_argument("--config_info", type=str, default="config_info")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    folders = generate_dataset(args.output_dir, args.frames, args.height, args.width, args.formats,
+                               args.config_info, args.seed)
+    print(f"Wrote {args.frames} frames of {args.height}x{args.width} in {', '.join(folders)} to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
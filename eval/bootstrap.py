@@ -0,0 +1,144 @@
+"""
+Bootstrap confidence intervals over frames
+
+Every frame's MetricAccumulator statistics are kept per (model, slice), with zeros where a frame has no
+valid pixels in the slice. A resample draws the frames with replacement, i.e. it is a vector of frame
+counts, so the accumulators of a whole chunk of resamples are one matrix product
+counts[resamples, frames] @ stats[frames, columns], and their metrics follow from the summed statistics
+at once. All (model, slice) pairs share the same resampled frames, which makes model differences paired.
+"""
+
+import csv
+
+import numpy as np
+
+from metrics import METRIC_NAMES, NUM_METRICS, NUM_SUMS, MetricAccumulator, metric_values_from_sums
+
+# Pixel sums, image count and per-image metric sums (the squared sums are not needed)
+COLUMNS = NUM_SUMS + 1 + NUM_METRICS
+# Upper bound of the counts matrix (resamples x frames) built at a time
+CHUNK_ENTRIES = 1 << 22
+
+
+class FrameStats:
+    """Per-frame MetricAccumulator statistics of every (model, slice), filled by evaluate_models_parallel"""
+
+    def __init__(self):
+        self.rows = {}
+
+    def add(self, frame, model_name, slice_sums):
+        """Record one model's results on one frame; slice_sums maps slice name to sums (None = no pixels)"""
+        for name, sums in slice_sums.items():
+            if sums is not None:
+                self.rows.setdefault((model_name, name), {})[frame] = \
+                    MetricAccumulator().add_frame(sums).stats[:COLUMNS]
+
+    def matrix(self, keys):
+        """[frames, len(keys) * COLUMNS] statistics over every frame with a result for any key"""
+        frames = sorted(set().union(*(self.rows.get(key, {}) for key in keys)))
+        position = {frame: i for i, frame in enumerate(frames)}
+        stats = np.zeros((len(frames), len(keys), COLUMNS), dtype=np.float64)
+        for k, key in enumerate(keys):
+            for frame, row in self.rows.get(key, {}).items():
+                stats[position[frame], k] = row
+        return stats.reshape(len(frames), -1)
+
+
+def resample_counts(rng, num_frames, num_resamples):
+    """[num_resamples, num_frames] counts of frames drawn with replacement (index matrix -> bincount)"""
+    index = rng.integers(0, num_frames, size=(num_resamples, num_frames), dtype=np.int32)
+    counts = np.empty((num_resamples, num_frames), dtype=np.float64)
+    # One bincount per resample keeps the counted vector in cache
+    for r in range(num_resamples):
+        counts[r] = np.bincount(index[r], minlength=num_frames)
+    return counts
+
+
+def metrics_from_stats(stats, pixel_weighted=False):
+    """Metric values of stacked accumulator statistics [..., COLUMNS]; NaN where nothing was accumulated"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if pixel_weighted:
+            return metric_values_from_sums(stats[..., :NUM_SUMS])
+        return stats[..., NUM_SUMS + 1:COLUMNS] / stats[..., NUM_SUMS, None]
+
+
+def bootstrap_metrics(frame_stats, keys, num_resamples, pixel_weighted=False, seed=0):
+    """[num_resamples, len(keys), NUM_METRICS] metrics of frame resamples shared by all keys"""
+    stats = frame_stats.matrix(keys)
+    num_frames = stats.shape[0]
+    values = np.full((num_resamples, len(keys), NUM_METRICS), np.nan)
+    if num_frames == 0:
+        return values
+    rng = np.random.default_rng(seed)
+    chunk = max(1, CHUNK_ENTRIES // num_frames)
+    for start in range(0, num_resamples, chunk):
+        size = min(chunk, num_resamples - start)
+        resampled = resample_counts(rng, num_frames, size) @ stats
+        values[start:start + size] = metrics_from_stats(resampled.reshape(size, len(keys), COLUMNS), pixel_weighted)
+    return values
+
+
+def percentile_interval(samples, confidence=0.95):
+    """(low, high) percentile interval along the first axis, ignoring empty resamples"""
+    alpha = (1 - confidence) / 2
+    with np.errstate(invalid="ignore"):
+        low, high = np.nanpercentile(samples, [100 * alpha, 100 * (1 - alpha)], axis=0)
+    return low, high
+
+
+def bootstrap_intervals(frame_stats, results, num_resamples, confidence=0.95, pixel_weighted=False,
+                        reference=None, seed=0):
+    """Percentile intervals of every (model, slice) and paired differences against a reference model.
+
+    results maps (model name, slice name) to the full-sample MetricAccumulator (the point estimates).
+    Returns ({(model, slice): (value, low, high)}, {(model, reference, slice): (diff, low, high)}),
+    each entry an array of NUM_METRICS values.
+    """
+    keys = list(results)
+    samples = bootstrap_metrics(frame_stats, keys, num_resamples, pixel_weighted, seed)
+    points = np.array([_point(results[key], pixel_weighted) for key in keys])
+
+    intervals = {}
+    for k, key in enumerate(keys):
+        intervals[key] = (points[k],) + percentile_interval(samples[:, k], confidence)
+
+    differences = {}
+    if reference is not None:
+        index = {key: k for k, key in enumerate(keys)}
+        for (model_name, name), k in index.items():
+            r = index.get((reference, name))
+            if model_name == reference or r is None:
+                continue
+            differences[(model_name, reference, name)] = (points[k] - points[r],) + \
+                percentile_interval(samples[:, k] - samples[:, r], confidence)
+    return intervals, differences
+
+
+def _point(accumulator, pixel_weighted):
+    metrics = accumulator.metrics(pixel_weighted)
+    return np.full(NUM_METRICS, np.nan) if metrics is None else np.array([metrics[m] for m in METRIC_NAMES])
+
+
+def print_interval_table(entry, title, difference=False):
+    """Print a metric x (value, low, high) table; differences whose interval excludes 0 are starred"""
+    value, low, high = entry
+    print(title)
+    width = max(len(m) for m in METRIC_NAMES + ("Metric",))
+    header = f"{'Metric':<{width}} | {'Diff' if difference else 'Value':>8} | {'Low':>8} | {'High':>8}"
+    print(header)
+    print("-" * len(header))
+    for metric, v, lo, hi in zip(METRIC_NAMES, value, low, high):
+        mark = " *" if difference and (lo > 0 or hi < 0) else ""
+        print(f"{metric:<{width}} | {v:>8.4f} | {lo:>8.4f} | {hi:>8.4f}{mark}")
+
+
+def write_intervals(path, intervals, differences, confidence):
+    """Write the intervals and paired differences as csv rows"""
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(("model", "reference", "slice", "metric", "value", "low", "high", "confidence"))
+        rows = [(model_name, "", name, entry) for (model_name, name), entry in intervals.items()]
+        rows += [(model_name, reference, name, entry) for (model_name, reference, name), entry in differences.items()]
+        for model_name, reference, name, (value, low, high) in rows:
+            for metric, v, lo, hi in zip(METRIC_NAMES, value, low, high):
+                writer.writerow([model_name, reference, name, metric, f"{v:.6g}", f"{lo:.6g}", f"{hi:.6g}", confidence])
@@ -0,0 +1,306 @@
+"""
+Packed, memory-mapped evaluation dataset cache
+
+A cache packs a GT folder into chunked .npy files that are memory-mapped at evaluation time:
+    depth_XXXX.npy   float32 [K, H, W]      decoded GT depth (as returned by load_depth)
+    labels_XXXX.npy  uint8   [K, H, W]      class ids (see metrics.LABEL_CLASS_IDS)
+    shadow_XXXX.npy  uint8   [K, H, W/8]    bit-packed shadow masks (non-zero pixels)
+    index.json                              source folders, file stems, shapes, chunk slots and source stats
+
+Frames whose source files changed (mtime or size) are treated as missing and decoded as usual, and so
+are the frames of a GT folder, and the masks of a label / shadow mask folder, other than the ones the
+cache was built from.
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from metrics import label_ids_from_rgb, load_label_image, load_shadow_mask
+from pfm2npy import read_pfm_header
+
+CACHE_VERSION = 2
+INDEX_FILE = "index.json"
+
+
+def _source_stat(path):
+    """(path, size, mtime_ns) of a source file, None if it does not exist"""
+    if path is None or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def _abspath(path):
+    return None if path is None else os.path.abspath(path)
+
+
+def _is_fresh(source):
+    """Whether a recorded source stat still matches the file on disk"""
+    return source is None or _source_stat(source[0]) == source
+
+
+def cache_config(preprocessor, max_distance):
+    """Preprocessing options that change the decoded GT"""
+    args = preprocessor.args
+    return {
+        "scale_factor": preprocessor.scale_factor,
+        "max_gt_distance": max_distance,
+        "pfm_flip_rows": bool(args and getattr(args, "pfm_flip_rows", False)),
+    }
+
+
+class CachedFrame:
+    """One frame of a DatasetCache; arrays are read from the memory-mapped chunks on demand"""
+
+    def __init__(self, cache, entry):
+        self.cache = cache
+        self.entry = entry
+        self.has_labels = entry["labels"] is not None
+        self.has_shadow = entry["shadow"] is not None
+
+    def has_labels_from(self, labeling_path):
+        """Whether the cached class ids were decoded from the label maps of labeling_path"""
+        return self.has_labels and self.cache.source_matches("labeling_path", labeling_path)
+
+    def has_shadow_from(self, shadow_mask_dir):
+        """Whether the cached shadow mask was decoded from the masks of shadow_mask_dir"""
+        return self.has_shadow and self.cache.source_matches("shadow_mask_dir", shadow_mask_dir)
+
+    def depth(self):
+        return self.cache._chunk("depth", self.entry["chunk"])[self.entry["slot"]]
+
+    def class_ids(self):
+        return self.cache._chunk("labels", self.entry["chunk"])[self.entry["slot"]]
+
+    def shadow(self):
+        packed = self.cache._chunk("shadow", self.entry["chunk"])[self.entry["slot"]]
+        return np.unpackbits(packed, axis=-1, count=self.entry["shape"][1]).view(bool)
+
+
+class DatasetCache:
+    """Read access to a cache written by build_cache"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        index_path = os.path.join(cache_dir, INDEX_FILE)
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(f"Dataset cache index not found: {index_path}")
+        with open(index_path, "r") as f:
+            self.index = json.load(f)
+        if self.index.get("version") != CACHE_VERSION:
+            raise ValueError(f"Unsupported dataset cache version in {cache_dir}, rebuild it with build-cache")
+        self._chunks = {}
+        self._fresh = {}
+        # {(index key, folder): whether the cache was built from that folder}
+        self._sources = {}
+
+    def __getstate__(self):
+        # Only the path travels to worker processes, memory maps are reopened there
+        return {"cache_dir": self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state["cache_dir"])
+
+    @property
+    def config(self):
+        return self.index["config"]
+
+    def _chunk(self, kind, chunk):
+        key = (kind, chunk)
+        if key not in self._chunks:
+            path = os.path.join(self.cache_dir, f"{kind}_{chunk:04d}.npy")
+            self._chunks[key] = np.load(path, mmap_mode="r")
+        return self._chunks[key]
+
+    def source_matches(self, key, folder):
+        """Whether the cache was built from folder ("gt_folder", "labeling_path" or "shadow_mask_dir");
+        warns once per folder if it was not
+        """
+        if folder is None:
+            return False
+        match = self._sources.get((key, folder))
+        if match is None:
+            match = self._sources[(key, folder)] = self.index.get(key) == _abspath(folder)
+            if not match:
+                print(f"Warning: dataset cache {self.cache_dir} was built from {key} {self.index.get(key)}, "
+                      f"not {_abspath(folder)}; decoding from source")
+        return match
+
+    def lookup(self, gt_path):
+        """CachedFrame of a GT file, None if it is not cached, comes from another GT folder or one of its
+        sources changed
+        """
+        if not self.source_matches("gt_folder", os.path.dirname(gt_path) or "."):
+            return None
+        stem = os.path.splitext(os.path.basename(gt_path))[0]
+        entry = self.index["frames"].get(stem)
+        if entry is None:
+            return None
+        if stem not in self._fresh:
+            self._fresh[stem] = all(_is_fresh(entry[kind]) for kind in ("gt", "labels", "shadow"))
+            if not self._fresh[stem]:
+                print(f"Warning: dataset cache entry for {stem} is stale, decoding from source")
+        return CachedFrame(self, entry) if self._fresh[stem] else None
+
+    def is_up_to_date(self, gt_folder, gt_paths, config, labeling_path=None, shadow_mask_dir=None):
+        """Whether the cache holds exactly these GT files, built with this config and mask folders"""
+        stems = [os.path.splitext(os.path.basename(p))[0] for p in gt_paths]
+        return (self.config == config
+                and self.index.get("gt_folder") == _abspath(gt_folder)
+                and self.index.get("labeling_path") == _abspath(labeling_path)
+                and self.index.get("shadow_mask_dir") == _abspath(shadow_mask_dir)
+                and sorted(stems) == sorted(self.index["frames"])
+                and all(self.lookup(p) is not None for p in gt_paths))
+
+
+def _pack_frame(task):
+    """Decode one GT frame with its label map and shadow mask into its chunk slot"""
+    cache_dir, gt_path, chunk, slot, preprocessor, max_distance, labeling_path, shadow_mask_dir = task
+    gt_file = os.path.basename(gt_path)
+
+    depth = np.squeeze(preprocessor.load_depth(gt_path, max_distance=max_distance, is_gt=True))
+    np.load(os.path.join(cache_dir, f"depth_{chunk:04d}.npy"), mmap_mode="r+")[slot] = depth
+
+    labels = None
+    if labeling_path:
+        labeling_img = load_label_image(gt_file, labeling_path)
+        if labeling_img is not None:
+            np.load(os.path.join(cache_dir, f"labels_{chunk:04d}.npy"), mmap_mode="r+")[slot] = \
+                label_ids_from_rgb(labeling_img)
+            labels = _source_stat(os.path.join(labeling_path, f"{os.path.splitext(gt_file)[0]}.png"))
+
+    shadow = None
+    if shadow_mask_dir:
+        shadow_mask = load_shadow_mask(gt_file, shadow_mask_dir)
+        if shadow_mask is not None:
+            np.load(os.path.join(cache_dir, f"shadow_{chunk:04d}.npy"), mmap_mode="r+")[slot] = \
+                np.packbits(shadow_mask, axis=-1)
+            shadow = _source_stat(os.path.join(shadow_mask_dir, f"{os.path.splitext(gt_file)[0]}.png"))
+
+    return {"gt": _source_stat(gt_path), "labels": labels, "shadow": shadow}
+
+
+def _frame_shape(gt_path):
+    """(H, W) of a GT file, read from its header only"""
+    if gt_path.endswith(".npy"):
+        shape = np.load(gt_path, mmap_mode="r").shape
+    elif gt_path.endswith(".png"):
+        from PIL import Image
+        with Image.open(gt_path) as img:
+            shape = (img.height, img.width)
+    elif gt_path.endswith(".pfm"):
+        with open(gt_path, "rb") as pfm_file:
+            shape = read_pfm_header(pfm_file)[0]
+    else:
+        raise ValueError(f"Unsupported GT file: {gt_path}")
+    return [dim for dim in shape if dim != 1][:2]
+
+
+def build_cache(gt_folder, cache_dir, preprocessor, max_distance=100, labeling_path=None,
+                shadow_mask_dir=None, chunk_size=256, num_workers=4, force=False):
+    """Pack a GT folder (and optionally its label maps and shadow masks) into a dataset cache"""
+    gt_files = sorted(os.listdir(gt_folder))
+    gt_paths = [os.path.join(gt_folder, f) for f in gt_files]
+    config = cache_config(preprocessor, max_distance)
+
+    if not force and os.path.exists(os.path.join(cache_dir, INDEX_FILE)):
+        try:
+            if DatasetCache(cache_dir).is_up_to_date(gt_folder, gt_paths, config, labeling_path, shadow_mask_dir):
+                print(f"Dataset cache {cache_dir} is up to date")
+                return
+        except ValueError:
+            pass
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for name in os.listdir(cache_dir):
+        if name.endswith(".npy") or name == INDEX_FILE:
+            os.remove(os.path.join(cache_dir, name))
+
+    # Frames are packed into chunks of identical shape
+    chunks = []
+    slots = []
+    for gt_path in gt_paths:
+        shape = _frame_shape(gt_path)
+        if not chunks or chunks[-1]["count"] == chunk_size or chunks[-1]["shape"] != shape:
+            chunks.append({"shape": shape, "count": 0})
+        slots.append((len(chunks) - 1, chunks[-1]["count"]))
+        chunks[-1]["count"] += 1
+
+    for chunk, info in enumerate(chunks):
+        height, width = info["shape"]
+        count = info["count"]
+        np.lib.format.open_memmap(os.path.join(cache_dir, f"depth_{chunk:04d}.npy"), mode="w+",
+                                  dtype=np.float32, shape=(count, height, width))
+        if labeling_path:
+            np.lib.format.open_memmap(os.path.join(cache_dir, f"labels_{chunk:04d}.npy"), mode="w+",
+                                      dtype=np.uint8, shape=(count, height, width))
+        if shadow_mask_dir:
+            np.lib.format.open_memmap(os.path.join(cache_dir, f"shadow_{chunk:04d}.npy"), mode="w+",
+                                      dtype=np.uint8, shape=(count, height, (width + 7) // 8))
+
+    tasks = [(cache_dir, gt_path, chunk, slot, preprocessor, max_distance, labeling_path, shadow_mask_dir)
+             for gt_path, (chunk, slot) in zip(gt_paths, slots)]
+    print(f"Packing {len(tasks)} frames into {len(chunks)} chunks with {num_workers} workers...")
+    if num_workers == 1:
+        sources = list(map(_pack_frame, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            sources = list(executor.map(_pack_frame, tasks, chunksize=max(1, len(tasks) // (num_workers * 8))))
+
+    frames = {}
+    for gt_file, (chunk, slot), source in zip(gt_files, slots, sources):
+        frames[os.path.splitext(gt_file)[0]] = dict(
+            chunk=chunk, slot=slot, shape=chunks[chunk]["shape"], **source)
+
+    index = {
+        "version": CACHE_VERSION,
+        "config": config,
+        "gt_folder": _abspath(gt_folder),
+        "labeling_path": _abspath(labeling_path),
+        "shadow_mask_dir": _abspath(shadow_mask_dir),
+        "chunks": chunks,
+        "frames": frames,
+    }
+    # Written last so an interrupted build never leaves a valid-looking index behind
+    with open(os.path.join(cache_dir, INDEX_FILE), "w") as f:
+        json.dump(index, f)
+    print(f"Dataset cache written to {cache_dir}")
+
+
+def main():
+    from methods2evaluation import OptimizedDepthPreprocessor
+
+    parser = argparse.ArgumentParser(description="Evaluation dataset cache")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build-cache", help="Pack GT depth, label maps and shadow masks")
+    build.add_argument("gt_folder")
+    build.add_argument("cache_dir")
+    build.add_argument("--labeling_path", type=str, help="Directory containing the label png files")
+    build.add_argument("--shadow_mask", type=str, help="Directory containing the shadow mask png files")
+    build.add_argument("--config_info", type=str, default="config_info")
+    build.add_argument("--max_gt_distance", type=int, default=100)
+    build.add_argument("--pfm_flip_rows", action="store_true")
+    build.add_argument("--chunk_size", type=int, default=256, help="Frames per memory-mapped chunk")
+    build.add_argument("--num_workers", type=int, default=4)
+    build.add_argument("--force", action="store_true", help="Rebuild even if the cache is up to date")
+
+    args = parser.parse_args()
+
+    if args.command == "build-cache":
+        preprocessor = OptimizedDepthPreprocessor(config_info=args.config_info, args=args)
+        build_cache(args.gt_folder, args.cache_dir, preprocessor,
+                    max_distance=args.max_gt_distance,
+                    labeling_path=args.labeling_path,
+                    shadow_mask_dir=args.shadow_mask,
+                    chunk_size=args.chunk_size,
+                    num_workers=args.num_workers,
+                    force=args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,295 @@
 import os
 import argparse
+import csv
+import time
 import numpy as np
 
-from metrics import compute_metrics_parallel
-from methods2evaluation import OptimizedDepthPreprocessor
+from metrics import (METRIC_NAMES, METRICS_BACKENDS, METRICS_DTYPES, SHADOW_REGIONS, SWEEP_THRESHOLDS,
+                     DistanceBins, EvalModel, build_slices, evaluate_models_parallel, slice_name)
+from methods2evaluation import ALIGNMENT_MODES, OptimizedDepthPreprocessor
+from frame_metrics import FrameMetricsLog, print_worst_frames
+from bootstrap import FrameStats, bootstrap_intervals, print_interval_table, write_intervals
+from sampling import PixelSample, sample_frames, standard_errors
+import profiling
+from result_cache import DEFAULT_MAX_MB, ResultCache, result_cache_config
+from pred_pack import is_pack, open_pack
+from shards import file_list_digest, parse_shard, run_config, shard_file_lists, write_partial
 
 
 def args_parser():
     parser = argparse.ArgumentParser(description="Depth evaluation")
     parser.add_argument("gt_folder")
-    parser.add_argument("preds_folder")
+    parser.add_argument("preds_folder", nargs="?")
+    parser.add_argument("--model", nargs=3, action="append", default=[], metavar=("NAME", "PATH", "MODE"),
+                        help=f"Additional prediction folder evaluated in the same pass, MODE is one of {ALIGNMENT_MODES}")
     parser.add_argument("--config_info", type=str, default="config_info")
     parser.add_argument("--absolute_depth", action="store_true")
     parser.add_argument("--relative_depth", action="store_true")
     parser.add_argument("--disparity", action="store_true")
     parser.add_argument("--resize", action="store_true")
+    parser.add_argument("--global_alignment", action="store_true",
+                        help="Fit one scale/shift (or median scale) over the whole sequence in a first pass instead of per frame")
     parser.add_argument("--max_gt_distance", type=int, default=100)
+    parser.add_argument("--gt_cache", type=str,
+                        help="Dataset cache built with `dataset_cache.py build-cache` (GT depth, labels, shadow masks)")
+    parser.add_argument("--result_cache", type=str,
+                        help="SQLite file caching per-frame results; reruns only evaluate new or changed frames")
+    parser.add_argument("--result_cache_size", type=int, default=DEFAULT_MAX_MB,
+                        help="Size budget of the result cache in MB, least recently used entries are evicted")
+    parser.add_argument("--pfm_flip_rows", action="store_true",
+                        help="Flip the bottom-up rows of .pfm files to top-down")
     parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--io_threads", type=int, default=0,
+                        help="Threads per worker decoding the files of the next frames while a frame is evaluated (0 = off)")
+    parser.add_argument("--io_readahead", type=int, default=4,
+                        help="Frames per worker decoded ahead with --io_threads")
+    parser.add_argument("--shard", type=parse_shard, metavar="I/N",
+                        help="Evaluate every N-th frame starting at frame I (0 <= I < N), for runs split across machines")
+    parser.add_argument("--shard_output", type=str,
+                        help="Write the mergeable statistics of this run to a JSON file (see `shards.py merge`)")
+    parser.add_argument("--metrics_backend", type=str, choices=METRICS_BACKENDS, default="numpy",
+                        help="Metric kernel: chunked numpy, numba (if installed), auto, or torch (batched frames on CPU)")
+    parser.add_argument("--torch_batch_size", type=int, default=8,
+                        help="Frames a worker aligns and evaluates together with --metrics_backend torch")
+    parser.add_argument("--torch_threads", type=int,
+                        help="torch intra-op threads per worker with --metrics_backend torch "
+                             "(default: CPU cores / --num_workers)")
+    parser.add_argument("--sample_fraction", type=float,
+                        help="Fast preview: evaluate a stratified sample of this fraction of the valid pixels per frame")
+    parser.add_argument("--max_pixels_per_frame", type=int,
+                        help="Fast preview: evaluate at most this many sampled pixels per frame")
+    parser.add_argument("--sample_frames", type=float,
+                        help="Fast preview: evaluate a random fraction of the frames")
+    parser.add_argument("--sample_seed", type=int, default=0)
+    parser.add_argument("--metrics_dtype", type=str, choices=METRICS_DTYPES, default="auto",
+                        help="Working precision of the metric kernel, 'auto' follows the inputs (sums are always accumulated in float64)")
+    parser.add_argument("--progress_interval", type=float, default=5.0,
+                        help="Seconds between throughput reports, 0 disables them")
+    parser.add_argument("--pixel_weighted", action="store_true",
+                        help="Report metrics over all valid pixels instead of averaging per-image metrics")
+    parser.add_argument("--frame_metrics", type=str, nargs="+",
+                        help="Stream every frame's metrics to these files (.csv and/or .npy with a .json index)")
+    parser.add_argument("--worst_k", type=int, default=10,
+                        help="Number of worst frames per metric reported with --frame_metrics (0 disables)")
+    
+    parser.add_argument("--bootstrap", type=int, default=0, metavar="N",
+                        help="Percentile confidence intervals of every metric from N frame resamples (e.g. 1000)")
+    parser.add_argument("--confidence", type=float, default=0.95, help="Confidence level of --bootstrap intervals")
+    parser.add_argument("--bootstrap_reference", type=str,
+                        help="Model the paired --bootstrap differences are taken against (default: the first model)")
+    parser.add_argument("--bootstrap_seed", type=int, default=0, help="Random seed of --bootstrap")
+    parser.add_argument("--bootstrap_csv", type=str, help="Write the --bootstrap intervals to this csv file")
+    
+    parser.add_argument("--profile", action="store_true",
+                        help="Time every pipeline stage in the workers and print totals, percentiles and throughput")
+    parser.add_argument("--profile_trace", type=str,
+                        help="Write the profiled stages as a Chrome trace-event JSON file (implies --profile)")
     
     # Shadow mask and labeling features
     parser.add_argument("--shadow_mask", type=str, help="Path to shadow mask directory (png format), file names must be correlated with pred and gt file names")
-    parser.add_argument("--labeling", type=str, help="Type of labeling to apply (e.g., obstacle, crater, mountain, ground)")
+    parser.add_argument("--shadow_rgb", type=str,
+                        help="RGB image folder to compute the dark masks from on the fly (instead of --shadow_mask files)")
+    parser.add_argument("--shadow_threshold", type=int, default=50, help="Dark threshold 0-255 for --shadow_rgb")
+    parser.add_argument("--shadow_kernel_sizes", type=int, nargs="+", default=[3, 5, 7, 9],
+                        help="Opening kernel sizes for --shadow_rgb, every size is a separate shadow slice")
+    parser.add_argument("--shadow_sweep", action="store_true",
+                        help="Evaluate inside/outside the --shadow_rgb dark masks at every threshold 0-255 in one pass, "
+                             "for every --shadow_kernel_sizes (1 = no opening)")
+    parser.add_argument("--shadow_sweep_step", type=int, default=16,
+                        help="Threshold step of the printed --shadow_sweep tables (--shadow_threshold is always shown)")
+    parser.add_argument("--shadow_sweep_csv", type=str, help="Write every --shadow_sweep threshold to this csv file")
+    parser.add_argument("--shadow_region", type=str, nargs="+", choices=SHADOW_REGIONS, default=["in"],
+                        help="Shadow mask region(s) to evaluate: 'in' keeps non-zero mask pixels, 'out' keeps zero pixels")
+    parser.add_argument("--labeling", type=str, nargs="+",
+                        help="Type(s) of labeling to apply (e.g., obstacle, crater, mountain, ground, all)")
     parser.add_argument("--labeling_path", type=str, help="Directory containing the label png files for evaluation")
     
     # Distance range filtering
-    parser.add_argument("--distance_range", type=str, 
-                       help="Distance range for evaluation (e.g., '30-60' for 30-60 meters, '100' for 0-100 meters).")
+    parser.add_argument("--distance_range", type=str, nargs="+",
+                       help="Distance range(s) for evaluation (e.g., '30-60' for 30-60 meters, '100' for 0-100 meters).")
+    parser.add_argument("--distance_bins", type=float, nargs=3, metavar=("MIN", "MAX", "STEP"),
+                        help="Error-vs-distance curve over GT depth bins of width STEP (e.g. 0 100 1), for every model and slice")
+    parser.add_argument("--distance_curve_csv", type=str, help="Write the distance curves to this csv file")
+    
+    args = parser.parse_args()
+    if args.distance_bins and not (args.distance_bins[2] > 0 and args.distance_bins[1] > args.distance_bins[0]):
+        parser.error("--distance_bins needs MIN < MAX and STEP > 0")
+    if args.shadow_mask and args.shadow_rgb:
+        parser.error("use either --shadow_mask or --shadow_rgb")
+    if args.shadow_sweep and not args.shadow_rgb:
+        parser.error("--shadow_sweep needs --shadow_rgb")
+    if not 0 <= args.shadow_threshold <= 255:
+        parser.error("--shadow_threshold must be in 0-255")
+    if args.bootstrap < 0 or not 0 < args.confidence < 1:
+        parser.error("--bootstrap needs N >= 0 and 0 < --confidence < 1")
+    if args.io_threads < 0 or args.io_readahead < 1:
+        parser.error("--io_threads must be at least 0 and --io_readahead at least 1")
+    if args.torch_batch_size < 1:
+        parser.error("--torch_batch_size must be at least 1")
+    if args.torch_threads is not None and args.torch_threads < 1:
+        parser.error("--torch_threads must be at least 1")
+    for option in ("sample_fraction", "sample_frames"):
+        value = getattr(args, option)
+        if value is not None and not 0 < value <= 1:
+            parser.error(f"--{option} must be in (0, 1]")
+    if args.max_pixels_per_frame is not None and args.max_pixels_per_frame < 1:
+        parser.error("--max_pixels_per_frame must be at least 1")
+    if args.sample_fraction or args.max_pixels_per_frame:
+        if args.result_cache or args.distance_bins or args.shadow_sweep or args.metrics_backend == "torch":
+            parser.error("pixel sampling cannot be combined with --result_cache, --distance_bins, --shadow_sweep "
+                         "or --metrics_backend torch")
+    if args.shard and not args.shard_output:
+        parser.error("--shard needs --shard_output")
+    if args.shard_output and (args.global_alignment or args.bootstrap or args.sample_fraction
+                              or args.max_pixels_per_frame or args.sample_frames):
+        parser.error("--shard_output cannot be combined with --global_alignment, --bootstrap or the preview options")
+    if not args.preds_folder and not args.model:
+        parser.error("a preds_folder or at least one --model is required")
+    names = [os.path.basename(os.path.normpath(args.preds_folder))] if args.preds_folder else []
+    for name, path, mode in args.model:
+        if mode not in ALIGNMENT_MODES:
+            parser.error(f"invalid alignment mode '{mode}' for model {name}, choose from {ALIGNMENT_MODES}")
+        # Results are keyed by model name, models sharing one would be merged into one row
+        if name in names:
+            parser.error(f"duplicate model name '{name}'")
+        names.append(name)
+    return args
+
+
+def list_files(folder):
+    """Sorted file paths of a folder (GT and predictions are paired by sorted order), or the frames of a
+    prediction pack (see pred_pack.py)
+    """
+    if is_pack(folder):
+        return [os.path.join(folder, stem) for stem in open_pack(folder).stems()]
+    return [os.path.join(folder, f) for f in sorted(os.listdir(folder))]
+
+
+def format_slice_table(slice_results, pixel_weighted=False, title="Slice", errors=None):
+    """The (model / slice) x metric table as text, with a row of standard errors under every entry of errors"""
+    name_width = max(len(name) for name in list(slice_results) + [title])
+    header = f"{title:<{name_width}} | {'Files':>6} | " + " | ".join(f"{m:>8}" for m in METRIC_NAMES)
+    lines = [header, "-" * len(header)]
+    for name, accumulator in slice_results.items():
+        metrics = accumulator.metrics(pixel_weighted)
+        count = accumulator.n_images
+        if metrics is None:
+            values = " | ".join(f"{'-':>8}" for _ in METRIC_NAMES)
+        else:
+            values = " | ".join(f"{metrics[m]:>8.4f}" for m in METRIC_NAMES)
+        lines.append(f"{name:<{name_width}} | {count:>6} | {values}")
+        if errors and errors.get(name):
+            lines.append(f"{'':<{name_width}} | {'':>6} | " + " | ".join(f"±{errors[name][m]:>7.4f}" for m in METRIC_NAMES))
+    return "\n".join(lines)
+
+
+def print_slice_table(slice_results, pixel_weighted=False, title="Slice", errors=None):
+    """Print the (model / slice) x metric table, with a row of standard errors under every entry of errors"""
+    print(format_slice_table(slice_results, pixel_weighted, title, errors))
+
+
+def write_distance_curves(path, distance_curves, pixel_weighted=False):
+    """Write every (model, slice) distance curve as csv rows"""
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(("model", "slice", "bin_min", "bin_max", "files", "n_pixels") + METRIC_NAMES)
+        for (model_name, name), curve in distance_curves.items():
+            for lo, hi, accumulator in zip(curve.edges[:-1], curve.edges[1:], curve.accumulators().values()):
+                metrics = accumulator.metrics(pixel_weighted)
+                values = [""] * len(METRIC_NAMES) if metrics is None else [f"{metrics[m]:.6g}" for m in METRIC_NAMES]
+                writer.writerow([model_name, name, f"{lo:g}", f"{hi:g}", accumulator.n_images,
+                                 accumulator.n_pixels] + values)
+
+
+def write_shadow_sweep(path, shadow_sweep_curves, pixel_weighted=False):
+    """Write every (model, slice, kernel) shadow sweep as csv rows, one per threshold and region"""
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(("model", "slice", "kernel", "threshold", "region", "files", "n_pixels") + METRIC_NAMES)
+        for (model_name, name, kernel), curve in shadow_sweep_curves.items():
+            for threshold in range(SWEEP_THRESHOLDS):
+                for region in curve.REGIONS:
+                    accumulator = curve.accumulator(threshold, region)
+                    metrics = accumulator.metrics(pixel_weighted)
+                    values = [""] * len(METRIC_NAMES) if metrics is None else [f"{metrics[m]:.6g}" for m in METRIC_NAMES]
+                    writer.writerow([model_name, name, kernel, threshold, region, accumulator.n_images,
+                                     accumulator.n_pixels] + values)
+
+
+def print_curves(args, distance_curves, shadow_sweep_curves):
+    """Print (and optionally write) the distance curves and the shadow sweep tables"""
+    weighting = "pixel-weighted" if args.pixel_weighted else "image-averaged"
+    for (model_name, name), curve in distance_curves.items():
+        print(f"\nDistance curve ({model_name} | {name}, {weighting}):")
+        print_slice_table(curve.accumulators(), args.pixel_weighted, "Distance")
+    if args.distance_curve_csv and distance_curves:
+        write_distance_curves(args.distance_curve_csv, distance_curves, args.pixel_weighted)
+        print(f"Distance curves written to {args.distance_curve_csv}")
     
-    return parser.parse_args()
+    thresholds = sorted(set(range(0, SWEEP_THRESHOLDS, args.shadow_sweep_step)) | {args.shadow_threshold})
+    for (model_name, name, kernel), curve in shadow_sweep_curves.items():
+        print(f"\nShadow sweep ({model_name} | {name}, kernel {kernel}, dark = intensity < t, {weighting}):")
+        rows = {f"t={t} | {region}": curve.accumulator(t, region) for t in thresholds for region in curve.REGIONS}
+        print_slice_table(rows, args.pixel_weighted, "Threshold")
+    if args.shadow_sweep_csv and shadow_sweep_curves:
+        write_shadow_sweep(args.shadow_sweep_csv, shadow_sweep_curves, args.pixel_weighted)
+        print(f"Shadow sweep written to {args.shadow_sweep_csv}")
+
+
+def report_bootstrap(args, results, frame_stats, reference):
+    """Print (and optionally write) the bootstrap intervals and the paired differences against reference"""
+    intervals, differences = bootstrap_intervals(frame_stats, results, args.bootstrap, args.confidence,
+                                                 args.pixel_weighted, reference, args.bootstrap_seed)
+    weighting = "pixel-weighted" if args.pixel_weighted else "image-averaged"
+    level = f"{args.confidence:.0%}"
+    for (model_name, name), entry in intervals.items():
+        print_interval_table(entry, f"\nBootstrap {level} interval ({model_name} | {name}, "
+                                    f"{args.bootstrap} resamples, {weighting}):")
+    for (model_name, reference, name), entry in differences.items():
+        print_interval_table(entry, f"\nPaired difference {model_name} - {reference} ({name}, {level} interval, "
+                                    f"* = excludes 0):", difference=True)
+    if args.bootstrap_csv:
+        write_intervals(args.bootstrap_csv, intervals, differences, args.confidence)
+        print(f"Bootstrap intervals written to {args.bootstrap_csv}")
+
+
+def print_results(args, results, models, slices, frame_log=None, errors=None):
+    """Print the results table (or the single result) and the worst frames; False if nothing was evaluated.
+    
+    errors maps (model name, slice name) to the standard errors of a sampled run.
+    """
+    weighting = "pixel-weighted" if args.pixel_weighted else "image-averaged"
+    errors = errors or {}
+    if len(results) > 1:
+        if len(models) == 1:
+            row_name, title = lambda model_name, name: name, "Slice"
+        elif len(slices) == 1:
+            row_name, title = lambda model_name, name: model_name, "Model"
+        else:
+            row_name, title = lambda model_name, name: f"{model_name} | {name}", "Model | Slice"
+        rows = {row_name(*key): acc for key, acc in results.items()}
+        print(f"\nResults ({len(models)} model(s), {len(slices)} slice(s), {weighting}):")
+        print_slice_table(rows, args.pixel_weighted, title, {row_name(*key): se for key, se in errors.items()})
+        if frame_log is not None:
+            for model_name, name in results:
+                print_worst_frames(frame_log, model_name, name, f" ({model_name} | {name})")
+        return True
+    
+    accumulator = next(iter(results.values()))
+    metrics, count = accumulator.metrics(args.pixel_weighted), accumulator.n_images
+    if metrics is None:
+        print("No valid results!")
+        return False
+    
+    # Print results
+    print(f"\nResults ({count} valid files{', pixel-weighted' if args.pixel_weighted else ''}):")
+    error = errors.get(next(iter(results)))
+    for metric_name, value in metrics.items():
+        print(f"{metric_name}: {value:.4f}" + (f" ± {error[metric_name]:.4f}" if error else ""))
+    if frame_log is not None:
+        model_name, name = next(iter(results))
+        print_worst_frames(frame_log, model_name, name, "")
+    return True
 
 
 def main():
@@ -37,41 +299,133 @@ def main():
     preprocessor = OptimizedDepthPreprocessor(config_info=args.config_info, args=args)
     
     # Get file lists
-    gt_files = sorted(os.listdir(args.gt_folder))
-    pred_files = sorted(os.listdir(args.preds_folder))
+    gt_paths = list_files(args.gt_folder)
+    models = []
+    if args.preds_folder:
+        models.append(EvalModel(os.path.basename(os.path.normpath(args.preds_folder)),
+                                list_files(args.preds_folder), None))
+    for name, path, mode in args.model:
+        models.append(EvalModel(name, list_files(path), mode))
+    
+    frames_total = min([len(gt_paths)] + [len(model.pred_paths) for model in models])
+    files = file_list_digest(gt_paths, models)
+    if args.shard:
+        gt_paths, models = shard_file_lists(gt_paths, models, *args.shard)
+        print(f"Shard {args.shard[0]}/{args.shard[1]}: evaluating {len(gt_paths)} of {frames_total} frames")
+    if args.sample_frames:
+        frames = sample_frames(frames_total, args.sample_frames, args.sample_seed)
+        gt_paths = [gt_paths[i] for i in frames]
+        models = [model._replace(pred_paths=[model.pred_paths[i] for i in frames]) for model in models]
+        print(f"Preview: evaluating {len(frames)} of {frames_total} frames")
+    sample = None
+    if args.sample_fraction or args.max_pixels_per_frame:
+        sample = PixelSample(args.sample_fraction, args.max_pixels_per_frame, args.sample_seed)
+        limits = [f"{args.sample_fraction:.1%} of the valid pixels" if args.sample_fraction else "",
+                  f"at most {args.max_pixels_per_frame} pixels" if args.max_pixels_per_frame else ""]
+        print(f"Preview: evaluating a stratified sample of {', '.join(filter(None, limits))} per frame")
     
-    pred_paths = [os.path.join(args.preds_folder, f) for f in pred_files]
-    gt_paths = [os.path.join(args.gt_folder, f) for f in gt_files]
+    reference = args.bootstrap_reference or models[0].name
+    if args.bootstrap and reference not in [model.name for model in models]:
+        raise ValueError(f"Unknown --bootstrap_reference model '{reference}'")
     
-    print(f"Processing {len(pred_paths)} image pairs with {args.num_workers} workers...")
+    print(f"Processing {len(gt_paths)} ground truth files against {len(models)} model(s) "
+          f"with {args.num_workers} workers...")
     
     # Print masking information
     if args.shadow_mask:
-        print(f"Using shadow mask from: {args.shadow_mask}")
+        print(f"Using shadow mask from: {args.shadow_mask} (regions: {', '.join(args.shadow_region)})")
+    if args.shadow_sweep:
+        print(f"Sweeping dark mask thresholds 0-255 from: {args.shadow_rgb} (kernels {args.shadow_kernel_sizes})")
+    elif args.shadow_rgb:
+        print(f"Computing dark masks from: {args.shadow_rgb} (threshold {args.shadow_threshold}, "
+              f"kernels {args.shadow_kernel_sizes}, regions: {', '.join(args.shadow_region)})")
     if args.labeling and args.labeling_path:
-        print(f"Using labeling: {args.labeling} from: {args.labeling_path}")
+        print(f"Using labeling: {', '.join(args.labeling)} from: {args.labeling_path}")
     if args.distance_range:
-        print(f"Using distance range: {args.distance_range}")
+        print(f"Using distance range: {', '.join(args.distance_range)}")
+    
+    slices = build_slices(
+        labels=args.labeling if args.labeling_path else None,
+        shadow_regions=args.shadow_region if args.shadow_mask or (args.shadow_rgb and not args.shadow_sweep) else None,
+        distance_ranges=preprocessor.distance_ranges,
+        shadow_kernels=args.shadow_kernel_sizes if args.shadow_rgb and not args.shadow_sweep else None,
+    )
     
-    # Parallel computation
-    results, count = compute_metrics_parallel(
-        pred_paths, gt_paths, preprocessor, 
+    result_cache = None
+    if args.result_cache:
+        result_cache = ResultCache(
+            args.result_cache,
+            result_cache_config(preprocessor, args.max_gt_distance, args.metrics_backend, args.metrics_dtype),
+            max_bytes=args.result_cache_size << 20)
+    
+    frame_log = None
+    if args.frame_metrics:
+        frame_log = FrameMetricsLog(args.frame_metrics, [model.name for model in models],
+                                    [slice_name(eval_slice) for eval_slice in slices], worst_k=args.worst_k)
+    
+    distance_bins = DistanceBins(*args.distance_bins) if args.distance_bins else None
+    distance_curves = {}
+    shadow_sweep = tuple(args.shadow_kernel_sizes) if args.shadow_sweep else None
+    shadow_sweep_curves = {}
+    frame_stats = FrameStats() if args.bootstrap else None
+    sample_replicates = {}
+    
+    if args.profile or args.profile_trace:
+        profiling.enable()
+    
+    # Parallel computation, one pass for all models and slices
+    start = time.perf_counter()
+    results = evaluate_models_parallel(
+        gt_paths, models, preprocessor, slices,
         max_distance=args.max_gt_distance, 
         num_workers=args.num_workers,
         shadow_mask_dir=args.shadow_mask,
-        labeling_type=args.labeling,
-        labeling_path=args.labeling_path
+        labeling_path=args.labeling_path,
+        metrics_backend=args.metrics_backend,
+        metrics_dtype=args.metrics_dtype,
+        progress_interval=args.progress_interval,
+        global_alignment=args.global_alignment,
+        result_cache=result_cache,
+        frame_log=frame_log,
+        distance_bins=distance_bins,
+        distance_curves=distance_curves,
+        shadow_sweep=shadow_sweep,
+        shadow_sweep_curves=shadow_sweep_curves,
+        frame_stats=frame_stats,
+        torch_batch_size=args.torch_batch_size,
+        sample=sample,
+        sample_replicates=sample_replicates,
+        io_threads=args.io_threads,
+        io_readahead=args.io_readahead,
+        torch_threads=args.torch_threads
     )
+    wall_seconds = time.perf_counter() - start
+    if result_cache is not None:
+        result_cache.close()
+    if frame_log is not None:
+        frame_log.close()
+        print(f"Per-frame metrics ({frame_log.rows} rows) written to {', '.join(args.frame_metrics)}")
     
-    if results is None:
-        print("No valid results!")
-        return
+    if args.shard_output:
+        write_partial(args.shard_output, run_config(args, preprocessor, models, slices), files,
+                      args.shard or (0, 1), results, distance_curves, shadow_sweep_curves)
+        print(f"Partial results written to {args.shard_output}")
     
-    # Print results
-    print(f"\nResults ({count} valid files):")
-    for metric_name, value in results.items():
-        print(f"{metric_name}: {value:.4f}")
-
+    print_curves(args, distance_curves, shadow_sweep_curves)
+    
+    errors = None
+    if sample is not None or args.sample_frames:
+        errors = {key: standard_errors(accumulator, sample_replicates.get(key), args.pixel_weighted,
+                                       len(gt_paths), frames_total)
+                  for key, accumulator in results.items()}
+        print("\nPreview estimates, ± = standard error of the sampling")
+    if print_results(args, results, models, slices, frame_log, errors) and args.bootstrap:
+        report_bootstrap(args, results, frame_stats, reference)
+    if profiling.enabled():
+        profiling.print_summary(wall_seconds)
+        if args.profile_trace:
+            events = profiling.write_trace(args.profile_trace)
+            print(f"Trace with {events} events written to {args.profile_trace}")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,492 @@
+"""
+Resident evaluation service
+
+`serve` loads a GT split once and keeps it hot for any number of evaluation jobs: the GT depth, label
+maps and shadow masks are packed into a dataset cache (dataset_cache.py) in shared memory (/dev/shm
+unless --cache_dir is given), which every worker memory-maps, and one worker pool (worker_pool.py) is
+started and reused by all jobs. Jobs wait in a FIFO queue of at most --max_queued jobs, at most
+--max_jobs of them run at a time.
+
+HTTP API on localhost, JSON in and out:
+    POST   /jobs                          create a job, returns {"job": id}
+               {"preds_folder": path} or {"stream": true}, plus the options "alignment" (absolute,
+               relative, disparity, none), "labeling", "shadow_region", "distance_range" (lists as on
+               the command line) and "pixel_weighted"
+    POST   /jobs/<id>/frames/<frame_id>   one prediction of a stream job as an .npy body (np.save);
+                                          frame_id is a GT file name or index, as for evaluator.Evaluator
+    POST   /jobs/<id>/close               no more frames for a stream job
+    GET    /jobs/<id>[?wait=SECONDS]      state, progress, per-slice metrics and the metric table
+    DELETE /jobs/<id>                     cancel a job
+    GET    /jobs, GET /status             all jobs, server status
+
+`submit` evaluates a prediction folder on a running server and prints the table; evaluate_folder and
+evaluate_arrays do the same from Python.
+
+Usage:
+    python eval_server.py serve /path/to/gt --labeling_path /path/to/labels --shadow_mask /path/to/shadow
+    python eval_server.py submit /path/to/preds --relative_depth --labeling all crater --shadow_region in out
+"""
+
+import argparse
+import io
+import itertools
+import json
+import os
+import queue
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import zlib
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+import numpy as np
+
+from dataset_cache import build_cache
+from eval2results import format_slice_table, list_files
+from evaluator import gt_path_of
+from methods2evaluation import (ALIGNMENT_MODES, OptimizedDepthPreprocessor, alignment_mode_from_args,
+                                parse_distance_range)
+from metrics import METRICS_BACKENDS, METRICS_DTYPES, SHADOW_REGIONS, MetricAccumulator, build_slices, slice_name
+from worker_pool import EvaluationPool, FrameConfig
+
+DEFAULT_URL = "http://127.0.0.1:8765"
+# Finished jobs kept for GET /jobs/<id>
+MAX_FINISHED_JOBS = 100
+# Predictions of a stream job buffered in the server
+STREAM_QUEUE_SIZE = 32
+
+
+class EvaluationJob:
+    """One evaluation of a prediction folder or a stream of arrays, with its accumulated results"""
+
+    def __init__(self, job_id, frame_config, pixel_weighted, tasks=None, frames_total=None, stream_timeout=None):
+        self.job_id = job_id
+        self.frame_config = frame_config
+        self.pixel_weighted = pixel_weighted
+        self.names = [slice_name(eval_slice) for eval_slice in frame_config.slices]
+        self.accumulators = {name: MetricAccumulator() for name in self.names}
+        self.state = "queued"
+        self.error = None
+        self.frames_total = frames_total
+        self.frames_done = 0
+        self.frames_failed = 0
+        self.created = time.time()
+        self.started = self.finished = None
+        self.done = threading.Event()
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._tasks = tasks
+        # Stream jobs: (task_id, gt_path, [array]) tasks, None once closed
+        self.stream = None
+        self.frames_submitted = 0
+        if tasks is None:
+            self.stream = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+            self._closed = False
+            self.stream_timeout = stream_timeout
+
+    def add_frame(self, gt_path, pred):
+        """Queue one prediction of a stream job; blocks while the job's buffer is full"""
+        if self.stream is None or self._closed:
+            raise ValueError(f"job {self.job_id} does not accept frames")
+        with self._lock:
+            task = (self.frames_submitted, gt_path, [pred])
+            self.frames_submitted += 1
+        while not self.done.is_set():
+            try:
+                self.stream.put(task, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise ValueError(f"job {self.job_id} is {self.state}")
+
+    def close_stream(self):
+        if self.stream is None:
+            raise ValueError(f"job {self.job_id} is not a stream job")
+        if not self._closed:
+            self._closed = True
+            self.frames_total = self.frames_submitted
+            self._put_end()
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.stream is not None:
+            self._put_end()
+        if self.state == "queued":
+            self._finish("cancelled")
+
+    def _put_end(self):
+        # A job waiting for frames needs the end marker; with a full buffer it is not waiting
+        try:
+            self.stream.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _task_iter(self):
+        if self.stream is None:
+            yield from itertools.takewhile(lambda task: not self.cancelled.is_set(), self._tasks)
+            return
+        while True:
+            try:
+                task = self.stream.get(timeout=self.stream_timeout)
+            except queue.Empty:
+                # An abandoned stream would hold its job slot forever
+                self.error = f"no frames for {self.stream_timeout:g}s"
+                self.cancelled.set()
+                return
+            if task is None or self.cancelled.is_set():
+                return
+            yield task
+
+    def run(self, pool):
+        """Evaluate the job on the shared pool (frame_config overrides the workers' configuration)"""
+        if self.done.is_set():
+            return
+        self.state, self.started = "running", time.time()
+        try:
+            for _, frame_result in pool.map_unordered(self._task_iter(), total=self.frames_total,
+                                                      frame_args=(None, self.frame_config)):
+                model_result = None if frame_result is None else frame_result[0]
+                with self._lock:
+                    self.frames_done += 1
+                    if model_result is None:
+                        self.frames_failed += 1
+                        continue
+                    for name, sums in zip(self.names, model_result):
+                        if sums is not None:
+                            self.accumulators[name].add_frame(sums)
+            self._finish("cancelled" if self.cancelled.is_set() else "done")
+        except Exception as e:
+            self.error = str(e)
+            self._finish("failed")
+
+    def _finish(self, state):
+        self.state, self.finished = state, time.time()
+        self.done.set()
+
+    def summary(self):
+        return {"job": self.job_id, "state": self.state, "frames_done": self.frames_done,
+                "frames_failed": self.frames_failed, "frames_total": self.frames_total,
+                "seconds": None if self.started is None else (self.finished or time.time()) - self.started,
+                "error": self.error}
+
+    def to_json(self):
+        """Summary, per-slice results and the metric table of what is evaluated so far"""
+        with self._lock:
+            accumulators = {name: MetricAccumulator(acc.stats) for name, acc in self.accumulators.items()}
+        result = self.summary()
+        result["pixel_weighted"] = self.pixel_weighted
+        result["results"] = {name: {"files": acc.n_images, "n_pixels": acc.n_pixels,
+                                    "metrics": acc.metrics(self.pixel_weighted)}
+                             for name, acc in accumulators.items()}
+        result["table"] = format_slice_table(accumulators, self.pixel_weighted)
+        return result
+
+
+class EvaluationService:
+    """The GT split, its shared dataset cache, the worker pool and the job queue of a server"""
+
+    def __init__(self, args):
+        self.args = args
+        self.gt_paths = list_files(args.gt_folder)
+        self._gt_by_name = {os.path.splitext(os.path.basename(path))[0]: path for path in self.gt_paths}
+        self._own_cache = args.cache_dir is None
+        self.cache_dir = args.cache_dir or default_cache_dir(args.gt_folder)
+        build_cache(args.gt_folder, self.cache_dir, OptimizedDepthPreprocessor(args.config_info, args),
+                    max_distance=args.max_gt_distance, labeling_path=args.labeling_path,
+                    shadow_mask_dir=args.shadow_mask, num_workers=args.num_workers)
+        args.gt_cache = self.cache_dir
+        self.preprocessor = OptimizedDepthPreprocessor(args.config_info, args)
+        self.pool = EvaluationPool(
+            self.preprocessor, self.frame_config({}), num_workers=args.num_workers,
+            metrics_backend=args.metrics_backend, metrics_dtype=args.metrics_dtype, progress_interval=0,
+            min_batch_size=args.torch_batch_size if args.metrics_backend == "torch" else 1,
+            io_threads=args.io_threads, io_readahead=args.io_readahead, torch_threads=args.torch_threads)
+        self.pool.start()
+        self.jobs = OrderedDict()
+        self.pending = queue.Queue(maxsize=args.max_queued)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.started = time.time()
+        for _ in range(args.max_jobs):
+            threading.Thread(target=self._run_jobs, daemon=True).start()
+
+    def frame_config(self, options):
+        """FrameConfig of a job from its JSON options; ValueError for invalid ones"""
+        alignment = options.get("alignment", self.preprocessor.alignment)
+        if alignment not in ALIGNMENT_MODES:
+            raise ValueError(f"invalid alignment '{alignment}', choose from {ALIGNMENT_MODES}")
+        labeling = options.get("labeling")
+        if labeling and not self.args.labeling_path:
+            raise ValueError("labeling needs a server started with --labeling_path")
+        shadow_region = options.get("shadow_region")
+        if shadow_region and not self.args.shadow_mask:
+            raise ValueError("shadow_region needs a server started with --shadow_mask")
+        if shadow_region and not set(shadow_region) <= set(SHADOW_REGIONS):
+            raise ValueError(f"invalid shadow_region, choose from {SHADOW_REGIONS}")
+        distance_ranges = [parse_distance_range(r) for r in options.get("distance_range") or []]
+        slices = build_slices(labeling, shadow_region, distance_ranges or None)
+        return FrameConfig(
+            [alignment], self.args.max_gt_distance, self.args.shadow_mask if shadow_region else None,
+            self.args.labeling_path if labeling else None, slices, len(slices) == 1, None, None, None)
+
+    def create_job(self, options):
+        """Queue a job from its JSON options; ValueError for invalid options, queue.Full if too many are queued"""
+        frame_config = self.frame_config(options)
+        tasks, frames_total = None, None
+        if options.get("preds_folder"):
+            pred_paths = list_files(options["preds_folder"])
+            frames_total = min(len(pred_paths), len(self.gt_paths))
+            tasks = ((i, self.gt_paths[i], [pred_paths[i]]) for i in range(frames_total))
+        elif not options.get("stream"):
+            raise ValueError("a job needs a preds_folder or stream: true")
+        with self._lock:
+            job = EvaluationJob(next(self._ids), frame_config, bool(options.get("pixel_weighted")), tasks,
+                                frames_total, self.args.stream_timeout)
+            self.pending.put_nowait(job)
+            self.jobs[job.job_id] = job
+            finished = [job_id for job_id, other in self.jobs.items() if other.done.is_set()]
+            for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self.jobs[job_id]
+        return job
+
+    def job(self, job_id):
+        with self._lock:
+            job = self.jobs.get(int(job_id)) if str(job_id).isdigit() else None
+        if job is None:
+            raise KeyError(f"unknown job {job_id}")
+        return job
+
+    def job_summaries(self):
+        with self._lock:
+            return [job.summary() for job in self.jobs.values()]
+
+    def gt_path(self, frame_id):
+        return gt_path_of(int(frame_id) if frame_id.isdigit() and frame_id not in self._gt_by_name else frame_id,
+                          self.gt_paths, self._gt_by_name)
+
+    def status(self):
+        with self._lock:
+            states = [job.state for job in self.jobs.values()]
+        return {"gt_folder": self.args.gt_folder, "frames": len(self.gt_paths), "cache_dir": self.cache_dir,
+                "num_workers": self.args.num_workers, "max_jobs": self.args.max_jobs,
+                "uptime_seconds": time.time() - self.started,
+                "jobs": {state: states.count(state) for state in sorted(set(states))}}
+
+    def _run_jobs(self):
+        while True:
+            job = self.pending.get()
+            job.run(self.pool)
+            print(f"Job {job.job_id} {job.state}: {job.frames_done} frames ({job.frames_failed} failed) "
+                  f"in {job.summary()['seconds'] or 0:.2f}s")
+
+    def close(self):
+        with self._lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            job.cancel()
+        self.pool.cancel()
+        self.pool.close()
+        if self._own_cache:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+def default_cache_dir(gt_folder):
+    """Dataset cache directory of a GT folder in shared memory (/dev/shm, or the temp directory)"""
+    root = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(root, f"lunar_eval_cache_{zlib.crc32(os.path.abspath(gt_folder).encode()):08x}")
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """JSON API of an EvaluationService (self.server.service)"""
+
+    def do_GET(self):
+        self._handle(self._get)
+
+    def do_POST(self):
+        self._handle(self._post)
+
+    def do_DELETE(self):
+        self._handle(self._delete)
+
+    def _get(self, parts, query):
+        service = self.server.service
+        if parts == ["status"]:
+            return service.status()
+        if parts == ["jobs"]:
+            return service.job_summaries()
+        if len(parts) == 2 and parts[0] == "jobs":
+            job = service.job(parts[1])
+            job.done.wait(float(query.get("wait", ["0"])[0]))
+            return job.to_json()
+        raise KeyError(self.path)
+
+    def _post(self, parts, query):
+        service = self.server.service
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if parts == ["jobs"]:
+            return {"job": service.create_job(json.loads(body or b"{}")).job_id}
+        if len(parts) == 4 and parts[0] == "jobs" and parts[2] == "frames":
+            job = service.job(parts[1])
+            pred = np.load(io.BytesIO(body), allow_pickle=False)
+            job.add_frame(service.gt_path(parts[3]), pred)
+            return {"job": job.job_id, "frames_submitted": job.frames_submitted}
+        if len(parts) == 3 and parts[0] == "jobs" and parts[2] == "close":
+            job = service.job(parts[1])
+            job.close_stream()
+            return job.summary()
+        raise KeyError(self.path)
+
+    def _delete(self, parts, query):
+        if len(parts) == 2 and parts[0] == "jobs":
+            job = self.server.service.job(parts[1])
+            job.cancel()
+            return job.summary()
+        raise KeyError(self.path)
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        try:
+            status, payload = 200, method(parts, parse_qs(url.query))
+        except KeyError as e:
+            status, payload = 404, {"error": f"not found: {e.args[0] if e.args else url.path}"}
+        except queue.Full:
+            status, payload = 503, {"error": "too many queued jobs"}
+        except (ValueError, OSError, EOFError) as e:
+            status, payload = 400, {"error": str(e)}
+        except Exception as e:
+            status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Jobs are logged by the service
+        pass
+
+
+# ******************** client ********************
+def call(url, method, path, payload=None, data=None):
+    """JSON response of an API call; RuntimeError with the server's message on errors"""
+    if payload is not None:
+        data = json.dumps(payload).encode()
+    request = urllib.request.Request(url.rstrip("/") + path, data=data, method=method)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(json.loads(e.read()).get("error", str(e))) from None
+
+
+def wait_for_job(url, job_id, poll_seconds=60):
+    """Final JSON of a job"""
+    while True:
+        result = call(url, "GET", f"/jobs/{job_id}?wait={poll_seconds}")
+        if result["state"] not in ("queued", "running"):
+            return result
+
+
+def evaluate_folder(url, preds_folder, **options):
+    """Evaluate a prediction folder on a running server; returns the final job JSON"""
+    job_id = call(url, "POST", "/jobs", dict(options, preds_folder=os.path.abspath(preds_folder)))["job"]
+    return wait_for_job(url, job_id)
+
+
+def evaluate_arrays(url, frames, **options):
+    """Evaluate (frame_id, array) pairs on a running server; returns the final job JSON"""
+    job_id = call(url, "POST", "/jobs", dict(options, stream=True))["job"]
+    for frame_id, pred in frames:
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(pred))
+        call(url, "POST", f"/jobs/{job_id}/frames/{quote(str(frame_id), safe='')}", data=buffer.getvalue())
+    call(url, "POST", f"/jobs/{job_id}/close")
+    return wait_for_job(url, job_id)
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resident evaluation service")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser("serve", help="Load a GT split and serve evaluation jobs")
+    serve.add_argument("gt_folder")
+    serve.add_argument("--labeling_path", type=str, help="Directory containing the label png files")
+    serve.add_argument("--shadow_mask", type=str, help="Directory containing the shadow mask png files")
+    serve.add_argument("--config_info", type=str, default="config_info")
+    serve.add_argument("--max_gt_distance", type=int, default=100)
+    serve.add_argument("--pfm_flip_rows", action="store_true")
+    serve.add_argument("--resize", action="store_true")
+    serve.add_argument("--cache_dir", type=str,
+                       help="Dataset cache directory, kept after shutdown (default: a temporary one in /dev/shm)")
+    serve.add_argument("--num_workers", type=int, default=4)
+    serve.add_argument("--metrics_backend", type=str, choices=METRICS_BACKENDS, default="numpy")
+    serve.add_argument("--metrics_dtype", type=str, choices=METRICS_DTYPES, default="auto")
+    serve.add_argument("--torch_batch_size", type=int, default=8)
+    serve.add_argument("--torch_threads", type=int, help="torch intra-op threads per worker (default: cores / workers)")
+    serve.add_argument("--io_threads", type=int, default=0, help="Threads per worker decoding frames ahead")
+    serve.add_argument("--io_readahead", type=int, default=4)
+    serve.add_argument("--max_jobs", type=int, default=1, help="Jobs evaluated at the same time")
+    serve.add_argument("--max_queued", type=int, default=16, help="Jobs waiting to run, more are rejected")
+    serve.add_argument("--stream_timeout", type=float, default=300,
+                       help="Seconds a running stream job waits for its next frame before it is cancelled")
+    serve.add_argument("--host", type=str, default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+
+    submit = subparsers.add_parser("submit", help="Evaluate a prediction folder on a running server")
+    submit.add_argument("preds_folder")
+    submit.add_argument("--url", type=str, default=DEFAULT_URL)
+    submit.add_argument("--absolute_depth", action="store_true")
+    submit.add_argument("--relative_depth", action="store_true")
+    submit.add_argument("--disparity", action="store_true")
+    submit.add_argument("--labeling", type=str, nargs="+")
+    submit.add_argument("--shadow_region", type=str, nargs="+", choices=SHADOW_REGIONS)
+    submit.add_argument("--distance_range", type=str, nargs="+")
+    submit.add_argument("--pixel_weighted", action="store_true")
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        if args.max_jobs < 1 or args.max_queued < 1:
+            parser.error("--max_jobs and --max_queued must be at least 1")
+        if not args.stream_timeout > 0:
+            parser.error("--stream_timeout must be positive")
+        service = EvaluationService(args)
+        server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+        server.daemon_threads = True
+        server.service = service
+        print(f"Serving {len(service.gt_paths)} GT frames from {service.cache_dir} on "
+              f"http://{args.host}:{server.server_port} ({args.num_workers} workers, {args.max_jobs} job(s) at a time)")
+        # SIGTERM shuts down like Ctrl-C, so the shared memory cache is removed
+        signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            service.close()
+    elif args.command == "submit":
+        options = {"alignment": alignment_mode_from_args(args), "labeling": args.labeling,
+                   "shadow_region": args.shadow_region, "distance_range": args.distance_range,
+                   "pixel_weighted": args.pixel_weighted}
+        result = evaluate_folder(args.url, args.preds_folder, **options)
+        print(f"Job {result['job']} {result['state']}: {result['frames_done']} frames "
+              f"({result['frames_failed']} failed) in {result['seconds'] or 0:.2f}s")
+        if result["error"]:
+            print(f"Error: {result['error']}")
+        print(result["table"])
+
+
+if __name__ == "__main__":
+    main()
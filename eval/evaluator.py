@@ -0,0 +1,199 @@
+"""
+In-process streaming evaluation of predictions held in memory
+
+An Evaluator evaluates predictions straight from a model's inference loop against the GT of a
+dataset folder, without writing them to disk. Predictions are submitted as (frame_id, array) pairs;
+the evaluator looks up the GT file and the masks of the frame itself and evaluates it in an
+EvaluationPool (worker_pool.py). Submitted frames wait in a bounded queue, so submit() blocks when
+the workers fall behind: at most queue_size + 2 * num_workers * max_batch_size predictions are held
+in memory. Running metrics are available at any time, final metrics once the evaluator is closed.
+
+Arrays are in the units of a saved .npy prediction (see OptimizedDepthPreprocessor.load_depth), so an
+in-memory run gives the same results as eval2results.py on the saved files.
+
+Example:
+    with Evaluator("data/gt", relative_depth=True, labeling=["crater"], labeling_path="data/label") as evaluator:
+        for frame_id, pred in inference(loader):
+            evaluator.submit(frame_id, pred)
+    print(evaluator.metrics())
+"""
+
+import os
+import queue
+import threading
+from argparse import Namespace
+
+import numpy as np
+
+from methods2evaluation import OptimizedDepthPreprocessor
+from metrics import MetricAccumulator, build_slices, slice_name
+
+# The eval2results.py options an Evaluator takes (as keyword arguments or an args namespace)
+OPTION_DEFAULTS = {
+    "config_info": "config_info", "absolute_depth": False, "relative_depth": False, "disparity": False,
+    "resize": False, "max_gt_distance": 100, "gt_cache": None, "pfm_flip_rows": False,
+    "num_workers": 4, "metrics_backend": "numpy", "metrics_dtype": "auto", "torch_batch_size": 8,
+    "torch_threads": None, "progress_interval": 0.0, "shadow_mask": None, "shadow_rgb": None,
+    "shadow_threshold": 50, "shadow_kernel_sizes": [3, 5, 7, 9], "shadow_region": ["in"], "labeling": None,
+    "labeling_path": None, "distance_range": None, "io_threads": 0, "io_readahead": 4,
+}
+
+
+def gt_path_of(frame_id, gt_paths, gt_by_name):
+    """GT file of a frame id: a file name (with or without extension) in gt_by_name ({stem: path}),
+    or an index into the sorted gt_paths
+    """
+    if isinstance(frame_id, (int, np.integer)):
+        return gt_paths[frame_id]
+    name = os.path.splitext(os.path.basename(str(frame_id)))[0]
+    if name not in gt_by_name:
+        raise KeyError(f"no ground truth for frame {frame_id!r}")
+    return gt_by_name[name]
+
+
+class Evaluator:
+    """Streaming evaluation of (frame_id, prediction array) pairs against a GT folder.
+
+    frame_id is the GT file name (with or without extension) or its index in the sorted GT folder.
+    Options are the eval2results.py options of OPTION_DEFAULTS, as keyword arguments and/or an args
+    namespace (e.g. from eval2results.args_parser); pixel sampling, distance bins, the shadow sweep
+    and the result cache are only available from the command line.
+    Use as a context manager, or call close().
+    """
+
+    def __init__(self, gt_folder, args=None, queue_size=32, max_batch_size=4, **options):
+        unknown = sorted(set(options) - set(OPTION_DEFAULTS))
+        if unknown:
+            raise TypeError(f"unknown Evaluator option(s): {', '.join(unknown)}")
+        values = dict(OPTION_DEFAULTS)
+        values.update({key: value for key, value in vars(args or Namespace()).items() if key in OPTION_DEFAULTS})
+        values.update(options)
+        self.args = args = Namespace(**values)
+        if args.shadow_mask and args.shadow_rgb:
+            raise ValueError("use either shadow_mask or shadow_rgb")
+
+        self.gt_paths = [os.path.join(gt_folder, f) for f in sorted(os.listdir(gt_folder))]
+        self._gt_by_name = {os.path.splitext(os.path.basename(path))[0]: path for path in self.gt_paths}
+        self.preprocessor = OptimizedDepthPreprocessor(config_info=args.config_info, args=args)
+        self.slices = build_slices(
+            labels=args.labeling if args.labeling_path else None,
+            shadow_regions=args.shadow_region if args.shadow_mask or args.shadow_rgb else None,
+            distance_ranges=self.preprocessor.distance_ranges,
+            shadow_kernels=args.shadow_kernel_sizes if args.shadow_rgb else None,
+        )
+        self.names = [slice_name(eval_slice) for eval_slice in self.slices]
+        self._accumulators = {name: MetricAccumulator() for name in self.names}
+        self.frames_done = 0
+        self.frames_failed = 0
+
+        from worker_pool import EvaluationPool, FrameConfig
+
+        frame_config = FrameConfig([None], args.max_gt_distance, args.shadow_mask, args.labeling_path, self.slices,
+                                   len(self.slices) == 1, None, None, None)
+        self.pool = EvaluationPool(
+            self.preprocessor, frame_config, num_workers=args.num_workers, metrics_backend=args.metrics_backend,
+            metrics_dtype=args.metrics_dtype, max_batch_size=max_batch_size,
+            progress_interval=args.progress_interval,
+            min_batch_size=args.torch_batch_size if args.metrics_backend == "torch" else 1,
+            io_threads=args.io_threads, io_readahead=args.io_readahead, torch_threads=args.torch_threads)
+        # Workers are forked here rather than from the consumer thread
+        self.pool.start()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._error = None
+        self._closed = False
+        self._consumer = threading.Thread(target=self._consume, name="evaluator", daemon=True)
+        self._consumer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.cancel()
+
+    def gt_path(self, frame_id):
+        """GT file of a frame id (file name with or without extension, or index in the sorted GT folder)"""
+        return gt_path_of(frame_id, self.gt_paths, self._gt_by_name)
+
+    def submit(self, frame_id, pred):
+        """Queue a prediction (array-like, copied) for evaluation; blocks while the queue is full"""
+        if self._closed:
+            raise RuntimeError("the evaluator is closed")
+        self._raise_error()
+        if not self._put((frame_id, self.gt_path(frame_id), [np.array(pred)])):
+            self._raise_error()
+
+    def evaluate(self, frames):
+        """Submit every (frame_id, prediction) pair of an iterable, close and return the final metrics"""
+        for frame_id, pred in frames:
+            self.submit(frame_id, pred)
+        self.close()
+        return self.metrics()
+
+    def close(self):
+        """Wait until every submitted frame is evaluated and stop the workers"""
+        if not self._closed:
+            self._closed = True
+            self._put(None)
+            self._consumer.join()
+            self.pool.close()
+        self._raise_error()
+
+    def cancel(self):
+        """Stop without evaluating the queued frames; the metrics cover what was done"""
+        if self._closed:
+            return
+        self._closed = True
+        self.pool.cancel()
+        # A consumer waiting for frames needs the end marker, any other one stops on the cancelled pool
+        self._put(None)
+        self._consumer.join()
+        self.pool.close()
+
+    def results(self):
+        """{slice name: MetricAccumulator} of the frames evaluated so far (copies)"""
+        with self._lock:
+            return {name: MetricAccumulator(accumulator.stats) for name, accumulator in self._accumulators.items()}
+
+    def metrics(self, pixel_weighted=False):
+        """{slice name: {metric: value}} of the frames evaluated so far (None for empty slices)"""
+        return {name: accumulator.metrics(pixel_weighted) for name, accumulator in self.results().items()}
+
+    def _put(self, item):
+        """Put an item into the queue unless the consumer has stopped (False then)"""
+        while self._consumer.is_alive():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _tasks(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            yield task
+
+    def _consume(self):
+        try:
+            for _, frame_result in self.pool.map_unordered(self._tasks()):
+                model_result = None if frame_result is None else frame_result[0]
+                with self._lock:
+                    self.frames_done += 1
+                    if model_result is None:
+                        self.frames_failed += 1
+                        continue
+                    for name, sums in zip(self.names, model_result):
+                        if sums is not None:
+                            self._accumulators[name].add_frame(sums)
+        except BaseException as e:
+            self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError(f"evaluation failed: {self._error}") from self._error
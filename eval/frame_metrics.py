@@ -0,0 +1,132 @@
+"""
+Streaming per-frame metrics export
+
+Every (frame, model, slice) result is written out as soon as it arrives, so memory stays constant:
+    *.csv   frame, gt_file, pred_file, model, slice, n_pixels, one column per metric
+    *.npy   float64 [rows, 4 + NUM_METRICS] = frame, model id, slice id, n_pixels, metrics;
+            appended in place, the header is patched with the final row count on close.
+            Model and slice ids are resolved by the *.json file written next to it.
+A bounded heap per (model, slice, metric) keeps the k worst frames.
+"""
+
+import csv
+import heapq
+import json
+import os
+
+import numpy as np
+
+from metrics import METRIC_NAMES, metric_values_from_sums
+
+# Metrics where a lower value is worse (the others are errors)
+HIGHER_IS_BETTER = ("δ1", "δ2", "δ3", "F_A")
+NPY_COLUMNS = ("frame", "model", "slice", "n_pixels") + METRIC_NAMES
+# Fixed header size so the row count can be rewritten in place
+NPY_HEADER_SIZE = 128
+
+
+def _npy_header(rows, cols):
+    header = f"{{'descr': '<f8', 'fortran_order': False, 'shape': ({rows}, {cols}), }}"
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin-1")
+
+
+class FrameMetricsLog:
+    """Writes per-frame metrics to .csv / .npy files and tracks the worst frames per metric"""
+
+    def __init__(self, paths, model_names, slice_names, worst_k=10):
+        self.model_ids = {name: i for i, name in enumerate(model_names)}
+        self.slice_ids = {name: i for i, name in enumerate(slice_names)}
+        self.worst_k = worst_k
+        self.worst = {}
+        self.rows = 0
+        self._csv_files = []
+        self._npy_files = []
+        for path in paths:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if path.endswith(".npy"):
+                f = open(path, "wb")
+                f.write(_npy_header(0, len(NPY_COLUMNS)))
+                self._npy_files.append(f)
+                with open(f"{os.path.splitext(path)[0]}.json", "w") as index:
+                    json.dump({"columns": NPY_COLUMNS, "models": list(model_names),
+                               "slices": list(slice_names)}, index, ensure_ascii=False, indent=2)
+            else:
+                f = open(path, "w", newline="", encoding="utf-8")
+                writer = csv.writer(f)
+                writer.writerow(("frame", "gt_file", "pred_file", "model", "slice", "n_pixels") + METRIC_NAMES)
+                self._csv_files.append((f, writer))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, frame, gt_path, pred_path, model_name, slice_sums):
+        """Record one model's results on one frame; slice_sums maps slice name to sums (None = no pixels)"""
+        names = list(slice_sums)
+        rows = np.full((len(names), len(NPY_COLUMNS)), np.nan)
+        rows[:, 0] = frame
+        rows[:, 1] = self.model_ids[model_name]
+        for r, name in enumerate(names):
+            rows[r, 2] = self.slice_ids[name]
+            sums = slice_sums[name]
+            rows[r, 3] = 0 if sums is None else sums[0]
+            if sums is not None and sums[0] > 0:
+                rows[r, 4:] = metric_values_from_sums(sums)
+        self.rows += len(rows)
+
+        for f in self._npy_files:
+            f.write(rows.tobytes())
+        gt_file, pred_file = os.path.basename(gt_path), os.path.basename(pred_path)
+        for _, writer in self._csv_files:
+            for name, row in zip(names, rows):
+                writer.writerow([frame, gt_file, pred_file, model_name, name, int(row[3])]
+                                + ["" if np.isnan(v) else f"{v:.6g}" for v in row[4:]])
+
+        if self.worst_k:
+            for name, row in zip(names, rows):
+                if row[3] > 0:
+                    self._track_worst(model_name, name, pred_file, row[4:])
+
+    def _track_worst(self, model_name, slice_name, frame_name, values):
+        heaps = self.worst.setdefault((model_name, slice_name), [[] for _ in METRIC_NAMES])
+        for heap, metric, value in zip(heaps, METRIC_NAMES, values):
+            # Min-heap on badness: the root is the best of the k worst frames seen so far
+            badness = -value if metric in HIGHER_IS_BETTER else value
+            if len(heap) < self.worst_k:
+                heapq.heappush(heap, (badness, frame_name, value))
+            elif badness > heap[0][0]:
+                heapq.heapreplace(heap, (badness, frame_name, value))
+
+    def worst_frames(self, model_name, slice_name):
+        """{metric: [(frame, value), ...]} worst first"""
+        heaps = self.worst.get((model_name, slice_name))
+        if heaps is None:
+            return {}
+        return {metric: [(frame, value) for _, frame, value in sorted(heap, reverse=True)]
+                for metric, heap in zip(METRIC_NAMES, heaps)}
+
+    def close(self):
+        for f in self._npy_files:
+            f.seek(0)
+            f.write(_npy_header(self.rows, len(NPY_COLUMNS)))
+            f.close()
+        for f, _ in self._csv_files:
+            f.close()
+        self._npy_files = []
+        self._csv_files = []
+
+
+def print_worst_frames(frame_log, model_name, slice_name, title):
+    """Print the k worst frames of every metric"""
+    worst = frame_log.worst_frames(model_name, slice_name)
+    if not worst:
+        return
+    print(f"\nWorst {frame_log.worst_k} frames{title}:")
+    width = max(len(m) for m in METRIC_NAMES)
+    for metric, frames in worst.items():
+        print(f"{metric:<{width}}: " + ", ".join(f"{frame} ({value:.4f})" for frame, value in frames))
@@ -7,6 +7,104 @@ import numpy as np
 import os
 import argparse
 
+import prefetch
+
+
+_KERNELS = {}
+
+
+def morphology_kernel(size):
+    """Square structuring element of the opening, built once per size"""
+    if size not in _KERNELS:
+        _KERNELS[size] = np.ones((size, size), np.uint8)
+    return _KERNELS[size]
+
+
+def mask_base_name(filename):
+    """Frame name of an image file: the part after the last '_' (e.g. color0_000123.png -> 000123)"""
+    name_parts = filename.split('_')
+    if len(name_parts) > 1:
+        return name_parts[-1].split('.')[0]
+    return filename.split('.')[0]
+
+
+def dark_masks_from_gray(image, threshold_value=50, kernel_sizes=(3, 5, 7, 9)):
+    """Thresholded dark mask (0/255) of a grayscale image and its opening for every kernel size"""
+    dark_mask = (image < threshold_value).astype(np.uint8) * 255
+    cleaned = {size: cv2.morphologyEx(dark_mask, cv2.MORPH_OPEN, morphology_kernel(size))
+               for size in kernel_sizes}
+    return dark_mask, cleaned
+
+
+def opening_levels(image, kernel_sizes=(3, 5, 7, 9)):
+    """Grayscale closing of the image per kernel size.
+    
+    For every threshold t, the dark mask (image < t) opened with a kernel equals (closing < t), so one
+    closed image per kernel gives the cleaned masks of all thresholds (used by the shadow sweep).
+    """
+    return {size: cv2.morphologyEx(image, cv2.MORPH_CLOSE, morphology_kernel(size)) for size in kernel_sizes}
+
+
+def compute_dark_masks(image_path, threshold_value=50, kernel_sizes=(3, 5, 7, 9)):
+    """Decode an image once as grayscale and return (dark_mask, {size: cleaned_mask}), None if unreadable"""
+    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return None
+    return dark_masks_from_gray(image, threshold_value, kernel_sizes)
+
+
+class DarkMaskSource:
+    """Computes the cleaned dark masks of a frame from the RGB image folder instead of reading mask files.
+    
+    Images are matched to frames by mask_base_name, as the masks written by generate_dark_masks.
+    """
+
+    def __init__(self, image_folder, threshold_value=50, kernel_sizes=(3, 5, 7, 9)):
+        if not os.path.isdir(image_folder):
+            raise FileNotFoundError(f"Input folder not found: {image_folder}")
+        self.image_folder = image_folder
+        self.threshold_value = threshold_value
+        self.kernel_sizes = tuple(kernel_sizes)
+        self._index = None
+
+    def __getstate__(self):
+        # The file index is rebuilt lazily in every worker
+        state = self.__dict__.copy()
+        state["_index"] = None
+        return state
+
+    def image_path(self, frame_file):
+        """RGB image of a frame (matched on the frame file name without extension), None if missing"""
+        if self._index is None:
+            self._index = {mask_base_name(f): os.path.join(self.image_folder, f)
+                           for f in sorted(os.listdir(self.image_folder)) if f.endswith('.png')}
+        return self._index.get(os.path.splitext(os.path.basename(frame_file))[0])
+
+    def levels(self, frame_file, kernel_sizes=None):
+        """{kernel size: opening_levels image} of a frame from a single grayscale decode, None if no image"""
+        image_path = self.image_path(frame_file)
+        image = None if image_path is None else prefetch.take(image_path)
+        if image is None and image_path is not None:
+            image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            return None
+        return opening_levels(image, kernel_sizes or self.kernel_sizes)
+
+    def masks(self, frame_file):
+        """{kernel size: boolean dark mask} of a frame from a single grayscale decode, None if no image"""
+        image_path = self.image_path(frame_file)
+        if image_path is None:
+            return None
+        image = prefetch.take(image_path)
+        if image is None:
+            result = compute_dark_masks(image_path, self.threshold_value, self.kernel_sizes)
+        else:
+            result = dark_masks_from_gray(image, self.threshold_value, self.kernel_sizes)
+        if result is None:
+            print(f"Warning: Could not read {image_path}")
+            return None
+        return {size: cleaned != 0 for size, cleaned in result[1].items()}
+
 
 def generate_dark_masks(input_folder, output_folder, threshold_value=50, 
                         kernel_sizes=[3, 5, 7, 9], save_normal=False, prefix="", 
@@ -21,7 +119,6 @@ def generate_dark_masks(input_folder, output_folder, threshold_value=50,
         for size in kernel_sizes:
             os.makedirs(os.path.join(output_folder, str(size)), exist_ok=True)
     
-    kernels = {size: np.ones((size, size), np.uint8) for size in kernel_sizes}
     png_files = [f for f in os.listdir(input_folder) if f.endswith('.png')]
     total_files = len(png_files)
     
@@ -38,27 +135,22 @@ def generate_dark_masks(input_folder, output_folder, threshold_value=50,
     
     for idx, filename in enumerate(png_files):
         image_path = os.path.join(input_folder, filename)
+        base_name = mask_base_name(filename)
         
-        name_parts = filename.split('_')
-        if len(name_parts) > 1:
-            base_name = name_parts[-1].split('.')[0]
-        else:
-            base_name = filename.split('.')[0]
-        
-        image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+        result = compute_dark_masks(image_path, threshold_value, kernel_sizes)
         
-        if image is None:
+        if result is None:
             print(f"Warning: Could not read {filename}, skipping...")
             continue
         
-        dark_mask = (image < threshold_value).astype(np.uint8) * 255
+        dark_mask, cleaned_masks = result
         
         if save_normal:
             normal_path = os.path.join(output_folder, f'normal_{filename}')
             cv2.imwrite(normal_path, dark_mask)
         
         for size in kernel_sizes:
-            cleaned_mask = cv2.morphologyEx(dark_mask, cv2.MORPH_OPEN, kernels[size])
+            cleaned_mask = cleaned_masks[size]
             
             if flat:
                 if no_kernel_suffix:
@@ -1,9 +1,34 @@
 import os
 import yaml
 import numpy as np
-import cv2
-from PIL import Image
-from alignment import align_depth_least_square, disparity2depth, depth2disparity
+from alignment import (least_square_sums, solve_scale_shift, log_depth_histogram, histogram_median,
+                       disparity2depth, depth2disparity)
+from pfm2npy import load_pfm_view
+from pred_pack import is_pack_frame, load_pack_frame, pack_frame_source
+from dataset_cache import DatasetCache, cache_config
+import prefetch
+import profiling
+
+
+ALIGNMENT_MODES = ("absolute", "relative", "disparity", "none")
+
+
+def alignment_mode_from_args(args):
+    """Alignment mode selected by the --absolute_depth / --relative_depth / --disparity flags"""
+    if args and getattr(args, 'relative_depth', False):
+        return "disparity" if getattr(args, 'disparity', False) else "relative"
+    if args and getattr(args, 'absolute_depth', False):
+        return "absolute"
+    return "none"
+
+
+def parse_distance_range(range_str):
+    """Parse a distance range string like '30-60' (or '60' for 0-60) into (min, max)"""
+    if '-' in range_str:
+        min_dist, max_dist = range_str.split('-')
+        return float(min_dist), float(max_dist)
+    # Single value means max distance
+    return 0.0, float(range_str)
 
 
 class OptimizedDepthPreprocessor:
@@ -19,54 +44,105 @@ class OptimizedDepthPreprocessor:
         self.min_depth = float(config['min_depth'])
         self.max_depth = float(config['max_depth'])
         self.scale_factor = float(config['scale_factor'])
+        # Least squares alignment is fitted on a strided grid of at most this many pixels per side
+        max_res = config.get('aligment_max_res')
+        self.alignment_max_res = int(max_res) if max_res else None
+        self.alignment = alignment_mode_from_args(args)
         
-        # Parse distance range if provided
-        self.distance_min, self.distance_max = self._parse_distance_range()
+        # Parse distance range(s) if provided; the first one drives the single-slice path
+        self.distance_ranges = self._parse_distance_ranges()
+        self.distance_min, self.distance_max = self.distance_ranges[0] if self.distance_ranges else (None, None)
         self.distance_mask = None
+        
+        # Packed GT / label / shadow cache built with `dataset_cache.py build-cache`
+        self.gt_cache = None
+        if args and getattr(args, 'gt_cache', None):
+            self.gt_cache = DatasetCache(args.gt_cache)
+            expected = cache_config(self, getattr(args, 'max_gt_distance', 100))
+            if self.gt_cache.config != expected:
+                print(f"Warning: dataset cache {args.gt_cache} was built with {self.gt_cache.config}, "
+                      f"expected {expected}; decoding from source instead")
+                self.gt_cache = None
+        
+        # Shadow masks computed in the worker from the RGB images instead of mask files
+        self.dark_masks = None
+        if args and getattr(args, 'shadow_rgb', None):
+            from generate_dark_mask import DarkMaskSource
+            self.dark_masks = DarkMaskSource(args.shadow_rgb, args.shadow_threshold, args.shadow_kernel_sizes)
 
-    def _parse_distance_range(self):
-        """Parse distance range from command line argument"""
+    def _parse_distance_ranges(self):
+        """Parse distance range(s) from command line argument"""
         if not self.args or not hasattr(self.args, 'distance_range') or not self.args.distance_range:
-            return None, None
+            return []
         
-        try:
-            range_str = self.args.distance_range
-            if '-' in range_str:
-                min_dist, max_dist = range_str.split('-')
-                return float(min_dist), float(max_dist)
-            else:
-                # Single value means max distance
-                return 0.0, float(range_str)
-        except:
-            print(f"Warning: Invalid distance range format '{self.args.distance_range}'. Use format like '30-60' or '60'")
-            return None, None
+        range_strs = self.args.distance_range
+        if isinstance(range_strs, str):
+            range_strs = [range_strs]
+        
+        ranges = []
+        for range_str in range_strs:
+            try:
+                ranges.append(parse_distance_range(range_str))
+            except ValueError:
+                print(f"Warning: Invalid distance range format '{range_str}'. Use format like '30-60' or '60'")
+        return ranges
 
     def load_pfm(self, file_path):
-        with open(file_path, 'rb') as f:
-            header = f.readline().decode('utf-8').rstrip()
-            if header not in ['PF', 'Pf']:
-                raise ValueError('Not a PFM file.')
-            
-            dims = f.readline().decode('utf-8').strip()
-            width, height = map(int, dims.split())
-            scale = float(f.readline().decode('utf-8').strip())
-            endian = '<' if scale < 0 else '>'
-            
-            data = np.fromfile(f, endian + 'f')
-            shape = (height, width, 3) if header == 'PF' else (height, width)
-            return np.reshape(data, shape)
-
-    def load_depth(self, path, max_distance=450, is_gt=False):
-        if path.endswith('.npy'):
-            depth = np.load(path)
-            if not is_gt and not self.args.absolute_depth:
-                depth = depth * self.max_depth
-        elif path.endswith('.png'):
-            depth = np.array(Image.open(path)).astype(np.float32)
+        """Zero-copy view of a PFM file (see pfm2npy.load_pfm_view)"""
+        flip_rows = bool(self.args and getattr(self.args, 'pfm_flip_rows', False))
+        depth, _ = load_pfm_view(file_path, flip_rows=flip_rows)
+        return depth
+
+    def cached_frame(self, gt_path):
+        """Frame of the dataset cache for a GT file, None if not cached"""
+        if self.gt_cache is None:
+            return None
+        return self.gt_cache.lookup(gt_path)
+
+    def load_depth(self, path, max_distance=450, is_gt=False, alignment=None):
+        if is_gt and self.gt_cache is not None:
+            cached = self.gt_cache.lookup(path)
+            if cached is not None:
+                return cached.depth()
+        
+        depth = None
+        packed = is_pack_frame(path)
+        if packed:
+            # Packed predictions (pred_pack.py) decode to the values of their source file
+            source = pack_frame_source(path)
+            depth = prefetch.take(path)
+            if depth is None:
+                depth = load_pack_frame(path)
+            if source == "pfm" and self.args and getattr(self.args, 'pfm_flip_rows', False):
+                depth = depth[::-1]
+        else:
+            source = "npy" if isinstance(path, np.ndarray) else os.path.splitext(path)[1][1:]
+        
+        if source == "npy":
+            # In-memory predictions (see evaluator.py) are in the units of a saved .npy prediction
+            if depth is None:
+                depth = path if isinstance(path, np.ndarray) else prefetch.take(path)
+            if depth is None:
+                depth = np.load(path)
+            if not is_gt and (alignment or self.alignment) != "absolute":
+                if packed:
+                    # A decoded pack frame is a new float32 array, scaled in place
+                    depth *= self.max_depth
+                else:
+                    depth = depth * self.max_depth
+        elif source == "png":
+            image = prefetch.take(path)
+            if image is None:
+                from PIL import Image
+                image = np.array(Image.open(path))
+            depth = image.astype(np.float32)
             if is_gt:
                 depth = depth / self.scale_factor
-        elif path.endswith('.pfm'):
-            depth = self.load_pfm(path)
+        elif source == "pfm":
+            if depth is None:
+                depth = prefetch.take(path)
+            if depth is None:
+                depth = self.load_pfm(path)
             # Apply max distance filtering for PFM
             depth = np.where(depth > max_distance, 0, depth)
             # Normalize if GT
@@ -75,13 +151,14 @@ class OptimizedDepthPreprocessor:
                 
         return depth
 
-    def apply_distance_mask(self, depth, file_path):
+    def apply_distance_mask(self, depth, file_path, distance_range=None):
         """Apply distance range mask to any depth map"""
-        if self.distance_min is None or self.distance_max is None:
+        distance_min, distance_max = distance_range or (self.distance_min, self.distance_max)
+        if distance_min is None or distance_max is None:
             return None
         
         # Create distance range mask
-        distance_mask = (depth >= self.distance_min) & (depth <= self.distance_max) & (depth > 0)
+        distance_mask = (depth >= distance_min) & (depth <= distance_max) & (depth > 0)
         
         # Log information Uncomment for detailed logging 
         # total_valid = (depth > 0).sum()
@@ -101,46 +178,102 @@ class OptimizedDepthPreprocessor:
             return pred * scale
         return pred
 
-    def process_depth(self, pred_path, gt_path=None, max_distance=100):
-        # Load depths
-        pred = self.load_depth(pred_path, is_gt=False)
+    def load_gt(self, gt_path, max_distance=100):
+        """Load and squeeze a ground truth depth map"""
         gt = self.load_depth(gt_path, max_distance=max_distance, is_gt=True)
-        
-        if pred is None or gt is None:
-            raise ValueError("Either the prediction or ground truth depth map is None")
+        if gt is None:
+            raise ValueError("The ground truth depth map is None")
+        return np.squeeze(gt)
 
-        # Squeeze and resize
+    def resize_prediction(self, pred, gt):
+        """Squeeze a prediction and resize it to the ground truth if needed"""
         pred = np.squeeze(pred)
-        gt = np.squeeze(gt)
-        
-        if self.args and self.args.resize:
-            pred = cv2.resize(pred, (gt.shape[1], gt.shape[0]), interpolation=cv2.INTER_LINEAR)
-        elif pred.shape != gt.shape:
-            pred = cv2.resize(pred, (gt.shape[1], gt.shape[0]), interpolation=cv2.INTER_LINEAR)
+        if (self.args and self.args.resize) or pred.shape != gt.shape:
+            import cv2
+            with profiling.stage("resize"):
+                pred = cv2.resize(pred, (gt.shape[1], gt.shape[0]), interpolation=cv2.INTER_LINEAR)
+            profiling.count_bytes("resize", pred.nbytes)
+        return pred
+
+    def alignment_statistics(self, pred, gt, alignment=None):
+        """Additive per-frame statistics the alignment is fitted from (see fit_alignment).
         
-        # Alignment
+        Least squares sums for relative / disparity, GT and prediction log-depth histograms for
+        median scaling; pred must already have the shape of gt.
+        """
+        alignment = alignment or self.alignment
         valid_mask = (gt > 0)
         
-        if self.args and self.args.relative_depth:
-            if self.args.disparity:
-                gt_disparity, gt_non_neg_mask = disparity2depth(disparity=gt, return_mask=True)
-                pred_non_neg_mask = pred > 0
-                valid_nonnegative_mask = valid_mask & gt_non_neg_mask & pred_non_neg_mask
-                
-                disparity_pred, _, _ = align_depth_least_square(
-                    gt_arr=gt_disparity, pred_arr=pred, valid_mask_arr=valid_nonnegative_mask)
-                disparity_pred = np.clip(disparity_pred, a_min=1e-6, a_max=None)
-                pred = disparity2depth(disparity_pred)
+        if alignment == "disparity":
+            gt_disparity, gt_non_neg_mask = disparity2depth(disparity=gt, return_mask=True)
+            pred_non_neg_mask = pred > 0
+            valid_nonnegative_mask = valid_mask & gt_non_neg_mask & pred_non_neg_mask
+            return least_square_sums(gt_disparity, pred, valid_nonnegative_mask, self.alignment_max_res)
+        if alignment == "relative":
+            return least_square_sums(gt, pred, valid_mask, self.alignment_max_res)
+        if alignment == "absolute":
+            return np.concatenate([log_depth_histogram(gt, valid_mask), log_depth_histogram(pred, valid_mask)])
+        return np.zeros(0)
+
+    def fit_alignment(self, statistics, alignment=None):
+        """(scale, shift) from statistics summed over one or more frames, None if there is nothing to fit"""
+        alignment = alignment or self.alignment
+        if alignment in ("relative", "disparity"):
+            return solve_scale_shift(statistics) if statistics[0] > 0 else None
+        if alignment == "absolute":
+            gt_hist, pred_hist = np.split(statistics, 2)
+            gt_median, pred_median = histogram_median(gt_hist), histogram_median(pred_hist)
+            if gt_median is None or not pred_median:
+                return None
+            return gt_median / pred_median, 0.0
+        return None
+
+    def align_prediction(self, pred, gt, alignment=None, scale_shift=None):
+        """Resize a prediction to the ground truth, align it and clip it to the valid depth range.
+        
+        scale_shift applies a fixed (e.g. dataset-level) alignment instead of fitting it on this frame.
+        """
+        pred = self.resize_prediction(pred, gt)
+        with profiling.stage("align"):
+            return self.align_resized(pred, gt, alignment, scale_shift)
+
+    def align_resized(self, pred, gt, alignment=None, scale_shift=None):
+        """Align a prediction of the shape of gt and clip it; also works on 1-D pixel samples"""
+        alignment = alignment or self.alignment
+        
+        # Alignment
+        if alignment in ("relative", "disparity"):
+            if scale_shift is None:
+                scale_shift = solve_scale_shift(self.alignment_statistics(pred, gt, alignment))
+            scale, shift = scale_shift
+            pred = np.asarray(pred)
+            if not np.issubdtype(pred.dtype, np.floating):
+                pred = pred.astype(np.float64)
+            # Only the least squares sums need float64; the aligned prediction keeps its precision
+            pred = pred * pred.dtype.type(scale) + pred.dtype.type(shift)
+            if alignment == "disparity":
+                pred = np.clip(pred, a_min=1e-6, a_max=None)
+                pred = disparity2depth(pred)
+        elif alignment == "absolute":
+            if scale_shift is None:
+                pred = self.apply_median_scaling(pred, gt)
             else:
-                pred, _, _ = align_depth_least_square(
-                    gt_arr=gt, pred_arr=pred, valid_mask_arr=valid_mask)
-        elif self.args and self.args.absolute_depth:
-            pred = self.apply_median_scaling(pred, gt)
+                pred = pred * scale_shift[0]
 
         # Clipping
         pred = np.clip(pred, a_min=self.min_depth, a_max=self.max_depth)
         pred = np.clip(pred, a_min=1e-6, a_max=None)
+        return pred
+
+    def process_depth(self, pred_path, gt_path=None, max_distance=100, alignment=None):
+        # Load depths
+        pred = self.load_depth(pred_path, is_gt=False, alignment=alignment)
+        gt = self.load_gt(gt_path, max_distance=max_distance)
         
+        if pred is None:
+            raise ValueError("Either the prediction or ground truth depth map is None")
+
+        pred = self.align_prediction(pred, gt, alignment)
         distance_mask = self.apply_distance_mask(gt, gt_path)
         
         return pred, gt, distance_mask
@@ -1,12 +1,389 @@
 import numpy as np
 import os
-from concurrent.futures import ProcessPoolExecutor
-from PIL import Image
-import imageio.v3 as imageio
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
 
+import prefetch
+import profiling
 
-def compute_metrics(gt, pred, distance_mask=None):
-    """Metrics computation"""
+
+METRIC_NAMES = ("Abs Rel", "Sq Rel", "RMSE", "RMSE Log", "Log10", "δ1", "δ2", "δ3", "SI_log", "F_A")
+
+# Per-frame sufficient statistics: every metric is a function of these pixel sums
+SUM_FIELDS = ("n", "abs_rel", "sq_rel", "sq_err", "log_sq", "log_abs", "log_sum", "delta1", "delta2", "delta3", "f_a")
+NUM_SUMS = len(SUM_FIELDS)
+NUM_METRICS = len(METRIC_NAMES)
+
+
+# Fused metric engine: valid pixels are gathered chunk by chunk into per-worker scratch buffers
+# and every sum is computed in place, so no full-frame temporaries are allocated.
+# "torch" evaluates whole batches of frames in the workers (torch_backend.py); frames evaluated one
+# at a time then use the numpy engine
+METRICS_BACKENDS = ("numpy", "numba", "auto", "torch")
+METRICS_DTYPES = ("auto", "float64", "float32")
+CHUNK_PIXELS = 1 << 16
+EPS = 1e-6
+THRESHOLDS = (1.25, 1.25**2, 1.25**3)
+
+_metrics_options = {"backend": "numpy", "dtype": None}
+# Options of the in-process evaluation running in a thread (see metrics_options), over _metrics_options
+_thread_options = threading.local()
+_scratch = threading.local()
+_numba_kernel = None
+
+
+def resolve_metrics_options(backend="numpy", dtype="auto"):
+    """{"backend", "dtype"} options of the metric engine for a backend and dtype choice"""
+    if backend not in METRICS_BACKENDS:
+        raise ValueError(f"Unknown metrics backend '{backend}', choose from {METRICS_BACKENDS}")
+    if backend == "auto":
+        backend = "numba" if _load_numba_kernel() is not None else "numpy"
+    elif backend == "numba" and _load_numba_kernel() is None:
+        print("Warning: numba is not installed, falling back to the numpy metrics backend")
+        backend = "numpy"
+    elif backend == "torch":
+        backend = "numpy"
+    # "auto" computes in the promoted input precision, exactly like compute_metrics_reference
+    return {"backend": backend, "dtype": None if dtype == "auto" else np.dtype(dtype)}
+
+
+def configure_metrics(backend="numpy", dtype="auto"):
+    """Select the metric backend and working precision of this process (also used as worker initializer)"""
+    _metrics_options.update(resolve_metrics_options(backend, dtype))
+
+
+@contextmanager
+def metrics_options(options):
+    """Use options (see resolve_metrics_options) for the metrics this thread computes within the block;
+    lets several in-process evaluations with different settings share a process
+    """
+    previous = getattr(_thread_options, "options", None)
+    _thread_options.options = options
+    try:
+        yield
+    finally:
+        _thread_options.options = previous
+
+
+def _options():
+    return getattr(_thread_options, "options", None) or _metrics_options
+
+
+def metrics_dtype(gt_dtype, pred_dtype):
+    """Working precision of the metric sums: the configured dtype, else the promoted input precision"""
+    return _options()["dtype"] or np.result_type(gt_dtype, pred_dtype, np.float32)
+
+
+def _get_scratch(dtype, kind="work"):
+    """Per-thread scratch buffers of CHUNK_PIXELS elements, created once per dtype"""
+    buffers = getattr(_scratch, "buffers", None)
+    if buffers is None:
+        buffers = _scratch.buffers = {}
+    key = (kind, np.dtype(dtype))
+    if key not in buffers:
+        if kind == "work":
+            buffers[key] = (
+                [np.empty(CHUNK_PIXELS, dtype=dtype) for _ in range(4)],
+                np.empty(CHUNK_PIXELS, dtype=bool),
+                np.empty(CHUNK_PIXELS, dtype=bool),
+            )
+        else:
+            buffers[key] = np.empty(CHUNK_PIXELS, dtype=dtype)
+    return buffers[key]
+
+
+def _gather(values, valid, out):
+    """Compress values[valid] into out without allocating"""
+    if values.dtype == out.dtype:
+        np.compress(valid, values, out=out)
+    else:
+        staged = _get_scratch(values.dtype, kind="staging")[:out.size]
+        np.compress(valid, values, out=staged)
+        np.copyto(out, staged, casting="unsafe")
+
+
+def _metric_sums_numpy(gt, pred, mask, dtype):
+    """Chunked, in-place NumPy implementation of the metric sums"""
+    (g_buf, p_buf, a_buf, b_buf), valid_buf, cmp_buf = _get_scratch(dtype)
+    gt_flat = gt.reshape(-1)
+    pred_flat = pred.reshape(-1)
+    mask_flat = None if mask is None else mask.reshape(-1)
+    sums = np.zeros(NUM_SUMS, dtype=np.float64)
+    
+    for start in range(0, gt_flat.size, CHUNK_PIXELS):
+        stop = min(start + CHUNK_PIXELS, gt_flat.size)
+        valid = valid_buf[:stop - start]
+        np.greater(gt_flat[start:stop], 0, out=valid)
+        if mask_flat is not None:
+            np.logical_and(valid, mask_flat[start:stop], out=valid)
+        k = np.count_nonzero(valid)
+        if k == 0:
+            continue
+        
+        g, p, a, b, c = g_buf[:k], p_buf[:k], a_buf[:k], b_buf[:k], cmp_buf[:k]
+        _gather(gt_flat[start:stop], valid, g)
+        _gather(pred_flat[start:stop], valid, p)
+        
+        # Ensure positive values
+        np.maximum(g, EPS, out=g)
+        np.maximum(p, EPS, out=p)
+        
+        sums[0] += k
+        
+        # Threshold accuracy on max(gt / pred, pred / gt)
+        np.divide(g, p, out=a)
+        np.divide(p, g, out=b)
+        np.maximum(a, b, out=a)
+        for i, threshold in enumerate(THRESHOLDS):
+            sums[7 + i] += np.count_nonzero(np.less(a, threshold, out=c))
+        
+        np.subtract(g, p, out=a)
+        np.abs(a, out=b)
+        sums[10] += np.count_nonzero(np.less(b, 0.5, out=c))
+        np.divide(b, g, out=b)
+        sums[1] += b.sum(dtype=np.float64)
+        np.multiply(a, a, out=a)
+        sums[3] += a.sum(dtype=np.float64)
+        np.divide(a, g, out=a)
+        sums[2] += a.sum(dtype=np.float64)
+        
+        # log(pred) - log(gt), each log computed once
+        np.log(p, out=a)
+        np.log(g, out=b)
+        np.subtract(a, b, out=a)
+        sums[6] += a.sum(dtype=np.float64)
+        np.abs(a, out=b)
+        sums[5] += b.sum(dtype=np.float64)
+        np.multiply(a, a, out=a)
+        sums[4] += a.sum(dtype=np.float64)
+    
+    return sums
+
+
+def _load_numba_kernel():
+    """Compile the numba metric kernel on first use; None if numba is unavailable"""
+    global _numba_kernel
+    if _numba_kernel is not None:
+        return _numba_kernel
+    try:
+        import numba
+    except ImportError:
+        return None
+    
+    # consts = (eps, t1, t2, t3) in the working dtype so scalar math stays in that precision
+    @numba.njit(cache=True, nogil=True)
+    def kernel(gt, pred, mask, use_mask, consts, sums):
+        eps, t1, t2, t3 = consts[0], consts[1], consts[2], consts[3]
+        for i in range(gt.size):
+            g = gt[i]
+            if not g > 0:
+                continue
+            if use_mask and not mask[i]:
+                continue
+            g = max(g, eps)
+            p = max(pred[i], eps)
+            thresh = max(g / p, p / g)
+            e = g - p
+            ae = abs(e)
+            d = np.log(p) - np.log(g)
+            sums[0] += 1
+            sums[1] += ae / g
+            sums[2] += e * e / g
+            sums[3] += e * e
+            sums[4] += d * d
+            sums[5] += abs(d)
+            sums[6] += d
+            sums[7] += thresh < t1
+            sums[8] += thresh < t2
+            sums[9] += thresh < t3
+            sums[10] += ae < 0.5
+    
+    _numba_kernel = kernel
+    return _numba_kernel
+
+
+def _metric_sums_numba(gt, pred, mask, dtype):
+    """Single-loop numba implementation of the metric sums"""
+    kernel = _load_numba_kernel()
+    sums = np.zeros(NUM_SUMS, dtype=np.float64)
+    mask_flat = np.ones(1, dtype=bool) if mask is None else np.ascontiguousarray(mask).reshape(-1)
+    consts = np.array((EPS,) + THRESHOLDS, dtype=dtype)
+    kernel(np.ascontiguousarray(gt, dtype=dtype).reshape(-1),
+           np.ascontiguousarray(pred, dtype=dtype).reshape(-1),
+           mask_flat, mask is not None, consts, sums)
+    return sums
+
+
+def compute_metric_sums(gt, pred, distance_mask=None, verbose=True):
+    """Sufficient statistics (see SUM_FIELDS) of one frame, or None if too few valid pixels"""
+    if gt.shape != pred.shape:
+        raise ValueError(f"Shape mismatch: GT shape {gt.shape} and pred shape {pred.shape}")
+    
+    dtype = metrics_dtype(gt.dtype, pred.dtype)
+    if _options()["backend"] == "numba":
+        sums = _metric_sums_numba(gt, pred, distance_mask, dtype)
+    else:
+        sums = _metric_sums_numpy(gt, pred, distance_mask, dtype)
+    
+    min_valid_pixels = gt.shape[0] * gt.shape[1] * 0.001
+    
+    if sums[0] < min_valid_pixels:
+        if verbose:
+            print("Warning: Too few valid pixels for reliable metrics")
+        return None
+    
+    return sums
+
+
+# Uniform distance bins [start, start + step), ... up to stop over the GT depth
+DistanceBins = namedtuple("DistanceBins", ["start", "stop", "step"])
+
+
+def distance_bin_edges(bins):
+    """Bin edges of DistanceBins (num_bins + 1 values)"""
+    num_bins = int(round((bins.stop - bins.start) / bins.step))
+    return bins.start + bins.step * np.arange(num_bins + 1)
+
+
+def distance_bin_index(gt, bins):
+    """Bin of every GT pixel, -1 outside [start, stop); the last bin includes stop"""
+    num_bins = len(distance_bin_edges(bins)) - 1
+    index = np.floor((gt - bins.start) / bins.step).astype(np.intp)
+    index[gt == bins.stop] = num_bins - 1
+    index[(index < 0) | (index >= num_bins)] = -1
+    return index, num_bins
+
+
+def _pixel_terms(gt, pred, valid):
+    """Per-pixel metric terms of the valid pixels for grouped sums.
+    
+    Returns the weighted terms (ordered as SUM_FIELDS[1:7]) and a count category per pixel:
+    number of thresholds exceeded (0-3) + 4 if |gt - pred| >= 0.5, from which n, delta1-3 and
+    f_a follow with a single unweighted bincount.
+    """
+    if gt.shape != pred.shape:
+        raise ValueError(f"Shape mismatch: GT shape {gt.shape} and pred shape {pred.shape}")
+    
+    dtype = metrics_dtype(gt.dtype, pred.dtype)
+    g = np.maximum(gt[valid].astype(dtype, copy=False), EPS)
+    p = np.maximum(pred[valid].astype(dtype, copy=False), EPS)
+    
+    e = g - p
+    ae = np.abs(e)
+    d = np.log(p) - np.log(g)
+    ratio = np.maximum(g / p, p / g)
+    terms = (ae / g, e * e / g, e * e, d * d, np.abs(d), d)
+    category = (ratio >= THRESHOLDS[0]).astype(np.intp)
+    category += ratio >= THRESHOLDS[1]
+    category += ratio >= THRESHOLDS[2]
+    category += 4 * (ae >= 0.5)
+    return terms, category
+
+
+def _bincount_sums(index, num_bins, terms, category, weights=None):
+    """[num_bins, NUM_SUMS] sums of the pixels grouped by index; index == num_bins is dropped.
+    
+    With weights every pixel counts weights[i] times (sampled pixels, see sampling.py).
+    """
+    sums = np.zeros((num_bins, NUM_SUMS), dtype=np.float64)
+    for field, term in enumerate(terms, start=1):
+        term = term if weights is None else term * weights
+        sums[:, field] = np.bincount(index, weights=term, minlength=num_bins + 1)[:num_bins]
+    counts = np.bincount(index * 8 + category, weights=weights, minlength=(num_bins + 1) * 8)
+    counts = counts[:num_bins * 8].reshape(num_bins, 2, 4)
+    sums[:, 0] = counts.sum(axis=(1, 2))
+    sums[:, 7:10] = counts.sum(axis=1).cumsum(axis=1)[:, :3]
+    sums[:, 10] = counts[:, 0].sum(axis=1)
+    return sums
+
+
+def compute_binned_metric_sums(gt, pred, bin_index, num_bins, masks=(None,)):
+    """Sufficient statistics per bin in one vectorised pass: [len(masks), num_bins, NUM_SUMS].
+    
+    Per-pixel terms are computed once and summed per bin with np.bincount for every mask
+    (None = unrestricted). Bins with too few valid pixels (as in compute_metric_sums) are zeroed.
+    """
+    valid = (gt > 0) & (bin_index >= 0)
+    index = bin_index[valid]
+    terms, category = _pixel_terms(gt, pred, valid)
+    
+    sums = np.zeros((len(masks), num_bins, NUM_SUMS), dtype=np.float64)
+    for s, mask in enumerate(masks):
+        # Pixels outside the mask go to an extra bin that is dropped
+        slice_index = index if mask is None else np.where(mask[valid], index, num_bins)
+        sums[s] = _bincount_sums(slice_index, num_bins, terms, category)
+    
+    min_valid_pixels = gt.shape[0] * gt.shape[1] * 0.001
+    sums[sums[..., 0] < min_valid_pixels] = 0
+    return sums
+
+
+# Dark mask thresholds covered by a shadow sweep: the mask at threshold t is {intensity < t}
+SWEEP_THRESHOLDS = 256
+
+
+def compute_shadow_sweep_sums(gt, pred, levels, masks=(None,)):
+    """Sums inside and outside the dark mask {level < t} for every threshold t in 0-255 at once.
+    
+    levels holds one uint8 intensity image per variant (e.g. per opening kernel, see
+    generate_dark_mask.opening_levels). Pixels are bucketed by intensity with np.bincount and the
+    inside sums are exclusive cumulative sums over the buckets. Returns
+    [len(masks), len(levels), 2 (in, out), SWEEP_THRESHOLDS, NUM_SUMS]; sparse entries are zeroed.
+    """
+    valid = gt > 0
+    terms, category = _pixel_terms(gt, pred, valid)
+    
+    sums = np.zeros((len(masks), len(levels), 2, SWEEP_THRESHOLDS, NUM_SUMS), dtype=np.float64)
+    for k, level in enumerate(levels):
+        level_index = level[valid].astype(np.intp)
+        for s, mask in enumerate(masks):
+            index = level_index if mask is None else np.where(mask[valid], level_index, SWEEP_THRESHOLDS)
+            buckets = _bincount_sums(index, SWEEP_THRESHOLDS, terms, category)
+            cumulative = np.cumsum(buckets, axis=0)
+            sums[s, k, 0, 1:] = cumulative[:-1]
+            sums[s, k, 1] = cumulative[-1] - sums[s, k, 0]
+    
+    min_valid_pixels = gt.shape[0] * gt.shape[1] * 0.001
+    sums[sums[..., 0] < min_valid_pixels] = 0
+    return sums
+
+
+def metric_values_from_sums(sums):
+    """Metric values (ordered as METRIC_NAMES) from sufficient statistics; works on stacked sums too"""
+    sums = np.asarray(sums, dtype=np.float64)
+    n = sums[..., 0]
+    mean = sums[..., 1:] / n[..., None]
+    abs_rel, sq_rel, sq_err, log_sq, log_abs, log_sum, delta1, delta2, delta3, f_a = np.moveaxis(mean, -1, 0)
+    return np.stack([
+        abs_rel,
+        sq_rel,
+        np.sqrt(sq_err),
+        np.sqrt(log_sq),
+        log_abs / np.log(10),
+        delta1,
+        delta2,
+        delta3,
+        log_sq - log_sum**2,
+        f_a,
+    ], axis=-1)
+
+
+def metrics_from_sums(sums):
+    """Metric dict from sufficient statistics"""
+    return dict(zip(METRIC_NAMES, metric_values_from_sums(sums).tolist()))
+
+
+def compute_metrics(gt, pred, distance_mask=None, verbose=True):
+    """Metrics computation; distance_mask may be any boolean mask restricting the valid pixels"""
+    sums = compute_metric_sums(gt, pred, distance_mask, verbose=verbose)
+    if sums is None:
+        return None
+    return metrics_from_sums(sums)
+
+
+def compute_metrics_reference(gt, pred, distance_mask=None):
+    """Straightforward metrics computation, kept as the reference for the fused engine"""
     if gt.shape != pred.shape:
         raise ValueError(f"Shape mismatch: GT shape {gt.shape} and pred shape {pred.shape}")
     
@@ -19,7 +396,6 @@ def compute_metrics(gt, pred, distance_mask=None):
     min_valid_pixels = gt.shape[0] * gt.shape[1] * 0.001
     
     if valid_mask.sum() < min_valid_pixels:
-        print("Warning: Too few valid pixels for reliable metrics")
         return None
 
     gt_valid = gt[valid_mask]
@@ -47,41 +423,251 @@ def compute_metrics(gt, pred, distance_mask=None):
     
     f_a = np.mean(np.abs(gt_valid - pred_valid) < 0.5)
     
-    return {
-        "Abs Rel": abs_rel,
-        "Sq Rel": sq_rel,
-        "RMSE": rmse,
-        "RMSE Log": rmse_log,
-        "Log10": log10,
-        "δ1": delta1,
-        "δ2": delta2,
-        "δ3": delta3,
-        "SI_log": si_log,
-        "F_A": f_a
-    }
+    return dict(zip(METRIC_NAMES, (abs_rel, sq_rel, rmse, rmse_log, log10,
+                                   delta1, delta2, delta3, si_log, f_a)))
 
 
-def apply_shadow_mask(pred, gt, pred_file, shadow_mask_dir):
-    """Apply shadow mask to prediction and ground truth"""
+class MetricAccumulator:
+    """Mergeable metric statistics of one evaluation slice.
+    
+    Everything lives in a single float64 array: the pixel sums (SUM_FIELDS), the number of
+    images, and the sum and squared sum of the per-image metrics. Accumulators merge by
+    addition, so partial results from workers, shards or reruns combine in any order.
+    """
+    __slots__ = ("stats",)
+    
+    SIZE = NUM_SUMS + 1 + 2 * NUM_METRICS
+    
+    def __init__(self, stats=None):
+        if stats is None:
+            self.stats = np.zeros(self.SIZE, dtype=np.float64)
+        else:
+            self.stats = np.array(stats, dtype=np.float64).reshape(self.SIZE)
+    
+    @property
+    def n_images(self):
+        return int(self.stats[NUM_SUMS])
+    
+    @property
+    def n_pixels(self):
+        return int(self.stats[0])
+    
+    def add_frame(self, sums):
+        """Add the sufficient statistics of one frame in place"""
+        values = metric_values_from_sums(sums)
+        self.stats[:NUM_SUMS] += sums
+        self.stats[NUM_SUMS] += 1
+        self.stats[NUM_SUMS + 1:NUM_SUMS + 1 + NUM_METRICS] += values
+        self.stats[NUM_SUMS + 1 + NUM_METRICS:] += np.square(values)
+        return self
+    
+    def merge(self, other):
+        """Merge another accumulator in place"""
+        self.stats += other.stats
+        return self
+    
+    __iadd__ = merge
+    
+    def __add__(self, other):
+        return MetricAccumulator(self.stats + other.stats)
+    
+    def __reduce__(self):
+        return (MetricAccumulator, (self.stats,))
+    
+    def image_metrics(self):
+        """Metrics averaged over images (the classic per-image mean)"""
+        if self.n_images == 0:
+            return None
+        means = self.stats[NUM_SUMS + 1:NUM_SUMS + 1 + NUM_METRICS] / self.n_images
+        return dict(zip(METRIC_NAMES, means.tolist()))
+    
+    def image_std(self):
+        """Standard deviation of the per-image metrics"""
+        if self.n_images == 0:
+            return None
+        means = self.stats[NUM_SUMS + 1:NUM_SUMS + 1 + NUM_METRICS] / self.n_images
+        sq_means = self.stats[NUM_SUMS + 1 + NUM_METRICS:] / self.n_images
+        return dict(zip(METRIC_NAMES, np.sqrt(np.maximum(sq_means - means**2, 0)).tolist()))
+    
+    def pixel_metrics(self):
+        """Metrics weighted by pixel, i.e. computed over all valid pixels of all images"""
+        if self.n_pixels == 0:
+            return None
+        return metrics_from_sums(self.stats[:NUM_SUMS])
+    
+    def metrics(self, pixel_weighted=False):
+        return self.pixel_metrics() if pixel_weighted else self.image_metrics()
+
+
+class MetricCurve:
+    """MetricAccumulator statistics for every point of a curve, updated in one vectorised step"""
+    
+    def __init__(self, point_names, stats=None):
+        self.point_names = list(point_names)
+        size = (len(self.point_names), MetricAccumulator.SIZE)
+        self.stats = np.zeros(size, dtype=np.float64) if stats is None else np.array(stats, dtype=np.float64).reshape(size)
+    
+    def add_frame(self, point_sums):
+        """Add one frame's [num_points, NUM_SUMS] sums; empty points do not count as images"""
+        present = point_sums[:, 0] > 0
+        sums = point_sums[present]
+        values = metric_values_from_sums(sums)
+        stats = self.stats[present]
+        stats[:, :NUM_SUMS] += sums
+        stats[:, NUM_SUMS] += 1
+        stats[:, NUM_SUMS + 1:NUM_SUMS + 1 + NUM_METRICS] += values
+        stats[:, NUM_SUMS + 1 + NUM_METRICS:] += np.square(values)
+        self.stats[present] = stats
+        return self
+    
+    def merge(self, other):
+        self.stats += other.stats
+        return self
+    
+    __iadd__ = merge
+    
+    def accumulators(self):
+        """{point name: MetricAccumulator}"""
+        return {name: MetricAccumulator(stats) for name, stats in zip(self.point_names, self.stats)}
+
+
+class DistanceCurve(MetricCurve):
+    """MetricCurve over the bins of DistanceBins"""
+    
+    def __init__(self, bins, stats=None):
+        self.bins = bins
+        self.edges = distance_bin_edges(bins)
+        super().__init__([f"{lo:g}-{hi:g}" for lo, hi in zip(self.edges[:-1], self.edges[1:])], stats)
+
+
+class ShadowSweepCurve(MetricCurve):
+    """MetricCurve over every dark mask threshold, inside and outside the mask, for one opening kernel"""
+    
+    REGIONS = ("in", "out")
+    
+    def __init__(self, kernel, stats=None):
+        self.kernel = kernel
+        super().__init__([f"t={t} | {region}" for region in self.REGIONS for t in range(SWEEP_THRESHOLDS)], stats)
+    
+    def add_frame(self, point_sums):
+        """Add one frame's [2, SWEEP_THRESHOLDS, NUM_SUMS] sums"""
+        return super().add_frame(np.reshape(point_sums, (-1, NUM_SUMS)))
+    
+    def accumulator(self, threshold, region):
+        return MetricAccumulator(self.stats[self.REGIONS.index(region) * SWEEP_THRESHOLDS + threshold])
+
+
+LABEL_COLORS = {
+    "obstacle": (232, 250, 80),
+    "crater": (120, 0, 200),
+    "mountain": (173, 69, 31),
+    "ground": (187, 70, 156),
+}
+
+# Class ids used by packed label maps, 0 = unlabelled
+LABEL_CLASS_IDS = {label: class_id for class_id, label in enumerate(LABEL_COLORS, start=1)}
+
+SHADOW_REGIONS = ("in", "out")
+
+# One evaluation slice: label class (None = all pixels), shadow region (None, "in" or "out")
+# and distance range as a (min, max) tuple (None = no distance filtering)
+EvalSlice = namedtuple("EvalSlice", ["label", "shadow", "distance_range", "shadow_kernel"], defaults=(None,))
+
+
+def build_slices(labels=None, shadow_regions=None, distance_ranges=None, shadow_kernels=None):
+    """Cartesian product of the requested labels, shadow regions (per dark mask kernel size) and distance ranges"""
+    labels = [None if label is None or label.lower() == "all" else label.lower()
+              for label in (labels or [None])]
+    shadows = [(shadow, kernel) for shadow in (shadow_regions or [None])
+               for kernel in (shadow_kernels if shadow is not None and shadow_kernels else [None])]
+    return [EvalSlice(label, shadow, distance_range, kernel)
+            for label in labels
+            for shadow, kernel in shadows
+            for distance_range in (distance_ranges or [None])]
+
+
+def slice_name(eval_slice):
+    """Human readable name of an evaluation slice"""
+    parts = [eval_slice.label or "all"]
+    if eval_slice.shadow is not None:
+        kernel = f"-k{eval_slice.shadow_kernel}" if eval_slice.shadow_kernel is not None else ""
+        parts.append(f"shadow-{eval_slice.shadow}{kernel}")
+    if eval_slice.distance_range is not None:
+        parts.append("{:g}-{:g}".format(*eval_slice.distance_range))
+    return " | ".join(parts)
+
+
+def load_shadow_mask(pred_file, shadow_mask_dir):
+    """Load the shadow mask of a frame as a boolean array (True where the mask is non-zero)"""
     if not shadow_mask_dir:
-        return pred, gt
+        return None
     
     base_name = os.path.splitext(pred_file)[0]
     shadow_path = os.path.join(shadow_mask_dir, f"{base_name}.png")
     
     if not os.path.exists(shadow_path):
-        return pred, gt
+        return None
     
-    # Load and apply shadow mask
-    shadow_img = Image.open(shadow_path)
-    shadow = np.array(shadow_img).astype(np.float32)
-    shadow_mask = (shadow == 0)  
+    image = prefetch.take(shadow_path)
+    if image is None:
+        from PIL import Image
+        image = np.array(Image.open(shadow_path))
+    return image != 0
+
+
+def load_label_image(pred_file, labeling_path):
+    """Load the RGB label map of a frame"""
+    if not labeling_path:
+        return None
+    
+    base_name = os.path.splitext(pred_file)[0]
+    label_file_path = os.path.join(labeling_path, f"{base_name}.png")
+    
+    if not os.path.exists(label_file_path):
+        print(f"Labeling png file not found: {label_file_path}")
+        return None
+    
+    image = prefetch.take(label_file_path)
+    if image is None:
+        import imageio.v3 as imageio
+        image = imageio.imread(label_file_path)
+    return image
+
+
+def label_mask(labeling_img, labeling_type):
+    """Boolean mask of the pixels belonging to the given label class"""
+    target_color = LABEL_COLORS.get(labeling_type.lower())
+    if target_color is None:
+        print(f"Invalid labeling type: {labeling_type}")
+        print(f"Valid types: {', '.join(LABEL_COLORS)}")
+        return None
+    
+    return np.all(labeling_img[..., :3] == target_color, axis=-1)
+
+
+def label_ids_from_rgb(labeling_img):
+    """Convert an RGB label map to a uint8 class-id map (see LABEL_CLASS_IDS)"""
+    # Colors are packed into 24-bit codes and looked up in the sorted palette in one pass
+    rgb = labeling_img[..., :3].astype(np.uint32)
+    codes = (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+    palette = np.array([(r << 16) | (g << 8) | b for r, g, b in LABEL_COLORS.values()], dtype=np.uint32)
+    order = np.argsort(palette)
+    position = np.minimum(np.searchsorted(palette[order], codes), len(palette) - 1)
+    ids = np.array([LABEL_CLASS_IDS[label] for label in LABEL_COLORS], dtype=np.uint8)[order]
+    return np.where(palette[order][position] == codes, ids[position], 0).astype(np.uint8)
+
+
+def apply_shadow_mask(pred, gt, pred_file, shadow_mask_dir):
+    """Apply shadow mask to prediction and ground truth"""
+    shadow = load_shadow_mask(pred_file, shadow_mask_dir)
+    if shadow is None:
+        return pred, gt
     
     # Apply mask
     pred = pred.copy()
     gt = gt.copy()
-    pred[shadow_mask] = 0
-    gt[shadow_mask] = 0
+    pred[~shadow] = 0
+    gt[~shadow] = 0
     
     return pred, gt
 
@@ -91,121 +677,410 @@ def apply_labeling_mask(pred, gt, pred_file, labeling_type, labeling_path):
     if not labeling_type or not labeling_path:
         return pred, gt
     
-    base_name = os.path.splitext(pred_file)[0]
-    label_file_path = os.path.join(labeling_path, f"{base_name}.png")
-    
-    if not os.path.exists(label_file_path):
-        print(f"Labeling png file not found: {label_file_path}")
+    labeling_img = load_label_image(pred_file, labeling_path)
+    if labeling_img is None:
         return pred, gt
     
-    # Color definitions
-    OBSTACLE_COLOR = (232, 250, 80)
-    CRATER_COLOR = (120, 0, 200)
-    MOUNTAIN_COLOR = (173, 69, 31)
-    GROUND_COLOR = (187, 70, 156)
-    
-    labeling_img = imageio.imread(label_file_path)
-    
-    # Select target color based on labeling type
-    labeling_type_lower = labeling_type.lower()
-    if labeling_type_lower == "obstacle":
-        target_color = OBSTACLE_COLOR
-    elif labeling_type_lower == "crater":
-        target_color = CRATER_COLOR
-    elif labeling_type_lower == "mountain":
-        target_color = MOUNTAIN_COLOR
-    elif labeling_type_lower == "ground":
-        target_color = GROUND_COLOR
-    else:
-        print(f"Invalid labeling type: {labeling_type}")
-        print("Valid types: obstacle, crater, mountain, ground")
+    labeling = label_mask(labeling_img, labeling_type)
+    if labeling is None:
         return pred, gt
     
-    # Create labeling mask
-    labeling_mask = np.all(labeling_img == target_color, axis=-1)
-    labeling_mask = np.invert(labeling_mask)
-    
     # Apply mask
     pred = pred.copy()
     gt = gt.copy()
-    pred[labeling_mask] = 0
-    gt[labeling_mask] = 0
+    pred[~labeling] = 0
+    gt[~labeling] = 0
     
     return pred, gt
 
 
+def build_slice_masks(gt, pred_file, slices, preprocessor, shadow_mask_dir=None, labeling_path=None,
+                      gt_path=None, class_ids=None):
+    """Build one boolean mask per slice (None = unrestricted); every mask source is loaded once.
+    
+    class_ids is an already loaded class id map of the frame (see label_ids_from_rgb).
+    """
+    cached = preprocessor.cached_frame(gt_path) if gt_path else None
+    
+    shadow = None
+    if any(s.shadow is not None and s.shadow_kernel is None for s in slices):
+        if cached is not None and cached.has_shadow_from(shadow_mask_dir):
+            shadow = cached.shadow()
+        else:
+            shadow = load_shadow_mask(pred_file, shadow_mask_dir)
+    
+    # Dark masks computed from the RGB image, one per kernel size (see generate_dark_mask.DarkMaskSource)
+    dark_masks = None
+    if any(s.shadow_kernel is not None for s in slices) and preprocessor.dark_masks is not None:
+        dark_masks = preprocessor.dark_masks.masks(pred_file)
+    
+    labeling_img = None
+    if class_ids is None and any(s.label is not None for s in slices):
+        if cached is not None and cached.has_labels_from(labeling_path):
+            class_ids = cached.class_ids()
+        else:
+            labeling_img = load_label_image(pred_file, labeling_path)
+    
+    shadow_masks = {}
+    if shadow is not None:
+        shadow_masks = {("in", None): shadow, ("out", None): ~shadow}
+    for kernel, dark_mask in (dark_masks or {}).items():
+        shadow_masks[("in", kernel)] = dark_mask
+        shadow_masks[("out", kernel)] = ~dark_mask
+    label_masks = {}
+    distance_masks = {}
+    
+    masks = []
+    for eval_slice in slices:
+        components = []
+        if eval_slice.label is not None and (labeling_img is not None or class_ids is not None):
+            if eval_slice.label not in label_masks:
+                if class_ids is not None and eval_slice.label in LABEL_CLASS_IDS:
+                    label_masks[eval_slice.label] = class_ids == LABEL_CLASS_IDS[eval_slice.label]
+                elif labeling_img is not None:
+                    label_masks[eval_slice.label] = label_mask(labeling_img, eval_slice.label)
+                else:
+                    label_masks[eval_slice.label] = None
+            components.append(label_masks[eval_slice.label])
+        if eval_slice.shadow is not None:
+            components.append(shadow_masks.get((eval_slice.shadow, eval_slice.shadow_kernel)))
+        if eval_slice.distance_range is not None:
+            if eval_slice.distance_range not in distance_masks:
+                distance_masks[eval_slice.distance_range] = preprocessor.apply_distance_mask(
+                    gt, pred_file, distance_range=eval_slice.distance_range)
+            components.append(distance_masks[eval_slice.distance_range])
+        
+        components = [c for c in components if c is not None]
+        mask = None
+        for component in components:
+            mask = component if mask is None else mask & component
+        masks.append(mask)
+    
+    return masks
+
+
+def prediction_name(gt_path, pred_path):
+    """File name the masks of a frame are looked up by: the prediction's, or the GT's for in-memory predictions"""
+    return os.path.basename(pred_path if isinstance(pred_path, str) else gt_path)
+
+
+# A prediction source: name, prediction paths paired with the GT list and alignment mode
+# (None = the preprocessor's mode from the command line flags)
+EvalModel = namedtuple("EvalModel", ["name", "pred_paths", "alignment"])
+
+
+def process_frame(args):
+    """Load a GT frame and its masks once, then evaluate every model's prediction on every slice.
+    
+    Returns one entry per model (None if that prediction failed) holding the per-slice sums,
+    followed by the per-slice [num_bins, NUM_SUMS] binned sums if distance_bins is set and the
+    per-slice [kernels, 2, SWEEP_THRESHOLDS, NUM_SUMS] shadow sweep sums if shadow_sweep is set.
+    scale_shifts optionally holds a fixed (dataset-level) alignment per model.
+    With a sample (sampling.PixelSample) only a stratified subsample of the pixels is aligned and
+    evaluated, and every slice holds [1 + REPLICATE_GROUPS, NUM_SUMS] estimated sums instead.
+    """
+    (gt_path, pred_paths, alignments, preprocessor, max_distance, shadow_mask_dir,
+     labeling_path, slices, verbose, scale_shifts, distance_bins, shadow_sweep, sample) = args
+    scale_shifts = scale_shifts or [None] * len(pred_paths)
+    pred_file = prediction_name(gt_path, pred_paths[0])
+    if sample is not None:
+        from sampling import align_sample, draw_pixel_sample, frame_class_ids, sampled_metric_sums
+    
+    with profiling.stage("frame"):
+        try:
+            with profiling.stage("decode_gt"):
+                gt = preprocessor.load_gt(gt_path, max_distance)
+            profiling.count_bytes("decode_gt", gt.nbytes)
+            # Masks are looked up by the file name of the first prediction, as for a single model
+            # (pred_paths may also hold arrays, see evaluator.py)
+            with profiling.stage("mask"):
+                class_ids = None
+                if sample is not None:
+                    # Label classes are strata of the sample, loaded once for the masks too
+                    class_ids = frame_class_ids(pred_file, preprocessor, labeling_path, gt_path)
+                masks = build_slice_masks(gt, pred_file, slices, preprocessor,
+                                          shadow_mask_dir, labeling_path, gt_path=gt_path, class_ids=class_ids)
+            profiling.count_bytes("mask", sum(mask.nbytes for mask in masks if mask is not None))
+            if distance_bins is not None:
+                bin_index, num_bins = distance_bin_index(gt, distance_bins)
+            if shadow_sweep is not None:
+                with profiling.stage("shadow_levels"):
+                    levels = preprocessor.dark_masks.levels(pred_file, shadow_sweep)
+                if levels is None:
+                    raise FileNotFoundError(f"no RGB image for {pred_file}")
+                levels = [levels[k] for k in shadow_sweep]
+            if sample is not None:
+                with profiling.stage("sample"):
+                    sample_state = draw_pixel_sample(gt, sample, class_ids, os.path.basename(gt_path))
+                    full_gt = gt
+                    gt = gt.reshape(-1)[sample_state[0]]
+                    masks = [None if mask is None else mask.reshape(-1)[sample_state[0]] for mask in masks]
+                min_valid_pixels = full_gt.shape[0] * full_gt.shape[1] * 0.001
+        except Exception as e:
+            print(f"Error processing {gt_path}: {e}")
+            return None
+        
+        results = []
+        for pred_path, alignment, scale_shift in zip(pred_paths, alignments, scale_shifts):
+            try:
+                with profiling.stage("decode_pred"):
+                    pred = preprocessor.load_depth(pred_path, is_gt=False, alignment=alignment)
+                profiling.count_bytes("decode_pred", pred.nbytes)
+                if sample is not None:
+                    pred = preprocessor.resize_prediction(pred, full_gt).reshape(-1)[sample_state[0]]
+                    with profiling.stage("align"):
+                        pred, replicate_pred = align_sample(preprocessor, pred, gt, sample_state[2], alignment,
+                                                            scale_shift)
+                    with profiling.stage("metrics"):
+                        results.append(sampled_metric_sums(gt, pred, replicate_pred, *sample_state[1:], masks,
+                                                           min_valid_pixels))
+                    continue
+                pred = preprocessor.align_prediction(pred, gt, alignment, scale_shift)
+                with profiling.stage("metrics"):
+                    model_result = [compute_metric_sums(gt, pred, mask, verbose=verbose) for mask in masks]
+                if distance_bins is not None:
+                    with profiling.stage("distance_bins"):
+                        model_result.extend(compute_binned_metric_sums(gt, pred, bin_index, num_bins, masks))
+                if shadow_sweep is not None:
+                    with profiling.stage("shadow_sweep"):
+                        model_result.extend(compute_shadow_sweep_sums(gt, pred, levels, masks))
+                results.append(model_result)
+            except Exception as e:
+                print(f"Error processing {pred_path if isinstance(pred_path, str) else pred_file}: {e}")
+                results.append(None)
+    
+    return results
+
+
+def process_alignment_frame(args):
+    """First pass of the dataset-level alignment: per-model alignment statistics of one frame"""
+    gt_path, pred_paths, alignments, preprocessor, max_distance = args
+    
+    try:
+        with profiling.stage("decode_gt"):
+            gt = preprocessor.load_gt(gt_path, max_distance)
+        profiling.count_bytes("decode_gt", gt.nbytes)
+    except Exception as e:
+        print(f"Error processing {gt_path}: {e}")
+        return None
+    
+    results = []
+    for pred_path, alignment in zip(pred_paths, alignments):
+        try:
+            with profiling.stage("decode_pred"):
+                pred = preprocessor.load_depth(pred_path, is_gt=False, alignment=alignment)
+            profiling.count_bytes("decode_pred", pred.nbytes)
+            pred = preprocessor.resize_prediction(pred, gt)
+            with profiling.stage("alignment_statistics"):
+                results.append(preprocessor.alignment_statistics(pred, gt, alignment))
+        except Exception as e:
+            print(f"Error processing {pred_path}: {e}")
+            results.append(None)
+    
+    return results
+
+
 def process_single_pair(args):
     """Process single depth pair for parallel execution with masking support"""
     (pred_path, gt_path, preprocessor, max_distance, 
      shadow_mask_dir, labeling_type, labeling_path) = args
     
-    try:
-        result = preprocessor.process_depth(pred_path, gt_path, max_distance)
-        
-        if len(result) == 3:
-            pred, gt, distance_mask = result
-        else:
-            pred, gt = result
-            distance_mask = None
-            
-        if pred is None or gt is None:
-            return None
-        
-        # Get filename for mask processing
-        pred_file = os.path.basename(pred_path)
-        
-        # Apply shadow mask if provided
-        pred, gt = apply_shadow_mask(pred, gt, pred_file, shadow_mask_dir)
-        
-        # Apply labeling mask if provided
-        pred, gt = apply_labeling_mask(pred, gt, pred_file, labeling_type, labeling_path)
+    eval_slice = EvalSlice(
+        labeling_type.lower() if labeling_type and labeling_path else None,
+        "in" if shadow_mask_dir else None,
+        (preprocessor.distance_min, preprocessor.distance_max) if preprocessor.distance_min is not None else None,
+    )
+    result = process_frame((
+        gt_path, [pred_path], [None], preprocessor, max_distance,
+        shadow_mask_dir, labeling_path, [eval_slice], True, None, None, None, None
+    ))
+    if result is None or result[0] is None or result[0][0] is None:
+        return None
+    return metrics_from_sums(result[0][0])
+
+
+def evaluate_models_parallel(gt_paths, models, preprocessor, slices, max_distance=100,
+                             num_workers=4, shadow_mask_dir=None, labeling_path=None,
+                             metrics_backend="numpy", metrics_dtype="auto", progress_interval=5.0,
+                             global_alignment=False, result_cache=None, frame_log=None,
+                             distance_bins=None, distance_curves=None, shadow_sweep=None,
+                             shadow_sweep_curves=None, frame_stats=None, torch_batch_size=8, sample=None,
+                             sample_replicates=None, io_threads=0, io_readahead=4, torch_threads=None):
+    """Single pass over the GT frames evaluating every model on every slice.
+    
+    With global_alignment a first pass accumulates the alignment statistics of the whole
+    sequence and every model is evaluated with one fitted scale/shift instead of per-frame fits.
+    With a result_cache (see result_cache.py) only frames without cached results are evaluated.
+    A frame_log (see frame_metrics.py) receives every frame's per-slice sums as they arrive, and so
+    does frame_stats (see bootstrap.py).
+    With distance_bins, the dict distance_curves is filled with a DistanceCurve per (model name, slice name).
+    With shadow_sweep (opening kernel sizes, needs preprocessor.dark_masks), the dict shadow_sweep_curves
+    is filled with a ShadowSweepCurve per (model name, slice name, kernel).
+    The torch metrics backend evaluates at least torch_batch_size frames per worker batch together, with
+    torch_threads intra-op threads per worker (default: the CPU cores divided by num_workers).
+    With a sample (sampling.PixelSample) every frame is evaluated on a stratified pixel subsample; the
+    accumulators then hold the estimated sums and the dict sample_replicates is filled with the
+    SampleReplicates of every (model name, slice name) for the standard errors.
+    With io_threads every worker decodes the files of the next io_readahead frames in a thread pool
+    (see prefetch.py).
+    Returns a dict mapping (model name, slice name) to its MetricAccumulator.
+    """
+    if sample is not None and (result_cache is not None or distance_bins is not None or shadow_sweep is not None
+                               or metrics_backend == "torch"):
+        raise ValueError("pixel sampling cannot be combined with the result cache, distance bins, "
+                         "the shadow sweep or the torch backend")
+    model_names = [model.name for model in models]
+    duplicates = sorted({name for name in model_names if model_names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"duplicate model names {duplicates}, results are keyed by model name")
+    num_frames = min([len(gt_paths)] + [len(model.pred_paths) for model in models])
+    for model in models:
+        if len(model.pred_paths) != len(gt_paths):
+            print(f"Warning: {model.name} has {len(model.pred_paths)} predictions for {len(gt_paths)} "
+                  f"ground truth files, evaluating the first {num_frames}")
+    
+    from worker_pool import EvaluationPool, FrameConfig
+    
+    frame_config = FrameConfig([model.alignment for model in models], max_distance, shadow_mask_dir,
+                               labeling_path, slices, len(slices) == 1, distance_bins, shadow_sweep, sample)
+    
+    def frame_tasks():
+        return ((i, gt_paths[i], [model.pred_paths[i] for model in models]) for i in range(num_frames))
+    
+    names = [slice_name(eval_slice) for eval_slice in slices]
+    accumulators = {(model.name, name): MetricAccumulator() for model in models for name in names}
+    if distance_bins is not None:
+        if distance_curves is None:
+            distance_curves = {}
+        distance_curves.update({key: DistanceCurve(distance_bins) for key in accumulators})
+    if shadow_sweep is not None:
+        if shadow_sweep_curves is None:
+            shadow_sweep_curves = {}
+        shadow_sweep_curves.update({key + (kernel,): ShadowSweepCurve(kernel)
+                                    for key in accumulators for kernel in shadow_sweep})
+    if sample is not None:
+        from sampling import SampleReplicates
         
-        # Compute metrics with distance mask
-        return compute_metrics(gt, pred, distance_mask)
+        if sample_replicates is None:
+            sample_replicates = {}
+        sample_replicates.update({key: SampleReplicates() for key in accumulators})
+    
+    # Results are merged into the accumulators as they arrive
+    with EvaluationPool(preprocessor, frame_config, num_workers=num_workers,
+                        metrics_backend=metrics_backend, metrics_dtype=metrics_dtype,
+                        progress_interval=progress_interval, result_cache=result_cache,
+                        min_batch_size=torch_batch_size if metrics_backend == "torch" else 1,
+                        io_threads=io_threads, io_readahead=io_readahead, torch_threads=torch_threads) as pool:
+        scale_shifts = None
+        if global_alignment:
+            scale_shifts = fit_global_alignment(pool, frame_tasks(), num_frames, models, preprocessor)
         
-    except Exception as e:
-        print(f"Error processing {pred_path}: {e}")
-        return None
+        for i, frame_result in pool.map_unordered(frame_tasks(), total=num_frames, frame_args=(scale_shifts,)):
+            if frame_result is None:
+                continue
+            for model, model_result in zip(models, frame_result):
+                if model_result is None:
+                    continue
+                if sample is not None:
+                    # Row 0 estimates the frame sums, the other rows are its replicates
+                    for name, sums in zip(names, model_result):
+                        if sums is not None:
+                            sample_replicates[(model.name, name)].add_frame(sums[1:])
+                    model_result = [None if sums is None else sums[0] for sums in model_result]
+                for name, sums in zip(names, model_result):
+                    if sums is not None:
+                        accumulators[(model.name, name)].add_frame(sums)
+                blocks = iter(model_result[b:b + len(names)] for b in range(len(names), len(model_result), len(names)))
+                if distance_bins is not None:
+                    for name, binned_sums in zip(names, next(blocks)):
+                        distance_curves[(model.name, name)].add_frame(binned_sums)
+                if shadow_sweep is not None:
+                    for name, sweep_sums in zip(names, next(blocks)):
+                        sweep_sums = np.reshape(sweep_sums, (len(shadow_sweep), 2, SWEEP_THRESHOLDS, NUM_SUMS))
+                        for kernel, kernel_sums in zip(shadow_sweep, sweep_sums):
+                            shadow_sweep_curves[(model.name, name, kernel)].add_frame(kernel_sums)
+                if frame_log is not None:
+                    frame_log.add(i, gt_paths[i], model.pred_paths[i], model.name, dict(zip(names, model_result)))
+                if frame_stats is not None:
+                    frame_stats.add(i, model.name, dict(zip(names, model_result)))
+    
+    if result_cache is not None:
+        result_cache.flush()
+        computed, reused = result_cache.run_summary()
+        evicted = result_cache.evict()
+        count, nbytes = result_cache.size()
+        print(f"Result cache: {reused} entries reused, {computed} computed, {evicted} evicted "
+              f"({count} entries, {nbytes / (1 << 20):.1f} MB)")
+    
+    return accumulators
+
+
+def fit_global_alignment(pool, tasks, num_frames, models, preprocessor):
+    """Streaming first pass: sum every model's alignment statistics over all frames and fit one
+    scale/shift per model. Memory stays constant (least squares sums or fixed-bin histograms).
+    """
+    from worker_pool import run_alignment_frame
+    
+    print("Global alignment: accumulating alignment statistics over the sequence...")
+    statistics = [None] * len(models)
+    for _, frame_result in pool.map_unordered(tasks, total=num_frames, frame_fn=run_alignment_frame):
+        if frame_result is None:
+            continue
+        for m, frame_statistics in enumerate(frame_result):
+            if frame_statistics is not None:
+                statistics[m] = frame_statistics if statistics[m] is None else statistics[m] + frame_statistics
+    
+    scale_shifts = []
+    for model, model_statistics in zip(models, statistics):
+        alignment = model.alignment or preprocessor.alignment
+        scale_shift = None
+        if model_statistics is not None:
+            scale_shift = preprocessor.fit_alignment(model_statistics, alignment)
+        if scale_shift is not None:
+            print(f"Global alignment for {model.name} ({alignment}): "
+                  f"scale {scale_shift[0]:.6g}, shift {scale_shift[1]:.6g}")
+        elif alignment != "none":
+            print(f"Warning: no valid pixels to fit the global alignment of {model.name}, "
+                  f"falling back to per-frame alignment")
+        scale_shifts.append(scale_shift)
+    return scale_shifts
+
+
+def compute_slice_metrics_parallel(pred_paths, gt_paths, preprocessor, slices, max_distance=100,
+                                   num_workers=4, shadow_mask_dir=None, labeling_path=None,
+                                   metrics_backend="numpy", metrics_dtype="auto"):
+    """Single pass over all image pairs computing metrics for every slice.
+    
+    Returns a dict mapping slice name to its MetricAccumulator.
+    """
+    accumulators = evaluate_models_parallel(
+        gt_paths, [EvalModel("pred", pred_paths, None)], preprocessor, slices,
+        max_distance=max_distance, num_workers=num_workers,
+        shadow_mask_dir=shadow_mask_dir, labeling_path=labeling_path,
+        metrics_backend=metrics_backend, metrics_dtype=metrics_dtype
+    )
+    return {name: accumulator for (_, name), accumulator in accumulators.items()}
 
 
 def compute_metrics_parallel(pred_paths, gt_paths, preprocessor, max_distance=100, 
                            num_workers=4, shadow_mask_dir=None, labeling_type=None, 
-                           labeling_path=None):
+                           labeling_path=None, pixel_weighted=False):
     """Parallel computation of metrics for multiple image pairs with masking support"""
     
-    if num_workers == 1:
-        # Sequential processing
-        results = []
-        for pred_path, gt_path in zip(pred_paths, gt_paths):
-            result = process_single_pair((
-                pred_path, gt_path, preprocessor, max_distance,
-                shadow_mask_dir, labeling_type, labeling_path
-            ))
-            if result is not None:
-                results.append(result)
-    else:
-        # Parallel processing
-        args_list = [
-            (pred_path, gt_path, preprocessor, max_distance,
-             shadow_mask_dir, labeling_type, labeling_path)
-            for pred_path, gt_path in zip(pred_paths, gt_paths)
-        ]
-        
-        with ProcessPoolExecutor(max_workers=num_workers) as executor:
-            results = list(executor.map(process_single_pair, args_list))
-        
-        results = [r for r in results if r is not None]
+    eval_slice = EvalSlice(
+        labeling_type.lower() if labeling_type and labeling_path else None,
+        "in" if shadow_mask_dir else None,
+        (preprocessor.distance_min, preprocessor.distance_max) if preprocessor.distance_min is not None else None,
+    )
+    accumulators = compute_slice_metrics_parallel(
+        pred_paths, gt_paths, preprocessor, [eval_slice],
+        max_distance=max_distance, num_workers=num_workers,
+        shadow_mask_dir=shadow_mask_dir, labeling_path=labeling_path
+    )
+    accumulator = accumulators[slice_name(eval_slice)]
     
-    if not results:
+    if accumulator.n_images == 0:
         print("No valid results!")
         return None, 0
     
-    # Average all metrics
-    metrics_names = list(results[0].keys())
-    final_metrics = {}
-    
-    for metric_name in metrics_names:
-        values = [r[metric_name] for r in results]
-        final_metrics[metric_name] = np.mean(values)
-    
-    return final_metrics, len(results)
+    return accumulator.metrics(pixel_weighted), accumulator.n_images
@@ -1,87 +1,167 @@
-import struct
+import argparse
 import numpy as np
-import cv2
 import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 MAX_UINT16 = 150
 
 
-def read_pfm(path):
-    """Read PFM file and return numpy array."""
+def read_pfm_header(pfm_file):
+    """Parse a PFM header; returns (shape, scale, dtype) and leaves the file at the start of the data"""
+    line1, line2, line3 = (pfm_file.readline().decode('latin-1').strip() for _ in range(3))
+    if line1 not in ('PF', 'Pf'):
+        raise ValueError('Not a PFM file.')
+
+    width, height = (int(s) for s in line2.split())
+    scale_endianess = float(line3)
+    # Negative scale means little endian
+    dtype = np.dtype('<f4' if scale_endianess < 0 else '>f4')
+    shape = (height, width, 3) if line1 == 'PF' else (height, width)
+    return shape, abs(scale_endianess), dtype
+
+
+def load_pfm_view(path, flip_rows=False):
+    """Memory-map a PFM file without decoding it.
+
+    Returns (data, scale) where data is a read-only view of the samples in file endianness.
+    PFM stores rows bottom-up; flip_rows=True returns them top-down (still a view, no copy).
+    """
     with open(path, 'rb') as pfm_file:
-        line1, line2, line3 = (pfm_file.readline().decode('latin-1').strip() for _ in range(3))
-        assert line1 in ('PF', 'Pf')
-
-        channels = 3 if "PF" in line1 else 1
-        width, height = (int(s) for s in line2.split())
-        scale_endianess = float(line3)
-        bigendian = scale_endianess > 0
-        scale = abs(scale_endianess)
-
-        buffer = pfm_file.read()
-        samples = width * height * channels
-        assert len(buffer) == samples * 4
-        
-        fmt = f'{"<>"[bigendian]}{samples}f'
-        decoded = struct.unpack(fmt, buffer)
-        shape = (height, width, 3) if channels == 3 else (height, width)
-        return np.reshape(decoded, shape) * scale
-
-def convert_pfm_files():
-    # Create output directories if they don't exist
-    output_npy_dir = Path('pfm_output_npy')
-    output_png_dir = Path('pfm_output_png')
-    output_npy_dir.mkdir(exist_ok=True)
-    output_png_dir.mkdir(exist_ok=True)
+        shape, scale, dtype = read_pfm_header(pfm_file)
+        offset = pfm_file.tell()
 
-    # Get all PFM files from the pfm_files directory
-    pfm_dir = Path('pfm_files')
-    if not pfm_dir.exists():
-        raise FileNotFoundError(f"Directory {pfm_dir} not found")
+    expected = int(np.prod(shape)) * dtype.itemsize
+    if os.path.getsize(path) - offset != expected:
+        raise ValueError(f'Truncated or corrupt PFM file: {path}')
+
+    data = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+    if flip_rows:
+        data = data[::-1]
+    return data, scale
+
+
+def read_pfm(path, flip_rows=False):
+    """Read PFM file and return numpy array."""
+    data, scale = load_pfm_view(path, flip_rows)
+    return data * scale if scale != 1.0 else data
+
+
+def convert_pfm_file(pfm_path, npy_dir=None, png_dir=None, max_depth=MAX_UINT16, flip_rows=False,
+                     npy_dtype=np.float64):
+    """Convert one PFM file to a normalized .npy and/or 16-bit .png; returns a summary line.
+
+    The depth is normalized and saved in npy_dtype (float64 by default, like the original script).
+    """
+    pfm_path = Path(pfm_path)
+    depth_map = np.asarray(read_pfm(str(pfm_path), flip_rows), dtype=npy_dtype)
+
+    # Create valid mask and filter values
+    valid_mask = (depth_map < max_depth)
+    if not valid_mask.any():
+        return f"Skipped {pfm_path.name}: no depth below {max_depth}"
+    depth_valid = depth_map[valid_mask]
+
+    # Normalize to 0-1 for full depth map
+    depth_min = np.min(depth_valid)
+    depth_max = np.max(depth_valid)
+    depth_span = max(depth_max - depth_min, np.finfo(depth_map.dtype).tiny)
+
+    # Create normalized depth map with same shape as input
+    depth_normalized = np.zeros_like(depth_map)
+    depth_normalized[valid_mask] = (depth_valid - depth_min) / depth_span
 
-    for pfm_file in pfm_dir.glob('*.pfm'):
-        print(f"Processing {pfm_file}")
-        
-        # Read PFM file
-        depth_map = read_pfm(str(pfm_file))
-        
-        # Generate output filenames
-        base_name = pfm_file.stem
-        npy_path = output_npy_dir / f"{base_name}.npy"
-        png_path = output_png_dir / f"{base_name}.png"
-
-        # Create valid mask and filter values
-        valid_mask = (depth_map < MAX_UINT16)
-        depth_valid = depth_map[valid_mask]
-
-        # Normalize to 0-1 for full depth map
-        depth_min = np.min(depth_valid)
-        depth_max = np.max(depth_valid)
-        print(f"Original depth min: {depth_min}, max: {depth_max}")
-
-        # Create normalized depth map with same shape as input
-        depth_normalized = np.zeros_like(depth_map)
-        depth_normalized[valid_mask] = (depth_map[valid_mask] - depth_min) / (depth_max - depth_min)
-        
+    if npy_dir is not None:
         # Save normalized depth to NPY
-        np.save(str(npy_path), depth_normalized)
-        
+        np.save(str(Path(npy_dir) / f"{pfm_path.stem}.npy"), depth_normalized)
+
+    if png_dir is not None:
         # Convert to uint16 for PNG (0-65535)
+        import cv2
         depth_uint16 = (depth_normalized * 65535).astype(np.uint16)
-        cv2.imwrite(str(png_path), depth_uint16)
+        cv2.imwrite(str(Path(png_dir) / f"{pfm_path.stem}.png"), depth_uint16)
 
-        print(f"Normalized depth min: {depth_normalized.min()}, max: {depth_normalized.max()}")
-        print(f"PNG depth min: {depth_uint16.min()}, max: {depth_uint16.max()}")
-        print(f"Saved: {npy_path} and {png_path}")
-        
+    return f"{pfm_path.name}: original depth min {depth_min:.4f}, max {depth_max:.4f}"
 
-if __name__ == "__main__":
+
+def _convert_task(task):
+    pfm_path, npy_dir, png_dir, max_depth, flip_rows, npy_dtype = task
     try:
-        convert_pfm_files()
-        print("Conversion completed successfully!")
+        return convert_pfm_file(pfm_path, npy_dir, png_dir, max_depth, flip_rows, npy_dtype)
     except Exception as e:
-        print(f"An error occurred: {e}")
+        return f"Error processing {pfm_path}: {e}"
 
 
+def convert_pfm_files(input_dir='pfm_files', npy_dir='pfm_output_npy', png_dir='pfm_output_png',
+                      max_depth=MAX_UINT16, num_workers=4, flip_rows=False, verbose=False,
+                      npy_dtype=np.float64):
+    """Convert every PFM file of input_dir in a process pool"""
+    pfm_dir = Path(input_dir)
+    if not pfm_dir.exists():
+        raise FileNotFoundError(f"Directory {pfm_dir} not found")
+
+    # Create output directories if they don't exist
+    for out_dir in (npy_dir, png_dir):
+        if out_dir is not None:
+            Path(out_dir).mkdir(parents=True, exist_ok=True)
+
+    pfm_files = sorted(pfm_dir.glob('*.pfm'))
+    if not pfm_files:
+        print(f"No PFM files found in {pfm_dir}")
+        return
+
+    print(f"Converting {len(pfm_files)} PFM files with {num_workers} workers...")
+    tasks = [(str(p), npy_dir, png_dir, max_depth, flip_rows, npy_dtype) for p in pfm_files]
+
+    if num_workers == 1:
+        messages = map(_convert_task, tasks)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=num_workers)
+        chunksize = max(1, len(tasks) // (num_workers * 8))
+        messages = executor.map(_convert_task, tasks, chunksize=chunksize)
 
+    try:
+        for idx, message in enumerate(messages):
+            if verbose or message.startswith(("Error", "Skipped")):
+                print(message)
+            if (idx + 1) % 100 == 0 or (idx + 1) == len(tasks):
+                print(f"Processed {idx + 1}/{len(tasks)}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert PFM depth maps to normalized .npy and 16-bit .png')
+    parser.add_argument('--input_dir', type=str, default='pfm_files', help='Folder containing the .pfm files')
+    parser.add_argument('--npy_dir', type=str, default='pfm_output_npy', help='Output folder for .npy files')
+    parser.add_argument('--png_dir', type=str, default='pfm_output_png', help='Output folder for .png files')
+    parser.add_argument('--no_npy', action='store_true', help='Do not write .npy files')
+    parser.add_argument('--no_png', action='store_true', help='Do not write .png files')
+    parser.add_argument('--max_depth', type=float, default=MAX_UINT16, help=f'Depths above this are invalid (default: {MAX_UINT16})')
+    parser.add_argument('--flip_rows', action='store_true', help='Flip the bottom-up PFM rows to top-down')
+    parser.add_argument('--npy_dtype', type=str, choices=['float64', 'float32'], default='float64',
+                        help='Precision of the normalized .npy files; float32 halves their size (default: float64)')
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--verbose', action='store_true', help='Print a line per converted file')
+    args = parser.parse_args()
+
+    convert_pfm_files(
+        input_dir=args.input_dir,
+        npy_dir=None if args.no_npy else args.npy_dir,
+        png_dir=None if args.no_png else args.png_dir,
+        max_depth=args.max_depth,
+        num_workers=args.num_workers,
+        flip_rows=args.flip_rows,
+        verbose=args.verbose,
+        npy_dtype=np.dtype(args.npy_dtype)
+    )
+
+
+if __name__ == "__main__":
+    try:
+        main()
+        print("Conversion completed successfully!")
+    except Exception as e:
+        print(f"An error occurred: {e}")
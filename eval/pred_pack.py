@@ -0,0 +1,241 @@
+"""
+Compact quantised prediction packs
+
+`pred_pack.py pack` stores a folder of .npy / .pfm predictions in one .qpred file, the frames in
+sorted file order:
+    b"QPRED001"                              magic
+    frame blocks                             64-byte aligned, memory-mapped one frame at a time
+    index (JSON)                             per frame: stem, source format, shape, encoding, offset,
+                                             decode parameters, content digest and the largest relative
+                                             error of its positive depths (max_error)
+    offset and length of the index, magic    trailer (<QQ8s)
+
+Encodings:
+    log_uint16  0 for depth 0, otherwise code q in 1..65535 with depth = exp(log_min + (q - 1) * step)
+                over the frame's [min, max] positive depth: the relative error is at most
+                exp(step / 2) - 1 (5e-5 for a 1000:1 depth range) plus float32 rounding
+    float16     relative error at most 2^-11 for depths in [6.1e-5, 65504]
+    float32     lossless; used for frames a lossy encoding cannot represent (negative, non-finite or,
+                for float16, out of range values)
+
+A pack is evaluated like the folder it was made from: `eval2results.py gt_folder preds.qpred`.
+Frame i of a pack has the virtual path preds.qpred/<stem>; load_depth decodes it straight into a
+float32 array and applies the unit conversion of its source format, so --relative_depth scaling,
+--pfm_flip_rows and the PFM max distance work as for the original files.
+
+Usage:
+    python pred_pack.py pack /path/to/preds_folder /path/to/preds.qpred --encoding log_uint16
+    python pred_pack.py info /path/to/preds.qpred
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+
+PACK_SUFFIX = ".qpred"
+PACK_VERSION = 1
+MAGIC = b"QPRED001"
+TRAILER = struct.Struct("<QQ8s")
+ALIGNMENT = 64
+ENCODINGS = ("log_uint16", "float16", "float32")
+MAX_CODE = 65535
+FLOAT16_MIN, FLOAT16_MAX = 6.103515625e-05, 65504.0
+
+# Open packs of this process: {path: PredictionPack}
+_packs = {}
+
+
+def is_pack_frame(path):
+    """Whether a path is the virtual path <pack>.qpred/<stem> of a packed frame"""
+    return isinstance(path, str) and os.path.dirname(path).endswith(PACK_SUFFIX)
+
+
+def is_pack(path):
+    return path.endswith(PACK_SUFFIX) and os.path.isfile(path)
+
+
+def open_pack(path):
+    """The PredictionPack of a .qpred file, opened once per process"""
+    pack = _packs.get(path)
+    if pack is None:
+        pack = _packs[path] = PredictionPack(path)
+    return pack
+
+
+def load_pack_frame(path):
+    """Decoded float32 depth of a packed frame path"""
+    return open_pack(os.path.dirname(path)).frame(os.path.basename(path))
+
+
+def pack_frame_source(path):
+    """Source format ("npy" or "pfm") of a packed frame path"""
+    return open_pack(os.path.dirname(path)).entries[os.path.basename(path)]["source"]
+
+
+def pack_frame_digest(path):
+    """Content digest of a packed frame path (its encoded bytes and decode parameters)"""
+    return open_pack(os.path.dirname(path)).entries[os.path.basename(path)]["digest"]
+
+
+class PredictionPack:
+    """Read access to a .qpred file; the frame data is memory-mapped on first use"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a prediction pack")
+            f.seek(-TRAILER.size, os.SEEK_END)
+            offset, length, magic = TRAILER.unpack(f.read(TRAILER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is truncated")
+            f.seek(offset)
+            index = json.loads(f.read(length))
+        if index["version"] != PACK_VERSION:
+            raise ValueError(f"{path} has pack version {index['version']}, expected {PACK_VERSION}")
+        self.entries = {entry["stem"]: entry for entry in index["frames"]}
+        self._data = None
+
+    def stems(self):
+        return list(self.entries)
+
+    def frame(self, stem):
+        """Decode a frame into a new float32 array"""
+        if self._data is None:
+            self._data = np.memmap(self.path, dtype=np.uint8, mode="r")
+        entry = self.entries[stem]
+        shape = tuple(entry["shape"])
+        encoding = entry["encoding"]
+        dtype = np.uint16 if encoding == "log_uint16" else np.dtype(encoding)
+        count = int(np.prod(shape))
+        raw = self._data[entry["offset"]:entry["offset"] + count * np.dtype(dtype).itemsize].view(dtype).reshape(shape)
+        return decode_frame(raw, encoding, entry)
+
+
+def decode_frame(raw, encoding, params):
+    """Decode an encoded frame into a new float32 array, without float64 temporaries"""
+    depth = np.empty(raw.shape, dtype=np.float32)
+    if encoding != "log_uint16":
+        np.copyto(depth, raw)
+        return depth
+    # exp(log_min + (q - 1) * step), 0 where q == 0
+    np.multiply(raw, np.float32(params["step"]), out=depth)
+    depth += np.float32(params["log_min"] - params["step"])
+    np.exp(depth, out=depth)
+    depth[raw == 0] = 0
+    return depth
+
+
+def encode_frame(depth, encoding="log_uint16"):
+    """(encoded array, encoding, decode parameters) of a depth map, float32 if encoding cannot represent it"""
+    depth = np.asarray(depth)
+    finite = np.isfinite(depth).all()
+    if encoding == "log_uint16" and finite and (depth >= 0).all():
+        positive = depth[depth > 0]
+        if positive.size == 0:
+            return np.zeros(depth.shape, dtype=np.uint16), encoding, {"log_min": 0.0, "step": 0.0}
+        log_min, log_max = float(np.log(positive.min())), float(np.log(positive.max()))
+        step = (log_max - log_min) / (MAX_CODE - 1)
+        codes = np.zeros(depth.shape, dtype=np.uint16)
+        valid = depth > 0
+        if step > 0:
+            codes[valid] = np.rint((np.log(depth[valid]) - log_min) / step).astype(np.uint16) + 1
+        else:
+            codes[valid] = 1
+        return codes, encoding, {"log_min": log_min, "step": step}
+    if encoding == "float16" and finite and (np.abs(depth) <= FLOAT16_MAX).all():
+        return depth.astype(np.float16), encoding, {}
+    return depth.astype(np.float32), "float32", {}
+
+
+def _read_source(path):
+    """Raw values of a .npy / .pfm prediction file, as stored (PFM rows are not flipped)"""
+    if path.endswith(".npy"):
+        return np.load(path), "npy"
+    from pfm2npy import load_pfm_view
+    depth, _ = load_pfm_view(path, flip_rows=False)
+    return np.array(depth), "pfm"
+
+
+def write_pack(preds_folder, pack_path, encoding="log_uint16"):
+    """Pack every .npy / .pfm file of a folder; returns the index entries"""
+    files = [f for f in sorted(os.listdir(preds_folder)) if f.endswith((".npy", ".pfm"))]
+    skipped = len(os.listdir(preds_folder)) - len(files)
+    if skipped:
+        print(f"Warning: skipping {skipped} file(s) that are not .npy or .pfm")
+    directory = os.path.dirname(pack_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    entries = []
+    tmp_path = f"{pack_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        for name in files:
+            depth, source = _read_source(os.path.join(preds_folder, name))
+            depth = np.squeeze(depth)
+            codes, frame_encoding, params = encode_frame(depth, encoding)
+            params["max_error"] = quantisation_error(depth, decode_frame(codes, frame_encoding, params))
+            f.write(b"\0" * (-f.tell() % ALIGNMENT))
+            offset = f.tell()
+            data = np.ascontiguousarray(codes).tobytes()
+            f.write(data)
+            digest = hashlib.blake2b(data, digest_size=16)
+            digest.update(json.dumps([frame_encoding, params, list(codes.shape)]).encode())
+            entries.append({"stem": os.path.splitext(name)[0], "source": source, "shape": list(codes.shape),
+                            "encoding": frame_encoding, "offset": offset, "digest": digest.hexdigest(), **params})
+        index = json.dumps({"version": PACK_VERSION, "frames": entries}).encode()
+        offset = f.tell()
+        f.write(index)
+        f.write(TRAILER.pack(offset, len(index), MAGIC))
+    os.replace(tmp_path, pack_path)
+    _packs.pop(pack_path, None)
+    return entries
+
+
+def quantisation_error(depth, decoded):
+    """Largest relative error of the positive depths of a frame after a pack round trip"""
+    depth = np.asarray(depth, dtype=np.float64)
+    valid = depth > 0
+    if not valid.any():
+        return 0.0
+    return float(np.max(np.abs(decoded[valid] - depth[valid]) / depth[valid]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantised prediction packs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    pack = subparsers.add_parser("pack", help="Pack a folder of .npy / .pfm predictions into one .qpred file")
+    pack.add_argument("preds_folder")
+    pack.add_argument("pack_path", help=f"Output file, must end with {PACK_SUFFIX}")
+    pack.add_argument("--encoding", type=str, choices=ENCODINGS[:2], default="log_uint16")
+
+    info = subparsers.add_parser("info", help="Print the frames, encodings, size and error of a pack")
+    info.add_argument("pack_path")
+
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        if not args.pack_path.endswith(PACK_SUFFIX):
+            parser.error(f"pack_path must end with {PACK_SUFFIX}")
+        entries = write_pack(args.preds_folder, args.pack_path, args.encoding)
+        source_bytes = sum(os.path.getsize(os.path.join(args.preds_folder, f"{entry['stem']}.{entry['source']}"))
+                           for entry in entries)
+        pack_bytes = os.path.getsize(args.pack_path)
+        print(f"Packed {len(entries)} frames into {args.pack_path}: {source_bytes / (1 << 20):.1f} MB -> "
+              f"{pack_bytes / (1 << 20):.1f} MB ({source_bytes / max(pack_bytes, 1):.1f}x)")
+    else:
+        entries = list(open_pack(args.pack_path).entries.values())
+        print(f"{args.pack_path}: {len(entries)} frames, {os.path.getsize(args.pack_path) / (1 << 20):.1f} MB")
+    lossless = sum(entry["encoding"] == "float32" for entry in entries)
+    if lossless:
+        print(f"{lossless} frame(s) with negative, non-finite or out of range values stored as float32")
+    print(f"Largest relative depth error: {max((entry['max_error'] for entry in entries), default=0.0):.2e}")
+
+
+if __name__ == "__main__":
+    main()
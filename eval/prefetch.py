@@ -0,0 +1,204 @@
+"""
+Read-ahead decoding of frame files (--io_threads)
+
+While a worker evaluates a frame, a thread pool decodes the files of the next --io_readahead frames of
+its batch: GT and prediction depth, label maps, shadow masks and the grayscale RGB images of the dark
+masks. The decoders release the GIL while they read and inflate (cv2.imread for the PNG layouts it
+decodes like PIL, np.load and plain file reads otherwise), so decoding overlaps with the metrics of
+the current frame instead of leaving the CPU in I/O wait on slow (network) filesystems.
+
+The loaders (load_depth, load_shadow_mask, load_label_image, DarkMaskSource) pick up a decoded file
+with take(path); files that were not prefetched, or failed to decode, are loaded as before. Prefetched
+files and statistics are kept per thread, so in-process evaluations in several threads (e.g. the jobs
+of eval_server.py) do not take each other's files.
+"""
+
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import profiling
+
+# Per thread: the decoded files of the frame being evaluated ({path: Future}) in .pending, and the
+# seconds spent waiting in take() for files that were still being decoded in .wait
+_frame = threading.local()
+# PNG color types and bit depths cv2.imread(IMREAD_UNCHANGED) decodes to the arrays PIL gives:
+# grayscale 8/16 bit, RGB and RGBA 8 bit (with the channels reversed)
+_CV2_PNG_LAYOUTS = {(0, 8), (0, 16), (2, 8), (6, 8)}
+
+
+def take(path):
+    """The prefetched contents of a file of the current frame, None if it was not prefetched"""
+    pending = getattr(_frame, "pending", None)
+    future = pending.pop(path, None) if pending else None
+    if future is None:
+        return None
+    start = time.perf_counter()
+    try:
+        return future.result()
+    except Exception:
+        # Loaded (and reported) again by the caller
+        return None
+    finally:
+        _frame.wait = getattr(_frame, "wait", 0.0) + time.perf_counter() - start
+
+
+def _png_layout(path):
+    """(color type, bit depth) from the IHDR chunk of a PNG file"""
+    with open(path, "rb") as f:
+        header = f.read(26)
+    if len(header) < 26 or header[12:16] != b"IHDR":
+        return None
+    return header[25], header[24]
+
+
+def _read_png_cv2(path):
+    """A PNG file decoded by cv2 in the channel order of PIL, None for the layouts cv2 decodes differently"""
+    try:
+        import cv2
+    except ImportError:
+        return None
+    if _png_layout(path) not in _CV2_PNG_LAYOUTS:
+        return None
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is not None and image.ndim == 3:
+        # BGR(A) -> RGB(A)
+        image = np.ascontiguousarray(image[..., [2, 1, 0, 3][:image.shape[2]]])
+    return image
+
+
+def read_png(path):
+    """A PNG file as np.array(PIL.Image.open(path)) gives it, decoded by cv2 where the layouts match"""
+    image = _read_png_cv2(path)
+    if image is None:
+        from PIL import Image
+        image = np.array(Image.open(path))
+    return image
+
+
+def read_label(path):
+    """A label PNG as load_label_image decodes it: imageio for the layouts cv2 does not decode alike
+    (palette images come out as RGB, not as palette indices)
+    """
+    image = _read_png_cv2(path)
+    if image is None:
+        import imageio.v3 as imageio
+        image = imageio.imread(path)
+    return image
+
+
+def read_gray(path):
+    """An image file decoded as grayscale (the input of the dark masks)"""
+    import cv2
+    return cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+
+def frame_files(gt_path, pred_paths, preprocessor, config, masks=True):
+    """(path, decoder) of every file the evaluation of a frame reads; masks=False for depth only"""
+    from metrics import prediction_name
+    from pred_pack import is_pack_frame, load_pack_frame
+
+    cached = preprocessor.cached_frame(gt_path)
+    files = []
+    for path in [gt_path if cached is None else None] + list(pred_paths):
+        if not isinstance(path, str):
+            continue
+        if is_pack_frame(path):
+            files.append((path, load_pack_frame))
+        elif path.endswith(".npy"):
+            files.append((path, np.load))
+        elif path.endswith(".png"):
+            files.append((path, read_png))
+        elif path.endswith(".pfm"):
+            files.append((path, lambda path: np.array(preprocessor.load_pfm(path))))
+    if not masks:
+        return files
+
+    base_name = os.path.splitext(prediction_name(gt_path, pred_paths[0]))[0]
+    slices = config.slices
+    if config.shadow_mask_dir and any(s.shadow is not None and s.shadow_kernel is None for s in slices) \
+            and not (cached is not None and cached.has_shadow_from(config.shadow_mask_dir)):
+        files.append((os.path.join(config.shadow_mask_dir, f"{base_name}.png"), read_png))
+    if config.labeling_path and any(s.label is not None for s in slices) \
+            and not (cached is not None and cached.has_labels_from(config.labeling_path)):
+        files.append((os.path.join(config.labeling_path, f"{base_name}.png"), read_label))
+    if preprocessor.dark_masks is not None and (config.shadow_sweep or any(s.shadow_kernel is not None
+                                                                           for s in slices)):
+        image_path = preprocessor.dark_masks.image_path(base_name)
+        if image_path is not None:
+            files.append((image_path, read_gray))
+    # Missing files fail in the decoder and are reported by the loader
+    return files
+
+
+class FramePrefetcher:
+    """Thread pool decoding the files of upcoming frames; one per worker process"""
+
+    def __init__(self, io_threads=4, readahead=4):
+        self.io_threads = io_threads
+        self.readahead = max(readahead, 1)
+        self.executor = ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        # Decoding seconds of the files submitted by each thread, in .seconds ([seconds])
+        self._submitter = threading.local()
+
+    def _decode(self, decode, path, seconds):
+        start = time.perf_counter()
+        try:
+            with profiling.stage("prefetch"):
+                return decode(path)
+        finally:
+            with self._lock:
+                seconds[0] += time.perf_counter() - start
+
+    def _seconds(self):
+        seconds = getattr(self._submitter, "seconds", None)
+        if seconds is None:
+            seconds = self._submitter.seconds = [0.0]
+        return seconds
+
+    def _submit(self, files):
+        seconds = self._seconds()
+        return {path: self.executor.submit(self._decode, decode, path, seconds) for path, decode in files}
+
+    def frames(self, items, files):
+        """Yield items in order; while an item is evaluated, the files of the next readahead items are decoded.
+
+        files(item) lists the (path, decoder) pairs of an item, see frame_files; take() returns them
+        while their item is being evaluated.
+        """
+        pending = _frame.pending = {}
+        items = iter(items)
+        ahead = deque((item, self._submit(files(item))) for item in itertools.islice(items, self.readahead))
+        try:
+            while ahead:
+                item, futures = ahead.popleft()
+                for item_ahead in itertools.islice(items, 1):
+                    ahead.append((item_ahead, self._submit(files(item_ahead))))
+                pending.update(futures)
+                try:
+                    yield item
+                finally:
+                    # Files the evaluation did not use
+                    for future in pending.values():
+                        future.cancel()
+                    pending.clear()
+        finally:
+            for _, futures in ahead:
+                for future in futures.values():
+                    future.cancel()
+
+    def take_stats(self):
+        """(thread seconds spent decoding, seconds waited for decoded files) of the frames of the calling
+        thread since its last call
+        """
+        seconds = self._seconds()
+        with self._lock:
+            decode_seconds, seconds[0] = seconds[0], 0.0
+        wait_seconds, _frame.wait = getattr(_frame, "wait", 0.0), 0.0
+        return decode_seconds, wait_seconds
@@ -0,0 +1,164 @@
+"""
+Per-stage profiling
+
+Pipeline stages are wrapped in `with profiling.stage("decode_gt"):`. While profiling is disabled (the
+default) stage() returns one shared no-op context manager and count_bytes() returns immediately.
+Once enabled, every process records monotonic start times and durations (time.perf_counter_ns) and
+byte counts per stage. Workers drain their records into every batch result (take()), and the parent
+merges them (merge()). At the end of the run, print_summary() prints per-stage totals, percentiles and
+throughput, and write_trace() writes a Chrome trace-event JSON file (chrome://tracing or Perfetto).
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+_NO_OP = contextlib.nullcontext()
+# Recorder of this process, None while profiling is disabled
+_recorder = None
+
+
+class _Stage:
+    __slots__ = ("recorder", "name", "start")
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recorder.record(self.name, self.start, time.perf_counter_ns())
+
+
+class StageRecorder:
+    """Start times and durations (ns) per (pid, thread, stage), and bytes per stage"""
+
+    def __init__(self):
+        self.events = {}
+        self.bytes = {}
+
+    def record(self, name, start, end):
+        key = (os.getpid(), threading.get_ident(), name)
+        events = self.events.get(key)
+        if events is None:
+            events = self.events[key] = ([], [])
+        events[0].append(start)
+        events[1].append(end - start)
+
+    def count_bytes(self, name, nbytes):
+        self.bytes[name] = self.bytes.get(name, 0) + int(nbytes)
+
+    def take(self):
+        """Records since the last take(), cleared from this recorder"""
+        records = (self.events, self.bytes)
+        self.events, self.bytes = {}, {}
+        return records
+
+    def merge(self, records):
+        events, nbytes = records
+        for key, (starts, durations) in events.items():
+            own = self.events.setdefault(key, ([], []))
+            own[0].extend(starts)
+            own[1].extend(durations)
+        for name, count in nbytes.items():
+            self.count_bytes(name, count)
+
+
+def enable():
+    """Start recording in this process (idempotent)"""
+    global _recorder
+    if _recorder is None:
+        _recorder = StageRecorder()
+
+
+def enabled():
+    return _recorder is not None
+
+
+def stage(name):
+    """Context manager timing a stage; a shared no-op while profiling is disabled"""
+    return _NO_OP if _recorder is None else _Stage(_recorder, name)
+
+
+def count_bytes(name, nbytes):
+    """Add to the bytes processed by a stage"""
+    if _recorder is not None:
+        _recorder.count_bytes(name, nbytes)
+
+
+def take():
+    """Drain this process's records (None while disabled); sent back by the workers with every batch"""
+    return None if _recorder is None else _recorder.take()
+
+
+def merge(records):
+    """Merge records taken in another process into this one's"""
+    if records is not None and _recorder is not None:
+        _recorder.merge(records)
+
+
+def stage_summary():
+    """{stage: (calls, total s, mean ms, p50 ms, p90 ms, p99 ms, max ms, bytes)} over all processes"""
+    if _recorder is None:
+        return {}
+    durations = {}
+    for (_, _, name), (_, stage_durations) in _recorder.events.items():
+        durations.setdefault(name, []).extend(stage_durations)
+    summary = {}
+    for name, values in durations.items():
+        ms = np.asarray(values, dtype=np.float64) / 1e6
+        p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+        summary[name] = (len(ms), ms.sum() / 1e3, ms.mean(), p50, p90, p99, ms.max(), _recorder.bytes.get(name, 0))
+    return summary
+
+
+def print_summary(wall_seconds=None):
+    """Print per-stage totals, percentiles and throughput (calls/s and MB/s of stage time)"""
+    summary = stage_summary()
+    if not summary:
+        return
+    processes = len({pid for pid, _, _ in _recorder.events})
+    wall = f", {wall_seconds:.2f} s wall" if wall_seconds else ""
+    print(f"\nProfile ({processes} process(es){wall}):")
+    width = max(len(name) for name in list(summary) + ["Stage"])
+    header = (f"{'Stage':<{width}} | {'Calls':>7} | {'Total s':>8} | {'Mean ms':>8} | {'p50 ms':>8} | "
+              f"{'p90 ms':>8} | {'p99 ms':>8} | {'Max ms':>8} | {'Calls/s':>8} | {'MB/s':>8}")
+    print(header)
+    print("-" * len(header))
+    for name, (calls, total, mean, p50, p90, p99, peak, nbytes) in sorted(summary.items(), key=lambda s: -s[1][1]):
+        rate = calls / total if total > 0 else 0.0
+        bandwidth = f"{nbytes / total / 1e6:>8.1f}" if nbytes and total > 0 else f"{'-':>8}"
+        print(f"{name:<{width}} | {calls:>7} | {total:>8.2f} | {mean:>8.2f} | {p50:>8.2f} | {p90:>8.2f} | "
+              f"{p99:>8.2f} | {peak:>8.2f} | {rate:>8.1f} | {bandwidth}")
+
+
+def write_trace(path):
+    """Write every recorded stage as a Chrome trace event ("ph": "X"), one row per process and thread.
+
+    perf_counter_ns is a system-wide monotonic clock on Linux, so worker timelines line up.
+    """
+    if _recorder is None:
+        return 0
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    count = 0
+    with open(path, "w") as f:
+        f.write('{"displayTimeUnit": "ms", "traceEvents": [\n')
+        pids = sorted({pid for pid, _, _ in _recorder.events})
+        f.write(",\n".join(json.dumps({"name": "process_name", "ph": "M", "pid": pid,
+                                       "args": {"name": f"process {pid}"}}) for pid in pids))
+        for (pid, tid, name), (starts, durations) in _recorder.events.items():
+            for start, duration in zip(starts, durations):
+                f.write(f',\n{{"name": {json.dumps(name)}, "ph": "X", "pid": {pid}, "tid": {tid}, '
+                        f'"ts": {start / 1e3:.3f}, "dur": {duration / 1e3:.3f}}}')
+                count += 1
+        f.write("\n]}\n")
+    return count
@@ -0,0 +1,364 @@
+"""
+Content-addressed per-frame result cache
+
+Stores the metric sums of every (frame, model, slice) in an SQLite file so that reruns only evaluate
+new or changed frames. An entry is keyed by a hash of:
+    the prediction and GT file contents
+    the label / shadow mask contents (only for slices that use them)
+    the preprocessing config (config yaml values, alignment mode, max_gt_distance, ...)
+    the slice definition
+
+File digests are memoized by (path, size, mtime_ns), so unchanged files are not re-read.
+Every entry carries a CRC32 of its value; corrupt entries are dropped and recomputed.
+The least recently used entries are evicted once the cache exceeds its size budget.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+import numpy as np
+
+import profiling
+from metrics import NUM_SUMS, process_frame
+from pred_pack import is_pack_frame, pack_frame_digest
+
+CACHE_VERSION = 1
+# Approximate per-row storage overhead on top of key and value
+ROW_OVERHEAD = 48
+DEFAULT_MAX_MB = 2048
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    checksum INTEGER NOT NULL,
+    nbytes INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+CREATE TABLE IF NOT EXISTS digests (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL
+);
+"""
+
+
+def result_cache_config(preprocessor, max_distance, metrics_backend="numpy", metrics_dtype="auto"):
+    """Options that change the metric sums of a frame (besides the files and the alignment mode)"""
+    args = preprocessor.args
+    return {
+        "version": CACHE_VERSION,
+        "min_depth": preprocessor.min_depth,
+        "max_depth": preprocessor.max_depth,
+        "scale_factor": preprocessor.scale_factor,
+        "alignment_max_res": preprocessor.alignment_max_res,
+        "resize": bool(args and getattr(args, "resize", False)),
+        "pfm_flip_rows": bool(args and getattr(args, "pfm_flip_rows", False)),
+        "max_gt_distance": max_distance,
+        "metrics_backend": metrics_backend,
+        "metrics_dtype": metrics_dtype,
+    }
+
+
+def _hash(*parts):
+    return hashlib.blake2b(json.dumps(parts).encode(), digest_size=16).hexdigest()
+
+
+def _encode(sums):
+    return b"" if sums is None else np.asarray(sums, dtype=np.float64).tobytes()
+
+
+def _decode(value):
+    """Flat sums of an entry; process_frame_cached restores their shape from the key's position"""
+    if not value:
+        return None
+    sums = np.frombuffer(value, dtype=np.float64)
+    return sums if sums.size % NUM_SUMS == 0 else None
+
+
+def _shaped(found, keys, num_slices):
+    """Cached sums of keys in the layout of process_frame: [NUM_SUMS] per slice, then the
+    distance-binned and shadow sweep blocks as [points, NUM_SUMS], even with a single point"""
+    shaped = []
+    for i, key in enumerate(keys):
+        sums = found.get(key)
+        if sums is not None:
+            sums = sums.reshape(NUM_SUMS) if i < num_slices else sums.reshape(-1, NUM_SUMS)
+        shaped.append(sums)
+    return shaped
+
+
+class ResultCache:
+    """Per-frame result cache; safe to share with worker processes (each opens its own connection)"""
+
+    def __init__(self, path, config, max_bytes=DEFAULT_MAX_MB << 20):
+        self.path = path
+        self.config = config
+        self.config_hash = _hash(config)
+        self.max_bytes = max_bytes
+        self.run_start = time.time()
+        self._conn = None
+        self._pid = None
+        self._digests = {}
+        self._pending_results = {}
+        self._pending_digests = []
+        self._touched = set()
+        self._corrupt = set()
+        self.connection()
+
+    def __getstate__(self):
+        # Connections and pending writes stay in the process that created them
+        return {"path": self.path, "config": self.config, "max_bytes": self.max_bytes,
+                "run_start": self.run_start}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["config"], state["max_bytes"])
+        self.run_start = state["run_start"]
+
+    def connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            try:
+                self._conn = self._open()
+            except sqlite3.DatabaseError as e:
+                print(f"Warning: result cache {self.path} is unreadable ({e}), starting a new one")
+                os.replace(self.path, f"{self.path}.corrupt")
+                self._conn = self._open()
+            self._pid = os.getpid()
+        return self._conn
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        # auto_vacuum only takes effect before the first table is created
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.executescript(_SCHEMA)
+        return conn
+
+    # ---------------- keys ----------------
+
+    def file_digest(self, path):
+        """Content hash of a file, None if it does not exist; memoized by (size, mtime_ns).
+        
+        Frames of a prediction pack have the digest stored in the pack (see pred_pack.py).
+        """
+        if is_pack_frame(path):
+            return pack_frame_digest(path)
+        if path is None or not os.path.exists(path):
+            return None
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        if path not in self._digests:
+            row = self.connection().execute(
+                "SELECT size, mtime_ns, digest FROM digests WHERE path = ?", (path,)).fetchone()
+            self._digests[path] = row
+        row = self._digests[path]
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        digest = h.hexdigest()
+        self._digests[path] = (stat.st_size, stat.st_mtime_ns, digest)
+        self._pending_digests.append((path, stat.st_size, stat.st_mtime_ns, digest))
+        return digest
+
+    def frame_keys(self, gt_path, pred_paths, alignments, scale_shifts, slices,
+                   shadow_mask_dir=None, labeling_path=None, distance_bins=None, dark_masks=None,
+                   shadow_sweep=None):
+        """Cache key of every (model, slice) of a frame, as a list per model laid out like process_frame results"""
+        gt_digest = self.file_digest(gt_path)
+        # Masks are looked up by the file name of the first prediction (see process_frame)
+        mask_file = f"{os.path.splitext(os.path.basename(pred_paths[0]))[0]}.png"
+        shadow_digest = self.file_digest(os.path.join(shadow_mask_dir, mask_file)) if shadow_mask_dir else None
+        label_digest = self.file_digest(os.path.join(labeling_path, mask_file)) if labeling_path else None
+        dark_digest = rgb_digest = None
+        if dark_masks is not None:
+            rgb_digest = self.file_digest(dark_masks.image_path(pred_paths[0]))
+            dark_digest = _hash(rgb_digest, dark_masks.threshold_value)
+
+        keys = []
+        for pred_path, alignment, scale_shift in zip(pred_paths, alignments, scale_shifts):
+            model_key = _hash(self.config_hash, alignment, scale_shift and [float(v) for v in scale_shift],
+                              gt_digest, self.file_digest(pred_path))
+            slice_keys = [
+                _hash(model_key, s.label, s.shadow, s.distance_range,
+                      label_digest if s.label is not None else None,
+                      (shadow_digest if s.shadow_kernel is None else [dark_digest, s.shadow_kernel])
+                      if s.shadow is not None else None)
+                for s in slices
+            ]
+            block_keys = list(slice_keys)
+            if distance_bins is not None:
+                block_keys += [_hash(key, "distance_bins", list(distance_bins)) for key in slice_keys]
+            if shadow_sweep is not None:
+                block_keys += [_hash(key, "shadow_sweep", list(shadow_sweep), rgb_digest) for key in slice_keys]
+            keys.append(block_keys)
+        return keys
+
+    # ---------------- entries ----------------
+
+    def get_many(self, keys):
+        """{key: sums} of the cached keys; entries failing the checksum are dropped"""
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.connection().execute(
+                f"SELECT key, value, checksum FROM results WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            for key, value, checksum in rows:
+                if zlib.crc32(value) != checksum or (value and _decode(value) is None):
+                    print(f"Warning: corrupt result cache entry {key}, recomputing")
+                    self._corrupt.add(key)
+                    continue
+                found[key] = _decode(value)
+                self._touched.add(key)
+        return found
+
+    def put(self, key, sums):
+        self._pending_results[key] = _encode(sums)
+
+    def flush(self):
+        """Write pending entries, digests and access times in one transaction"""
+        if not (self._pending_results or self._pending_digests or self._touched or self._corrupt):
+            return
+        now = time.time()
+        conn = self.connection()
+        with conn:
+            conn.executemany("DELETE FROM results WHERE key = ?", [(k,) for k in self._corrupt])
+            conn.executemany(
+                "INSERT OR REPLACE INTO results (key, value, checksum, nbytes, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(key, value, zlib.crc32(value), len(key) + len(value) + ROW_OVERHEAD, now, now)
+                 for key, value in self._pending_results.items()])
+            conn.executemany("UPDATE results SET last_used = ? WHERE key = ?",
+                             [(now, key) for key in self._touched])
+            conn.executemany("INSERT OR REPLACE INTO digests (path, size, mtime_ns, digest) VALUES (?, ?, ?, ?)",
+                             self._pending_digests)
+        self._pending_results.clear()
+        self._pending_digests.clear()
+        self._touched.clear()
+        self._corrupt.clear()
+
+    # ---------------- maintenance ----------------
+
+    def size(self):
+        """(entries, bytes) currently stored"""
+        count, nbytes = self.connection().execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM results").fetchone()
+        return count, nbytes
+
+    def evict(self):
+        """Drop the least recently used entries until the cache fits max_bytes; returns the number dropped"""
+        self.flush()
+        if self.max_bytes is None or self.size()[1] <= self.max_bytes:
+            return 0
+        conn = self.connection()
+        with conn:
+            dropped = conn.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM (SELECT key, SUM(nbytes) OVER "
+                "(ORDER BY last_used DESC, key) AS kept FROM results) WHERE kept > ?)",
+                (self.max_bytes,)).rowcount
+            # Digests of files no longer referenced are cheap to recompute; keep them bounded too
+            conn.execute("DELETE FROM digests WHERE rowid NOT IN "
+                         "(SELECT rowid FROM digests ORDER BY rowid DESC LIMIT 1000000)")
+        conn.execute("PRAGMA incremental_vacuum")
+        return dropped
+
+    def run_summary(self):
+        """Entries computed and reused since this cache object was created"""
+        computed, reused = self.connection().execute(
+            "SELECT COALESCE(SUM(created >= ?), 0), COALESCE(SUM(created < ? AND last_used >= ?), 0) FROM results",
+            (self.run_start, self.run_start, self.run_start)).fetchone()
+        return computed, reused
+
+    def verify(self):
+        """Check the database structure and every entry's checksum; corrupt entries are deleted"""
+        conn = self.connection()
+        status = conn.execute("PRAGMA quick_check").fetchone()[0]
+        bad = [key for key, value, checksum in conn.execute("SELECT key, value, checksum FROM results")
+               if zlib.crc32(value) != checksum or (value and _decode(value) is None)]
+        with conn:
+            conn.executemany("DELETE FROM results WHERE key = ?", [(k,) for k in bad])
+        return status, len(bad)
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self.flush()
+            self._conn.close()
+        self._conn = None
+
+
+def process_frame_cached(args, cache):
+    """process_frame with cached results: only the missing (model, slice) results are evaluated"""
+    (gt_path, pred_paths, alignments, preprocessor, max_distance,
+     shadow_mask_dir, labeling_path, slices, verbose, scale_shifts, distance_bins, shadow_sweep, sample) = args
+    if sample is not None:
+        raise ValueError("sampled frames are not cached")
+    scale_shifts = scale_shifts or [None] * len(pred_paths)
+
+    with profiling.stage("cache_lookup"):
+        try:
+            keys = cache.frame_keys(gt_path, pred_paths, [a or preprocessor.alignment for a in alignments],
+                                    scale_shifts, slices, shadow_mask_dir, labeling_path, distance_bins,
+                                    preprocessor.dark_masks, shadow_sweep)
+        except OSError as e:
+            print(f"Error processing {gt_path}: {e}")
+            return None
+        found = cache.get_many(key for model_keys in keys for key in model_keys)
+
+    missing = [m for m, model_keys in enumerate(keys) if any(key not in found for key in model_keys)]
+    if not missing:
+        return [_shaped(found, model_keys, len(slices)) for model_keys in keys]
+
+    # Only the slices missing for some model are evaluated (e.g. a slice added to a previous run)
+    missing_slices = sorted({i % len(slices) for m in missing for i, key in enumerate(keys[m]) if key not in found})
+    computed = process_frame((
+        gt_path, [pred_paths[m] for m in missing], [alignments[m] for m in missing], preprocessor,
+        max_distance, shadow_mask_dir, labeling_path, [slices[i] for i in missing_slices], verbose,
+        [scale_shifts[m] for m in missing], distance_bins, shadow_sweep, None
+    ))
+    if computed is None:
+        return None
+
+    results = [_shaped(found, model_keys, len(slices)) for model_keys in keys]
+    for m, model_result in zip(missing, computed):
+        if model_result is None:
+            results[m] = None
+            continue
+        # Binned and sweep sums follow the per-slice sums, one block of len(slices) each
+        positions = [b * len(slices) + i for b in range(len(keys[m]) // len(slices)) for i in missing_slices]
+        for i, sums in zip(positions, model_result):
+            results[m][i] = sums
+            cache.put(keys[m][i], sums)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-frame result cache maintenance")
+    parser.add_argument("command", choices=["stats", "verify"])
+    parser.add_argument("cache_path")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.cache_path):
+        raise FileNotFoundError(f"Result cache not found: {args.cache_path}")
+    cache = ResultCache(args.cache_path, config=None, max_bytes=None)
+    if args.command == "verify":
+        status, dropped = cache.verify()
+        print(f"Database check: {status}, {dropped} corrupt entries removed")
+    count, nbytes = cache.size()
+    print(f"{count} entries, {nbytes / (1 << 20):.1f} MB")
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
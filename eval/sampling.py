@@ -0,0 +1,174 @@
+"""
+Stratified pixel sampling for fast previews
+
+With a PixelSample every worker evaluates a stratified subsample of the valid pixels of each frame
+instead of all of them. Strata are GT distance bands (DISTANCE_BANDS bands of equal width in log
+depth over the frame's valid range) crossed with the label classes (LABEL_CLASS_IDS, 0 = unlabeled)
+when a label map is available. The sample is allocated proportionally to the stratum sizes, with at
+least two pixels per stratum. Every sampled pixel is weighted by N_h / m_h, so the weighted sums
+estimate the full-frame sums. Alignment and metrics only see the sampled pixels.
+
+Standard errors use random groups: the sample of every stratum is dealt into REPLICATE_GROUPS
+groups, and each group, weighted up by REPLICATE_GROUPS, is an independent estimate of the frame
+sums, with its own alignment fit. Replicates are accumulated like the full sample (SampleReplicates).
+The spread of the replicate metrics gives the pixel sampling error, shrunk by the finite population
+correction of the frame.
+When only a fraction of the frames is evaluated (sample_frames), the spread of the per-image metrics
+adds the frame sampling error.
+"""
+
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+from metrics import (LABEL_CLASS_IDS, METRIC_NAMES, MetricCurve, _bincount_sums, _pixel_terms,
+                     label_ids_from_rgb, load_label_image)
+
+DISTANCE_BANDS = 8
+NUM_CLASSES = len(LABEL_CLASS_IDS) + 1
+REPLICATE_GROUPS = 10
+
+# Pixels evaluated per frame: a fraction of the valid pixels and/or at most max_pixels
+PixelSample = namedtuple("PixelSample", ["fraction", "max_pixels", "seed"])
+
+
+def sample_frames(num_frames, fraction, seed=0):
+    """Sorted indices of a random subset of round(fraction * num_frames) frames (at least one)"""
+    count = min(num_frames, max(1, int(round(fraction * num_frames))))
+    return np.sort(np.random.default_rng(seed).choice(num_frames, count, replace=False)).tolist()
+
+
+def frame_class_ids(pred_file, preprocessor, labeling_path, gt_path=None):
+    """Class id map of a frame from the dataset cache or the label image, None without labels"""
+    if not labeling_path:
+        return None
+    cached = preprocessor.cached_frame(gt_path) if gt_path else None
+    if cached is not None and cached.has_labels_from(labeling_path):
+        return cached.class_ids()
+    labeling_img = load_label_image(pred_file, labeling_path)
+    return None if labeling_img is None else label_ids_from_rgb(labeling_img)
+
+
+def stratum_index(gt_values, class_ids=None):
+    """Stratum of every valid pixel (distance band x label class) and the number of strata"""
+    log_depth = np.log(gt_values)
+    lo, hi = log_depth.min(), log_depth.max()
+    band = ((log_depth - lo) * (DISTANCE_BANDS / max(hi - lo, 1e-12))).astype(np.uint8)
+    np.minimum(band, DISTANCE_BANDS - 1, out=band)
+    if class_ids is None:
+        return band, DISTANCE_BANDS
+    return band * NUM_CLASSES + class_ids, DISTANCE_BANDS * NUM_CLASSES
+
+
+def stratified_sample(strata, num_strata, num_samples, rng):
+    """Proportionally allocated sample of positions in strata.
+
+    Returns the sampled positions, their weights N_h / m_h and their replicate group.
+    """
+    counts = np.bincount(strata, minlength=num_strata)
+    allocation = np.round(counts * (num_samples / counts.sum())).astype(np.intp)
+    allocation = np.minimum(counts, np.maximum(allocation, 2))
+    # uint8 strata are sorted with a radix sort
+    order = np.argsort(strata, kind="stable")
+    starts = np.cumsum(counts) - counts
+    positions = np.concatenate([order[start + rng.choice(count, size, replace=False)]
+                                for start, count, size in zip(starts, counts, allocation) if size])
+    present = allocation > 0
+    weights = np.repeat(counts[present] / allocation[present], allocation[present])
+    # Positions are in random order within every stratum, so dealing them out balances the groups
+    groups = np.arange(positions.size) % REPLICATE_GROUPS
+    return positions, weights, groups
+
+
+def draw_pixel_sample(gt, sample, class_ids=None, frame_name=""):
+    """Sample the valid pixels of a frame: (flat pixel indices, weights, replicate groups, sampled fraction).
+
+    The generator is seeded with the sample seed and the frame name, so every run (and every worker)
+    draws the same pixels.
+    """
+    valid = np.flatnonzero(gt.reshape(-1) > 0)
+    num_samples = valid.size
+    if sample.fraction is not None:
+        num_samples = int(np.ceil(sample.fraction * valid.size))
+    if sample.max_pixels is not None:
+        num_samples = min(num_samples, sample.max_pixels)
+    if valid.size == 0:
+        return valid, np.zeros(0), np.zeros(0, dtype=np.intp), 1.0
+
+    rng = np.random.default_rng([sample.seed, zlib.crc32(frame_name.encode())])
+    strata, num_strata = stratum_index(gt.reshape(-1)[valid],
+                                       None if class_ids is None else class_ids.reshape(-1)[valid])
+    positions, weights, groups = stratified_sample(strata, num_strata, num_samples, rng)
+    return valid[positions], weights, groups, positions.size / valid.size
+
+
+def align_sample(preprocessor, pred, gt, groups, alignment=None, scale_shift=None):
+    """Align sampled pixels on the whole sample, and every replicate group on its own pixels.
+    
+    Fitting the replicates separately puts the variance of the alignment fit into the standard errors.
+    """
+    aligned = preprocessor.align_resized(pred, gt, alignment, scale_shift)
+    replicate_aligned = np.empty_like(aligned)
+    for group in range(REPLICATE_GROUPS):
+        members = groups == group
+        if members.any():
+            replicate_aligned[members] = preprocessor.align_resized(pred[members], gt[members], alignment, scale_shift)
+    return aligned, replicate_aligned
+
+
+def sampled_metric_sums(gt, pred, replicate_pred, weights, groups, sampled_fraction, masks=(None,),
+                        min_valid_pixels=0):
+    """Estimated frame sums of sampled pixels per mask: [1 + REPLICATE_GROUPS, NUM_SUMS] each.
+    
+    Row 0 is the weighted estimate of the full-frame sums from pred. Rows 1.. are the replicate
+    estimates from replicate_pred (see align_sample), shrunk towards their mean by the finite
+    population correction. None if the estimated number of valid pixels is below min_valid_pixels,
+    as in compute_metric_sums.
+    """
+    everything = np.ones(gt.shape, dtype=bool)
+    terms, category = _pixel_terms(gt, pred, everything)
+    replicate_terms, replicate_category = _pixel_terms(gt, replicate_pred, everything)
+    correction = np.sqrt(max(1.0 - sampled_fraction, 0.0))
+    single = np.zeros(gt.shape, dtype=np.intp)
+    results = []
+    for mask in masks:
+        # Pixels outside the mask go to an extra group that is dropped
+        estimate = _bincount_sums(single if mask is None else np.where(mask, 0, 1), 1, terms, category, weights)[0]
+        if estimate[0] < min_valid_pixels:
+            results.append(None)
+            continue
+        index = groups if mask is None else np.where(mask, groups, REPLICATE_GROUPS)
+        replicates = _bincount_sums(index, REPLICATE_GROUPS, replicate_terms, replicate_category,
+                                    weights * REPLICATE_GROUPS)
+        center = replicates.mean(axis=0)
+        results.append(np.vstack([estimate, center + correction * (replicates - center)]))
+    return results
+
+
+class SampleReplicates(MetricCurve):
+    """Accumulated replicate estimates of one (model, slice) for the standard errors of a sampled run"""
+
+    def __init__(self, stats=None):
+        super().__init__([f"replicate {r}" for r in range(REPLICATE_GROUPS)], stats)
+
+
+def standard_errors(accumulator, replicates=None, pixel_weighted=False, frames_sampled=None, frames_total=None):
+    """{metric: standard error} of a sampled run, None if nothing was evaluated.
+
+    replicates (SampleReplicates) gives the pixel sampling error; frames_sampled < frames_total adds the
+    frame sampling error from the spread of the per-image metrics (also used for pixel-weighted metrics).
+    """
+    if accumulator.n_images == 0:
+        return None
+    variance = np.zeros(len(METRIC_NAMES))
+    if replicates is not None:
+        values = [acc.metrics(pixel_weighted) for acc in replicates.accumulators().values()]
+        values = np.array([[v[m] for m in METRIC_NAMES] for v in values if v is not None])
+        if len(values) > 1:
+            variance += values.var(axis=0, ddof=1) / len(values)
+    k = accumulator.n_images
+    if frames_total and frames_sampled and frames_sampled < frames_total and k > 1:
+        spread = np.array([accumulator.image_std()[m] for m in METRIC_NAMES]) ** 2 * k / (k - 1)
+        variance += spread / k * (1 - frames_sampled / frames_total)
+    return dict(zip(METRIC_NAMES, np.sqrt(variance).tolist()))
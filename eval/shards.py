@@ -0,0 +1,213 @@
+"""
+Sharded evaluation across machines
+
+`eval2results.py --shard i/N --shard_output part_i.json` evaluates every N-th frame of the paired file
+list starting at frame i (i = 0 .. N-1) and writes the mergeable statistics of the shard to a small
+JSON file:
+    fingerprint    hash of the options that change the metric sums (preprocessing config, models and
+                   their alignment, slices, distance bins, shadow sweep kernels, metrics backend)
+    files          frame count and hash of the full paired file list (file names, before sharding)
+    shard_count    N, and shards: the shard indices the file holds
+    results        MetricAccumulator statistics per (model, slice)
+    distance_curves, shadow_sweep_curves   MetricCurve statistics, with --distance_bins / --shadow_sweep
+
+`python shards.py merge part_*.json` adds the statistics of all N shards and prints the tables of a
+single-machine run. Shards with a different fingerprint or file list, duplicate shards and missing
+shards are refused. The merged sums only differ from a single run by the floating point summation
+order, as between runs with a different --num_workers.
+
+Usage:
+    python eval2results.py /path/to/gt /path/to/preds --relative_depth --shard 0/4 --shard_output part_0.json
+    python shards.py merge part_*.json --output merged.json
+"""
+
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from metrics import DistanceBins, DistanceCurve, MetricAccumulator, ShadowSweepCurve
+
+SHARD_VERSION = 1
+
+
+def parse_shard(text):
+    """argparse type of --shard: 'i/N' with 0 <= i < N, returns (i, N)"""
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard '{text}', expected i/N (e.g. 0/4)")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"invalid shard '{text}', needs 0 <= i < N")
+    return index, count
+
+
+def _hash(value):
+    return hashlib.blake2b(json.dumps(value, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+def file_list_digest(gt_paths, models):
+    """Frame count and hash of the paired (GT, predictions) file names of every frame"""
+    num_frames = min([len(gt_paths)] + [len(model.pred_paths) for model in models])
+    names = [[os.path.basename(gt_paths[i])] + [os.path.basename(model.pred_paths[i]) for model in models]
+             for i in range(num_frames)]
+    return {"frames": num_frames, "digest": _hash(names)}
+
+
+def shard_file_lists(gt_paths, models, index, count):
+    """The GT paths and models of shard index of count: every count-th paired frame from frame index"""
+    num_frames = min([len(gt_paths)] + [len(model.pred_paths) for model in models])
+    for model in models:
+        if len(model.pred_paths) != len(gt_paths):
+            print(f"Warning: {model.name} has {len(model.pred_paths)} predictions for {len(gt_paths)} "
+                  f"ground truth files, sharding the first {num_frames}")
+    frames = range(index, num_frames, count)
+    return ([gt_paths[i] for i in frames],
+            [model._replace(pred_paths=[model.pred_paths[i] for i in frames]) for model in models])
+
+
+def run_config(args, preprocessor, models, slices):
+    """Options of an eval2results.py run that change the merged statistics"""
+    from metrics import slice_name
+    from result_cache import result_cache_config
+
+    config = result_cache_config(preprocessor, args.max_gt_distance, args.metrics_backend, args.metrics_dtype)
+    del config["version"]
+    config.update({
+        "models": [[model.name, model.alignment or preprocessor.alignment] for model in models],
+        "slices": [slice_name(eval_slice) for eval_slice in slices],
+        "distance_bins": args.distance_bins,
+        "shadow_sweep": args.shadow_kernel_sizes if args.shadow_sweep else None,
+        "shadow_threshold": args.shadow_threshold if args.shadow_rgb else None,
+    })
+    return config
+
+
+def write_partial(path, config, files, shard, results, distance_curves=None, shadow_sweep_curves=None):
+    """Write the statistics of shard (i, N) of a run with config over files (see file_list_digest)"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    index, count = shard
+    partial = {
+        "version": SHARD_VERSION,
+        "fingerprint": _hash(config),
+        "config": config,
+        "files": files,
+        "shard_count": count,
+        "shards": [index],
+        "results": [[model_name, name, accumulator.stats.tolist()]
+                    for (model_name, name), accumulator in results.items()],
+        "distance_curves": [[model_name, name, curve.stats.tolist()]
+                            for (model_name, name), curve in (distance_curves or {}).items()],
+        "shadow_sweep_curves": [[model_name, name, kernel, curve.stats.tolist()]
+                                for (model_name, name, kernel), curve in (shadow_sweep_curves or {}).items()],
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(partial, f, ensure_ascii=False)
+
+
+def _add_partial(merged, partial):
+    """Add the statistics of partial into merged (both as loaded from JSON)"""
+    for entry, other in zip(merged["results"], partial["results"]):
+        entry[2] += np.asarray(other[2])
+    for entry, other in zip(merged["distance_curves"], partial["distance_curves"]):
+        entry[2] += np.asarray(other[2])
+    for entry, other in zip(merged["shadow_sweep_curves"], partial["shadow_sweep_curves"]):
+        entry[3] += np.asarray(other[3])
+    merged["shards"] += partial["shards"]
+
+
+def merge_partials(paths):
+    """Merge the partial results files of all shards of a run; raises ValueError if they do not belong together"""
+    merged = None
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            partial = json.load(f)
+        if partial.get("version") != SHARD_VERSION:
+            raise ValueError(f"{path} is not a partial results file of version {SHARD_VERSION}")
+        if merged is None:
+            merged, first = partial, path
+            for entry in merged["results"] + merged["distance_curves"]:
+                entry[2] = np.asarray(entry[2])
+            for entry in merged["shadow_sweep_curves"]:
+                entry[3] = np.asarray(entry[3])
+            continue
+        if partial["fingerprint"] != merged["fingerprint"]:
+            changed = sorted(key for key in set(partial["config"]) | set(merged["config"])
+                             if partial["config"].get(key) != merged["config"].get(key))
+            raise ValueError(f"{path} was evaluated with a different config than {first} ({', '.join(changed)})")
+        if partial["files"] != merged["files"]:
+            raise ValueError(f"{path} was evaluated on a different file list than {first} "
+                             f"({partial['files']['frames']} vs {merged['files']['frames']} frames)")
+        if partial["shard_count"] != merged["shard_count"]:
+            raise ValueError(f"{path} is one of {partial['shard_count']} shards, {first} of {merged['shard_count']}")
+        duplicates = set(partial["shards"]) & set(merged["shards"])
+        if duplicates:
+            raise ValueError(f"{path} repeats shard(s) {sorted(duplicates)}")
+        _add_partial(merged, partial)
+    if merged is None:
+        raise ValueError("no partial results files")
+    count = merged["shard_count"]
+    missing = sorted(set(range(count)) - set(merged["shards"]))
+    if missing:
+        raise ValueError(f"missing shard(s) {', '.join(f'{i}/{count}' for i in missing)}")
+    return merged
+
+
+def partial_results(merged):
+    """(results, distance_curves, shadow_sweep_curves) dicts of merged partial results, as returned
+    by evaluate_models_parallel
+    """
+    config = merged["config"]
+    results = {(model_name, name): MetricAccumulator(stats) for model_name, name, stats in merged["results"]}
+    distance_curves = {}
+    if config["distance_bins"]:
+        bins = DistanceBins(*config["distance_bins"])
+        distance_curves = {(model_name, name): DistanceCurve(bins, stats)
+                           for model_name, name, stats in merged["distance_curves"]}
+    shadow_sweep_curves = {(model_name, name, kernel): ShadowSweepCurve(kernel, stats)
+                           for model_name, name, kernel, stats in merged["shadow_sweep_curves"]}
+    return results, distance_curves, shadow_sweep_curves
+
+
+def main():
+    from eval2results import print_curves, print_results
+
+    parser = argparse.ArgumentParser(description="Sharded evaluation")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    merge = subparsers.add_parser("merge", help="Merge the partial results of all shards and print the tables")
+    merge.add_argument("partials", nargs="+", help="Partial results files written with --shard_output")
+    merge.add_argument("--output", type=str, help="Write the merged statistics as one partial results file")
+    merge.add_argument("--pixel_weighted", action="store_true",
+                       help="Report metrics over all valid pixels instead of averaging per-image metrics")
+    merge.add_argument("--distance_curve_csv", type=str, help="Write the distance curves to this csv file")
+    merge.add_argument("--shadow_sweep_step", type=int, default=16,
+                       help="Threshold step of the printed shadow sweep tables")
+    merge.add_argument("--shadow_sweep_csv", type=str, help="Write every shadow sweep threshold to this csv file")
+
+    args = parser.parse_args()
+
+    if args.command == "merge":
+        try:
+            merged = merge_partials(args.partials)
+        except ValueError as error:
+            raise SystemExit(f"Cannot merge: {error}")
+        config = merged["config"]
+        print(f"Merged {merged['shard_count']} shard(s) of {merged['files']['frames']} frames "
+              f"(fingerprint {merged['fingerprint']})")
+        results, distance_curves, shadow_sweep_curves = partial_results(merged)
+        args.shadow_threshold = config["shadow_threshold"] or 0
+        print_curves(args, distance_curves, shadow_sweep_curves)
+        print_results(args, results, config["models"], config["slices"])
+        if args.output:
+            write_partial(args.output, config, merged["files"], (0, 1), results, distance_curves,
+                          shadow_sweep_curves)
+            print(f"Merged statistics written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""
+Batched torch CPU evaluation backend (--metrics_backend torch)
+
+A worker stacks the frames of a batch that share a shape and dtype into [B, H, W] tensors. Alignment
+(closed-form least squares per frame, median scaling or a fixed dataset-level scale/shift), clipping
+and the metric sums of every slice then run as batched tensor ops on torch's intra-op thread pool.
+One process evaluates many frames at once instead of one frame per process. Decoding, resizing and
+mask loading stay per frame, through the preprocessor and build_slice_masks.
+
+The metric sums are reduced in pixel chunks of at most CHUNK_ELEMENTS values per batch, so the
+scratch buffers do not grow with the batch size. The terms of a chunk are computed in place in the
+working precision, and every slice is summed in one torch.bmm of the float64 slice weights
+[B, S, pixels] with the terms [B, pixels, 10]. Sums are accumulated in float64, as in the NumPy
+engine, and results match process_frame within floating point tolerance
+(benchmarks/bench_torch_backend.py).
+"""
+
+import numpy as np
+import torch
+
+import profiling
+from alignment import sampling_stride
+from metrics import (EPS, NUM_SUMS, THRESHOLDS, build_slice_masks, compute_binned_metric_sums,
+                     compute_shadow_sweep_sums, distance_bin_index, metrics_dtype, prediction_name)
+
+CHUNK_ELEMENTS = 1 << 18
+
+
+def _median(values, valid):
+    """Per-row median of values[valid] like np.median (mean of the two middle values); NaN for empty rows"""
+    values = torch.where(valid, values, torch.nan)
+    # nanmedian selects the lower middle value, the upper one is the lower middle of -values
+    return (torch.nanmedian(values, dim=1).values - torch.nanmedian(-values, dim=1).values) / 2
+
+
+def _least_square_sums(gt, pred, valid, stride):
+    """[B, 5] sums [n, Σp, Σg, Σp², Σpg] per frame on the strided grid (see alignment.least_square_sums)"""
+    gt, pred, valid = gt[:, ::stride, ::stride], pred[:, ::stride, ::stride], valid[:, ::stride, ::stride]
+    batch = gt.shape[0]
+    g = torch.where(valid, gt, 0).reshape(batch, -1).to(torch.float64)
+    p = torch.where(valid, pred, 0).reshape(batch, -1).to(torch.float64)
+    return torch.stack([valid.reshape(batch, -1).sum(dim=1).to(torch.float64),
+                        p.sum(dim=1), g.sum(dim=1), (p * p).sum(dim=1), (p * g).sum(dim=1)], dim=1)
+
+
+def _solve_scale_shift(sums):
+    """Batched alignment.solve_scale_shift: [B] scales and shifts"""
+    n, sum_p, sum_g, sum_pp, sum_pg = sums.unbind(dim=1)
+    safe_n = n.clamp_min(1)
+    denom = n * sum_pp - sum_p**2
+    regular = denom > 1e-12 * n * sum_pp
+    scale = (n * sum_pg - sum_p * sum_g) / torch.where(regular, denom, 1)
+    shift = (sum_g - scale * sum_p) / safe_n
+    # Constant prediction: minimum norm solution, as lstsq
+    p, g = sum_p / safe_n, sum_g / safe_n
+    scale = torch.where(regular, scale, p * g / (p**2 + 1))
+    shift = torch.where(regular, shift, g / (p**2 + 1))
+    empty = n == 0
+    return torch.where(empty, 0, scale), torch.where(empty, 0, shift)
+
+
+def align_batch(preprocessor, gt, pred, alignment, scale_shift=None):
+    """Batched OptimizedDepthPreprocessor.align_prediction of resized predictions [B, H, W]"""
+    alignment = alignment or preprocessor.alignment
+    valid = gt > 0
+    stride = sampling_stride(gt.shape, preprocessor.alignment_max_res)
+    if alignment in ("relative", "disparity"):
+        target = gt
+        if alignment == "disparity":
+            target = torch.where(valid, 1.0 / torch.where(valid, gt, 1), 0)
+            valid = valid & (pred > 0)
+        if scale_shift is None:
+            scale, shift = _solve_scale_shift(_least_square_sums(target, pred, valid, stride))
+        else:
+            scale, shift = (torch.full((gt.shape[0],), float(v), dtype=torch.float64) for v in scale_shift)
+        if not pred.is_floating_point():
+            pred = pred.to(torch.float64)
+        # Only the least squares sums need float64; the aligned prediction keeps its precision
+        pred = pred * scale.to(pred.dtype)[:, None, None] + shift.to(pred.dtype)[:, None, None]
+        if alignment == "disparity":
+            pred = pred.clamp_min(1e-6)
+            pred = torch.where(pred > 0, 1.0 / pred, 0)
+    elif alignment == "absolute":
+        if scale_shift is None:
+            batch = gt.shape[0]
+            flat_valid = valid.reshape(batch, -1)
+            scale = _median(gt.reshape(batch, -1), flat_valid) / _median(pred.reshape(batch, -1), flat_valid)
+            # Frames without valid pixels keep their prediction
+            scale = torch.where(flat_valid.any(dim=1), scale, 1).to(pred.dtype)
+            pred = pred * scale[:, None, None]
+        else:
+            pred = pred * scale_shift[0]
+    pred = pred.clamp(preprocessor.min_depth, preprocessor.max_depth)
+    return pred.clamp_min(1e-6)
+
+
+def batch_metric_sums(gt, pred, masks, dtype):
+    """[B, S, NUM_SUMS] float64 sums of stacked frames gt, pred [B, H, W] over masks [B, S, H, W]"""
+    batch, num_slices = masks.shape[:2]
+    gt = gt.reshape(batch, -1)
+    pred = pred.reshape(batch, -1)
+    masks = masks.reshape(batch, num_slices, -1)
+    dtype = getattr(torch, np.dtype(dtype).name)
+    chunk = min(max(1, CHUNK_ELEMENTS // batch), gt.shape[1])
+    # Scratch buffers reused by every chunk, the terms are ordered as SUM_FIELDS[1:]
+    terms_buf = torch.empty((batch, NUM_SUMS - 1, chunk), dtype=dtype)
+    g_buf, p_buf, a_buf = (torch.empty((batch, chunk), dtype=dtype) for _ in range(3))
+    valid_buf = torch.empty((batch, chunk), dtype=torch.bool)
+    selected_buf = torch.empty((batch, num_slices, chunk), dtype=torch.bool)
+    weights_buf = torch.empty((batch, num_slices, chunk), dtype=torch.float64)
+    sums = torch.zeros((batch, num_slices, NUM_SUMS), dtype=torch.float64)
+    
+    for start in range(0, gt.shape[1], chunk):
+        k = min(chunk, gt.shape[1] - start)
+        terms, g, p, a = terms_buf[..., :k], g_buf[:, :k], p_buf[:, :k], a_buf[:, :k]
+        valid, selected, weights = valid_buf[:, :k], selected_buf[..., :k], weights_buf[..., :k]
+        torch.gt(gt[:, start:start + k], 0, out=valid)
+        torch.logical_and(masks[..., start:start + k], valid.unsqueeze(1), out=selected)
+        weights.copy_(selected)
+        
+        # Invalid pixels get finite placeholder values and zero weight
+        g.copy_(gt[:, start:start + k]).masked_fill_(~valid, 1).clamp_min_(EPS)
+        p.copy_(pred[:, start:start + k]).masked_fill_(~valid, 1).clamp_min_(EPS)
+        torch.sub(g, p, out=a)
+        abs_err, sq_err = terms[:, 0], terms[:, 2]
+        torch.abs(a, out=abs_err)
+        torch.lt(abs_err, 0.5, out=terms[:, 9])
+        torch.mul(a, a, out=sq_err)
+        torch.div(sq_err, g, out=terms[:, 1])
+        abs_err.div_(g)
+        
+        log_diff = terms[:, 5]
+        torch.log(p, out=log_diff)
+        torch.log(g, out=a)
+        log_diff.sub_(a)
+        torch.mul(log_diff, log_diff, out=terms[:, 3])
+        torch.abs(log_diff, out=terms[:, 4])
+        
+        # Threshold accuracy on max(gt / pred, pred / gt)
+        torch.div(g, p, out=a)
+        torch.maximum(a, torch.div(p, g, out=terms[:, 6]), out=a)
+        for i, threshold in enumerate(THRESHOLDS):
+            torch.lt(a, threshold, out=terms[:, 6 + i])
+        
+        sums[..., 0] += weights.sum(dim=2)
+        sums[..., 1:] += torch.bmm(weights, terms.to(torch.float64).transpose(1, 2))
+    return sums.numpy()
+
+
+def _stack(arrays):
+    return torch.from_numpy(np.stack(arrays))
+
+
+def process_frames_batched(frames, alignments, preprocessor, max_distance, shadow_mask_dir, labeling_path,
+                           slices, verbose, scale_shifts=None, distance_bins=None, shadow_sweep=None):
+    """process_frame for a list of (gt_path, pred_paths) frames with batched alignment and metrics.
+
+    Returns one process_frame result per frame (None if the frame failed).
+    """
+    scale_shifts = scale_shifts or [None] * len(alignments)
+    loaded = []
+    for gt_path, pred_paths in frames:
+        pred_file = prediction_name(gt_path, pred_paths[0])
+        try:
+            with profiling.stage("decode_gt"):
+                gt = preprocessor.load_gt(gt_path, max_distance)
+            profiling.count_bytes("decode_gt", gt.nbytes)
+            with profiling.stage("mask"):
+                masks = build_slice_masks(gt, pred_file, slices, preprocessor,
+                                          shadow_mask_dir, labeling_path, gt_path=gt_path)
+            profiling.count_bytes("mask", sum(mask.nbytes for mask in masks if mask is not None))
+            extra = {}
+            if distance_bins is not None:
+                extra["bins"] = distance_bin_index(gt, distance_bins)
+            if shadow_sweep is not None:
+                with profiling.stage("shadow_levels"):
+                    levels = preprocessor.dark_masks.levels(pred_file, shadow_sweep)
+                if levels is None:
+                    raise FileNotFoundError(f"no RGB image for {pred_file}")
+                extra["levels"] = [levels[k] for k in shadow_sweep]
+        except Exception as e:
+            print(f"Error processing {gt_path}: {e}")
+            loaded.append(None)
+            continue
+
+        preds = []
+        for pred_path, alignment in zip(pred_paths, alignments):
+            try:
+                with profiling.stage("decode_pred"):
+                    pred = preprocessor.load_depth(pred_path, is_gt=False, alignment=alignment)
+                if pred is None:
+                    raise ValueError("The predicted depth map is None")
+                profiling.count_bytes("decode_pred", pred.nbytes)
+                preds.append(preprocessor.resize_prediction(pred, gt))
+            except Exception as e:
+                print(f"Error processing {pred_path if isinstance(pred_path, str) else pred_file}: {e}")
+                preds.append(None)
+        loaded.append((gt, masks, preds, extra))
+
+    results = [None if frame is None else [None] * len(alignments) for frame in loaded]
+    for m, (alignment, scale_shift) in enumerate(zip(alignments, scale_shifts)):
+        # Frames are stacked by shape and dtype
+        groups = {}
+        for i, frame in enumerate(loaded):
+            if frame is not None and frame[2][m] is not None:
+                gt, pred = frame[0], frame[2][m]
+                groups.setdefault((gt.shape, gt.dtype, pred.dtype), []).append(i)
+        for indices in groups.values():
+            try:
+                _evaluate_group(loaded, indices, m, results, preprocessor, alignment, scale_shift, verbose,
+                                distance_bins, shadow_sweep)
+            except Exception as e:
+                print(f"Error processing a batch of {len(indices)} frames: {e}")
+    return results
+
+
+def _evaluate_group(loaded, indices, m, results, preprocessor, alignment, scale_shift, verbose,
+                    distance_bins, shadow_sweep):
+    """Align and evaluate model m on frames of the same shape and dtype, filling results in place"""
+    with profiling.stage("stack"):
+        gt = _stack([loaded[i][0] for i in indices])
+        pred = _stack([loaded[i][2][m] for i in indices])
+        full = np.ones(gt.shape[1:], dtype=bool)
+        masks = _stack([np.stack([full if mask is None else mask for mask in loaded[i][1]]) for i in indices])
+    with profiling.stage("align"):
+        pred = align_batch(preprocessor, gt, pred, alignment, scale_shift)
+    with profiling.stage("metrics"):
+        dtype = metrics_dtype(loaded[indices[0]][0].dtype, pred.numpy().dtype)
+        sums = batch_metric_sums(gt, pred, masks, dtype)
+
+    min_valid_pixels = gt.shape[1] * gt.shape[2] * 0.001
+    for b, i in enumerate(indices):
+        gt_frame, frame_masks, _, extra = loaded[i]
+        model_result = []
+        for slice_sums in sums[b]:
+            if slice_sums[0] < min_valid_pixels:
+                if verbose:
+                    print("Warning: Too few valid pixels for reliable metrics")
+                model_result.append(None)
+            else:
+                model_result.append(slice_sums)
+        pred_frame = pred[b].numpy()
+        if distance_bins is not None:
+            with profiling.stage("distance_bins"):
+                model_result.extend(compute_binned_metric_sums(gt_frame, pred_frame, *extra["bins"], frame_masks))
+        if shadow_sweep is not None:
+            with profiling.stage("shadow_sweep"):
+                model_result.extend(compute_shadow_sweep_sums(gt_frame, pred_frame, extra["levels"], frame_masks))
+        results[i][m] = model_result
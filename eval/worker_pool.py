@@ -0,0 +1,324 @@
+"""
+Persistent evaluation worker pool
+
+The preprocessor and the per-frame configuration are sent once to every worker through the pool
+initializer; tasks only carry file paths. Tasks are grouped into adaptively sized batches, at most
+a few batches are in flight at a time, and results are streamed back as batches complete.
+With the torch metrics backend a worker evaluates the frames of a batch together (torch_backend.py),
+on an intra-op thread pool of torch_threads threads (by default the cores shared out between workers).
+With io_threads every worker decodes the files of the next frames of its batch in a thread pool while
+it evaluates the current one (prefetch.py).
+A pool with a single worker evaluates in the calling process with a worker state of its own, so
+several pools (e.g. Evaluators) can live in one process.
+"""
+
+import itertools
+import os
+import signal
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from threading import Event
+
+import profiling
+from metrics import (configure_metrics, metrics_options, process_alignment_frame, process_frame,
+                     resolve_metrics_options)
+from prefetch import FramePrefetcher, frame_files
+from result_cache import process_frame_cached
+
+# Everything a worker needs to evaluate a frame besides its file paths
+FrameConfig = namedtuple("FrameConfig", ["alignments", "max_distance", "shadow_mask_dir",
+                                         "labeling_path", "slices", "verbose", "distance_bins",
+                                         "shadow_sweep", "sample"])
+
+# Seconds of work a batch should take once the per-frame cost is known
+TARGET_BATCH_SECONDS = 0.5
+
+# State of a pool worker process (see init_worker)
+_worker_state = {}
+
+
+def worker_state(preprocessor, frame_config, metrics_backend="numpy", metrics_dtype="auto", result_cache=None,
+                 io_threads=0, io_readahead=4):
+    """The preprocessor, frame config, metric options, result cache and prefetcher tasks are evaluated with"""
+    return {
+        "preprocessor": preprocessor,
+        "frame_config": frame_config,
+        "metrics_options": resolve_metrics_options(metrics_backend, metrics_dtype),
+        "result_cache": result_cache,
+        "batched": metrics_backend == "torch",
+        "prefetcher": FramePrefetcher(io_threads, io_readahead) if io_threads else None,
+    }
+
+
+def init_worker(preprocessor, frame_config, metrics_backend="numpy", metrics_dtype="auto", result_cache=None,
+                profile=False, io_threads=0, io_readahead=4, torch_threads=None):
+    """Pool initializer: keep the worker state (see worker_state) of this process for all later tasks"""
+    _worker_state.update(worker_state(preprocessor, frame_config, metrics_backend, metrics_dtype, result_cache,
+                                      io_threads, io_readahead))
+    configure_metrics(metrics_backend, metrics_dtype)
+    if metrics_backend == "torch" and torch_threads:
+        import torch
+        torch.set_num_threads(torch_threads)
+    if profile:
+        profiling.enable()
+
+
+def _init_pool_worker(*initargs):
+    # Ctrl-C is handled by the parent, which cancels the remaining work
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_worker(*initargs)
+
+
+def run_frame(state, task, scale_shifts=None, frame_config=None):
+    """Evaluate one (task_id, gt_path, pred_paths) task with a worker state's configuration (or frame_config)"""
+    task_id, gt_path, pred_paths = task
+    config = frame_config or state["frame_config"]
+    args = (gt_path, pred_paths, config.alignments, state["preprocessor"], config.max_distance,
+            config.shadow_mask_dir, config.labeling_path, config.slices, config.verbose, scale_shifts,
+            config.distance_bins, config.shadow_sweep, config.sample)
+    if state["result_cache"] is not None:
+        return task_id, process_frame_cached(args, state["result_cache"])
+    return task_id, process_frame(args)
+
+
+def run_frames_batched(state, batch, scale_shifts=None, frame_config=None):
+    """Evaluate a batch of tasks together with the batched torch backend; same results as run_frame"""
+    from torch_backend import process_frames_batched
+
+    config = frame_config or state["frame_config"]
+    results = process_frames_batched(
+        [(gt_path, pred_paths) for _, gt_path, pred_paths in batch], config.alignments,
+        state["preprocessor"], config.max_distance, config.shadow_mask_dir, config.labeling_path,
+        config.slices, config.verbose, scale_shifts, config.distance_bins, config.shadow_sweep)
+    return [(task[0], result) for task, result in zip(batch, results)]
+
+
+def run_alignment_frame(state, task):
+    """Alignment statistics of one (task_id, gt_path, pred_paths) task (global alignment first pass)"""
+    task_id, gt_path, pred_paths = task
+    config = state["frame_config"]
+    return task_id, process_alignment_frame((
+        gt_path, pred_paths, config.alignments, state["preprocessor"], config.max_distance
+    ))
+
+
+def run_batch(batch, frame_fn=run_frame, frame_args=(), state=None):
+    """Run frame_fn(state, task, *frame_args) on a batch of tasks, with the worker state of this
+    process unless a state is given.
+
+    Returns the results, the time spent, the profiling records and, with a prefetcher, the
+    (decode, wait) seconds of FramePrefetcher.take_stats.
+    """
+    start = time.perf_counter()
+    state = state or _worker_state
+    prefetcher = state["prefetcher"]
+    cached = state["result_cache"] is not None
+    batched = frame_fn is run_frame and state["batched"] and not cached
+    with metrics_options(state["metrics_options"]):
+        # Cached runs only read the frames they evaluate, so they are not prefetched
+        if prefetcher is not None and not cached:
+            # run_frame(state, task, scale_shifts, frame_config): a job's own config, or the state's
+            config = (frame_args[1] if frame_fn is run_frame and len(frame_args) > 1 else None) or \
+                state["frame_config"]
+
+            def files(task):
+                return frame_files(task[1], task[2], state["preprocessor"], config, masks=frame_fn is run_frame)
+
+            if batched:
+                # The whole batch is decoded ahead of the batched evaluation
+                for _ in prefetcher.frames([batch], lambda batch: [f for task in batch for f in files(task)]):
+                    results = run_frames_batched(state, batch, *frame_args)
+            else:
+                results = [frame_fn(state, task, *frame_args) for task in prefetcher.frames(batch, files)]
+        elif batched:
+            results = run_frames_batched(state, batch, *frame_args)
+        else:
+            results = [frame_fn(state, task, *frame_args) for task in batch]
+    if cached:
+        # New cache entries are written once per batch
+        with profiling.stage("cache_flush"):
+            state["result_cache"].flush()
+    io_stats = prefetcher.take_stats() if prefetcher is not None else None
+    return results, time.perf_counter() - start, profiling.take(), io_stats
+
+
+def frame_failed(result):
+    """Whether a frame (or one of its models) could not be evaluated"""
+    return result is None or any(model_result is None for model_result in result)
+
+
+class ThroughputMeter:
+    """Counts processed frames and errors and periodically prints the frame rate"""
+
+    def __init__(self, total=None, interval=5.0, label="frames"):
+        self.total = total
+        self.interval = interval
+        self.label = label
+        self.done = 0
+        self.errors = 0
+        self.start = time.perf_counter()
+        self._last_report = self.start
+
+    def update(self, frames, errors=0):
+        self.done += frames
+        self.errors += errors
+        now = time.perf_counter()
+        if self.interval and now - self._last_report >= self.interval:
+            self._last_report = now
+            print(self.status())
+
+    @property
+    def rate(self):
+        elapsed = time.perf_counter() - self.start
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def status(self):
+        progress = f"{self.done}/{self.total}" if self.total else f"{self.done}"
+        return f"Processed {progress} {self.label} ({self.rate:.1f} {self.label}/s, {self.errors} errors)"
+
+
+class EvaluationPool:
+    """Process pool that evaluates frames with a fixed configuration and streams results.
+
+    Use as a context manager; map_unordered may be called several times on the same pool, also from
+    several threads at once (every call has its own progress meter and I/O statistics).
+    Pressing Ctrl-C (or calling cancel()) stops submitting new work and returns what is done.
+    Batches hold at least min_batch_size tasks (the frames stacked by the torch backend).
+    With io_threads > 0 every worker decodes up to io_readahead frames ahead (see prefetch.py), and
+    the final status line reports how busy the decoding threads and the compute loop were.
+    With the torch backend every worker uses torch_threads intra-op threads, by default the CPU cores
+    divided by num_workers so the workers do not oversubscribe the CPU; a single-worker pool leaves the
+    torch threads of the calling process alone unless torch_threads is given.
+    """
+
+    def __init__(self, preprocessor, frame_config, num_workers=4, metrics_backend="numpy",
+                 metrics_dtype="auto", max_batch_size=64, progress_interval=5.0, result_cache=None,
+                 min_batch_size=1, io_threads=0, io_readahead=4, torch_threads=None):
+        self.num_workers = num_workers
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max(max_batch_size, min_batch_size)
+        self.progress_interval = progress_interval
+        self.io_threads = io_threads
+        self.cancelled = Event()
+        self.state = None
+        if num_workers == 1:
+            # Sequential processing in this process, with a worker state of this pool
+            self.state = worker_state(preprocessor, frame_config, metrics_backend, metrics_dtype, result_cache,
+                                      io_threads, io_readahead)
+            if metrics_backend == "torch" and torch_threads:
+                import torch
+                torch.set_num_threads(torch_threads)
+            self.executor = None
+        else:
+            if metrics_backend == "torch" and not torch_threads:
+                torch_threads = max(1, (os.cpu_count() or 1) // num_workers)
+            # Workers profile whenever the parent does (see profiling.py)
+            initargs = (preprocessor, frame_config, metrics_backend, metrics_dtype, result_cache,
+                        profiling.enabled(), io_threads, io_readahead, torch_threads)
+            self.executor = ProcessPoolExecutor(max_workers=num_workers, initializer=_init_pool_worker,
+                                                initargs=initargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        """Start the worker processes now, from the calling thread (otherwise the first batch starts them)"""
+        if self.executor is not None:
+            self.executor.submit(time.perf_counter).result()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=not self.cancelled.is_set(), cancel_futures=True)
+            self.executor = None
+
+    def cancel(self):
+        """Stop submitting work; in-flight batches are dropped"""
+        self.cancelled.set()
+
+    @staticmethod
+    def _add_io_stats(io_seconds, elapsed, io_stats):
+        if io_stats is not None:
+            io_seconds[0] += io_stats[0]
+            io_seconds[1] += io_stats[1]
+            io_seconds[2] += elapsed
+
+    def io_status(self, meter, io_seconds):
+        """Utilisation of the decoding threads and of the compute loops in a map_unordered call"""
+        decode, wait, busy = io_seconds
+        wall = max(time.perf_counter() - meter.start, 1e-9) * self.num_workers
+        return (f"I/O vs compute: {self.num_workers} worker(s) x {self.io_threads} I/O thread(s) decoded for "
+                f"{decode:.1f} s ({decode / (wall * self.io_threads):.0%} busy), compute {(busy - wait) / wall:.0%} "
+                f"busy, {wait / wall:.0%} waiting for decoded files")
+
+    def _batch_size(self, seconds_per_frame, remaining):
+        if seconds_per_frame is None:
+            return self.min_batch_size
+        size = int(TARGET_BATCH_SECONDS / max(seconds_per_frame, 1e-6))
+        if remaining is not None:
+            # Keep enough batches for every worker towards the end of the run
+            size = min(size, max(1, remaining // (self.num_workers * 2)))
+        return max(self.min_batch_size, min(size, self.max_batch_size))
+
+    def map_unordered(self, tasks, total=None, frame_fn=run_frame, frame_args=()):
+        """Yield (task_id, result) for every (task_id, gt_path, pred_paths) task as results arrive.
+        
+        frame_fn (run_frame or run_alignment_frame) is called as frame_fn(state, task, *frame_args) in the
+        workers, with the worker state (see worker_state).
+        """
+        meter = ThroughputMeter(total, self.progress_interval)
+        # Decoding thread seconds, seconds waited for decoded files and batch seconds of the workers
+        io_seconds = [0.0, 0.0, 0.0]
+        tasks = iter(tasks)
+        seconds_per_frame = None
+        submitted = 0
+        pending = set()
+        exhausted = False
+        max_in_flight = self.num_workers * 2
+        try:
+            while self.executor is None and not self.cancelled.is_set():
+                batch = list(itertools.islice(tasks, self.min_batch_size))
+                if not batch:
+                    break
+                results, elapsed, records, io_stats = run_batch(batch, frame_fn, frame_args, self.state)
+                profiling.merge(records)
+                self._add_io_stats(io_seconds, elapsed, io_stats)
+                meter.update(len(results), sum(frame_failed(r) for _, r in results))
+                yield from results
+
+            while self.executor is not None:
+                while not exhausted and not self.cancelled.is_set() and len(pending) < max_in_flight:
+                    remaining = None if total is None else total - submitted
+                    batch = list(itertools.islice(tasks, self._batch_size(seconds_per_frame, remaining)))
+                    if not batch:
+                        exhausted = True
+                        break
+                    submitted += len(batch)
+                    pending.add(self.executor.submit(run_batch, batch, frame_fn, frame_args))
+                if not pending or self.cancelled.is_set():
+                    break
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results, elapsed, records, io_stats = future.result()
+                    profiling.merge(records)
+                    self._add_io_stats(io_seconds, elapsed, io_stats)
+                    per_frame = elapsed / max(len(results), 1)
+                    seconds_per_frame = per_frame if seconds_per_frame is None else \
+                        0.8 * seconds_per_frame + 0.2 * per_frame
+                    meter.update(len(results), sum(frame_failed(r) for _, r in results))
+                    yield from results
+        except KeyboardInterrupt:
+            self.cancel()
+
+        if self.cancelled.is_set():
+            print(f"Cancelled: {meter.status()}")
+            for future in pending:
+                future.cancel()
+        elif self.progress_interval:
+            print(meter.status())
+            if self.io_threads:
+                print(self.io_status(meter, io_seconds))